@@ -1,10 +1,16 @@
 import streamlit as st
 import pandas as pd
-import json
-import requests
-import base64
 from datetime import datetime
-import io
+import uuid
+
+import core
+import instrumentation
+from history_model import as_strings, empty_history
+from history_query import has_filters
+from history_stats import HistoryStats
+from ingest import read_visit_files, read_visits
+from instrumentation import timed
+from reports import EXCEL_MAX_ROWS, EXPORT_FORMATS, history_export, payment_report
 
 # Настройка страницы
 st.set_page_config(
@@ -13,103 +19,156 @@ st.set_page_config(
     layout="wide"
 )
 
-# Получаем настройки из secrets
+# Получаем настройки из secrets (GITHUB_TOKEN, REPO_OWNER, REPO_NAME, GITHUB_API_URL, HISTORY_MAX_AGE,
+# JOURNAL_DIR, JOURNAL_FLUSH_DELAY; STORAGE_BACKEND = "sqlite" и SQLITE_PATH - локальная база; PERF_LOG_LEVEL). Хранилище и снимок истории общие для всех сессий процесса,
+# а RUN_ID создаётся заново при каждом перезапуске скрипта: все чтения за один перезапуск стоят
+# не более одного запроса, а в пределах HISTORY_MAX_AGE секунд после проверки - ни одного.
+# Оплаты сначала пишутся в локальный журнал и отправляются в GitHub фоновым потоком
 try:
-    GITHUB_TOKEN = st.secrets["GITHUB_TOKEN"]
-    REPO_OWNER = st.secrets["REPO_OWNER"] 
-    REPO_NAME = st.secrets["REPO_NAME"]
-    FILE_PATH = "data/payments.json"
+    history_store = core.open_store(st.secrets, journal=True)
 except KeyError as e:
     st.error(f"❌ Ошибка конфигурации: {e}. Проверьте файл secrets.toml")
     st.stop()
+RUN_ID = uuid.uuid4().hex
 
-# Функции для работы с GitHub
-def get_file_from_github():
-    """Загружает файл с данными из GitHub"""
-    url = f"https://api.github.com/repos/{REPO_OWNER}/{REPO_NAME}/contents/{FILE_PATH}"
-    headers = {"Authorization": f"token {GITHUB_TOKEN}"}
-    
+# Структурированные строки замеров (payment_system.perf): итог перезапуска на INFO, каждый замер на DEBUG
+instrumentation.configure_logging(st.secrets.get("PERF_LOG_LEVEL", "INFO"))
+
+# Как часто заглушка истории проверяет, закончилась ли фоновая загрузка, с
+PREFETCH_POLL_INTERVAL = 0.5
+
+def history_prefetch():
+    """Фоновая загрузка индекса и сводки истории; запускается при первом показе страницы в сессии"""
+    if 'history_prefetch' not in st.session_state:
+        st.session_state['history_prefetch'] = history_store.prefetch(RUN_ID)
+    return st.session_state['history_prefetch']
+
+def wait_for_history():
+    """Дожидается фоновой загрузки истории; ошибку покажет следующее обычное чтение"""
+    prefetch = history_prefetch()
+    if not prefetch.done():
+        with st.spinner(f"Дожидаемся загрузки истории из {history_store.backend_name}..."):
+            try:
+                prefetch.result()
+            except Exception:
+                pass
+
+@st.fragment(run_every=PREFETCH_POLL_INTERVAL)
+def history_placeholder():
+    """Заглушка сводки, пока история загружается в фоне; по окончании страница перерисовывается"""
+    if history_prefetch().done():
+        st.rerun()
+    st.info(f"⏳ Загружаем историю из {history_store.backend_name}...")
+
+class HistoryUnavailable(Exception):
+    """История оплат не загрузилась: сверять с ней загрузку нельзя"""
+
+# Функции для работы с данными
+def load_history_stats():
+    """Загружает сводку истории (счётчики и последние оплаты) без сборки полной таблицы; None при ошибке"""
     try:
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            content = response.json()
-            file_content = base64.b64decode(content['content']).decode('utf-8')
-            data = json.loads(file_content)
-            return data, content['sha']
-        else:
-            return [], None
+        return history_store.load_stats(RUN_ID)
     except Exception as e:
         st.error(f"Ошибка загрузки данных: {e}")
-        return [], None
+        return None
 
-def save_file_to_github(data, sha=None):
-    """Сохраняет файл с данными в GitHub"""
-    url = f"https://api.github.com/repos/{REPO_OWNER}/{REPO_NAME}/contents/{FILE_PATH}"
-    headers = {"Authorization": f"token {GITHUB_TOKEN}"}
-    
-    content = base64.b64encode(
-        json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
-    ).decode('utf-8')
-    
-    payload = {
-        "message": f"Update payments data - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
-        "content": content
-    }
-    
-    if sha:
-        payload["sha"] = sha
-    
+def query_paid_visits(filters):
+    """Загружает выборку истории по периоду, центру и визиту"""
+    with st.spinner("Загружаем данные..."):
+        try:
+            df, _ = core.query_paid_visits(history_store, RUN_ID, **filters)
+        except Exception as e:
+            st.error(f"Ошибка загрузки данных: {e}")
+            df = empty_history()
+        return df
+
+def export_history(fmt, filters):
+    """Собирает файл экспорта выборки по нажатию кнопки; кэшируется по версии хранилища и условиям"""
+    df, version = core.query_paid_visits(history_store, RUN_ID, **filters)
+    return history_export(df, fmt, version, filters)
+
+def export_rows(filters, total):
+    """Число строк выборки для экспорта; без условий - total из сводки, без чтения истории"""
+    if not has_filters(filters):
+        return total
     try:
-        response = requests.put(url, headers=headers, json=payload)
-        return response.status_code in [200, 201]
-    except Exception as e:
-        st.error(f"Ошибка сохранения данных: {e}")
-        return False
+        df, _ = core.query_paid_visits(history_store, RUN_ID, **filters)
+    except Exception:
+        # Размер выборки неизвестен: считаем её не меньше всей истории
+        return total
+    return len(df)
 
-# Функции для работы с данными
-def load_paid_visits():
-    """Загружает оплаченные визиты из GitHub"""
-    with st.spinner("Загружаем данные из GitHub..."):
-        data, sha = get_file_from_github()
-        if data:
-            df = pd.DataFrame(data)
-            st.session_state['github_sha'] = sha
-            return df
-        else:
-            st.session_state['github_sha'] = None
-            return pd.DataFrame(columns=['subject_id', 'visit_name', 'visit_date', 'payment_date', 'payment_amount'])
+def period_bounds(period):
+    """(начало, конец) из st.date_input с периодом; пока выбрана одна дата - (дата, None)"""
+    period = tuple(period or ())
+    return (period + (None, None))[:2]
 
-def save_paid_visits(visits_df):
-    """Сохраняет оплаченные визиты в GitHub"""
-    with st.spinner("Сохраняем данные в GitHub..."):
-        # Загружаем существующие данные
-        existing_data, current_sha = get_file_from_github()
-        
-        # Добавляем новые данные
-        new_data = visits_df.to_dict('records')
-        all_data = existing_data + new_data
-        
-        # Сохраняем в GitHub
-        success = save_file_to_github(all_data, current_sha)
+def history_filters(visit_names):
+    """Период, центр и визит для показа и экспорта истории (по умолчанию - текущий месяц)
+
+    visit_names - названия визитов по алфавиту (HistoryStats.visit_name_list).
+    """
+    today = datetime.now().date()
+    filters = {'payment_from': None, 'payment_to': None}
+    if not st.checkbox("За всё время", value=False, key="history_all_time"):
+        payment_period = st.date_input(
+            "Период оплаты", value=(today.replace(day=1), today), format="YYYY-MM-DD", key="history_payment_period"
+        )
+        filters['payment_from'], filters['payment_to'] = period_bounds(payment_period)
+    visit_period = st.date_input(
+        "Период визитов", value=[], format="YYYY-MM-DD", help="Пусто - любые даты визитов", key="history_visit_period"
+    )
+    filters['visit_from'], filters['visit_to'] = period_bounds(visit_period)
+    subject_prefix = st.text_input(
+        "Центр (начало ID субъекта)", placeholder="13-", key="history_subject_prefix"
+    ).strip()
+    filters['subject_prefix'] = subject_prefix or None
+    visit_name = st.selectbox("Визит", ["Все визиты"] + visit_names, key="history_visit_name")
+    filters['visit_name'] = None if visit_name == "Все визиты" else visit_name
+    return filters
+
+def save_paid_visits(visits_to_pay):
+    """Сохраняет оплаченные визиты; с журналом (GitHub) они уходят в хранилище в фоне"""
+    with st.spinner("Сохраняем данные..."):
+        # С журналом - запись на диск; фоновый поток объединит её с соседними в один коммит
+        try:
+            core.save_paid_visits(history_store, visits_to_pay)
+            success = True
+        except Exception as e:
+            st.error(f"Ошибка сохранения данных: {e}")
+            success = False
         
         if success:
-            st.success("✅ Данные успешно сохранены в GitHub!")
-            # Обновляем локальный кэш
-            st.session_state['github_sha'] = None
+            if history_store.journal is not None:
+                st.success(f"✅ Данные сохранены, отправка в {history_store.backend_name} идёт в фоне")
+            else:
+                st.success(f"✅ Данные сохранены в {history_store.backend_name}")
         else:
-            st.error("❌ Ошибка сохранения в GitHub")
+            st.error(f"❌ Ошибка сохранения в {history_store.backend_name}")
         
         return success
 
+def flush_journal():
+    """Отправляет ожидающие записи журнала в GitHub, не дожидаясь фонового потока"""
+    with st.spinner("Отправляем данные в GitHub..."):
+        try:
+            history_store.flush()
+            st.success("✅ Данные отправлены в GitHub")
+        except Exception as e:
+            st.error(f"Ошибка отправки данных: {e}")
+
 def clear_all_data():
     """Очищает все данные в GitHub"""
     with st.spinner("Очищаем данные в GitHub..."):
-        existing_data, current_sha = get_file_from_github()
-        success = save_file_to_github([], current_sha)
+        try:
+            history_store.clear()
+            success = True
+        except Exception as e:
+            st.error(f"Ошибка сохранения данных: {e}")
+            success = False
         
         if success:
             st.success("✅ Все данные очищены!")
-            st.session_state['github_sha'] = None
         else:
             st.error("❌ Ошибка очистки данных")
         
@@ -118,73 +177,177 @@ def clear_all_data():
 # Обработка данных визитов
 def process_visits(uploaded_df):
     """Обрабатывает загруженные визиты и находит дубликаты"""
-    # Переименовываем столбцы для удобства
-    uploaded_df.columns = ['subject_id', 'visit_name', 'visit_date']
+    # Столбцы и даты уже приведены к единому виду при чтении файла (ingest.read_visits)
     
-    # Преобразуем даты
-    uploaded_df['visit_date'] = pd.to_datetime(uploaded_df['visit_date']).dt.strftime('%Y-%m-%d')
+    # Фоновая загрузка, начатая при открытии страницы, уже скачивает историю: ждём её, а не начинаем вторую
+    wait_for_history()
     
-    # Загружаем уже оплаченные визиты
-    paid_visits = load_paid_visits()
+    # Индекс по оплаченным визитам строится раз на версию хранилища
+    try:
+        visit_index = history_store.load_index(RUN_ID)
+    except Exception as e:
+        # Пустой индекс вместо недоступной истории пометил бы оплаченные визиты как новые
+        st.error(f"Ошибка загрузки истории оплат, проверка дубликатов невозможна: {e}")
+        raise HistoryUnavailable() from e
     
-    if not paid_visits.empty:
-        # Создаем ключи для сравнения
-        uploaded_df['full_key'] = uploaded_df['subject_id'].astype(str) + '_' + uploaded_df['visit_name'].astype(str) + '_' + uploaded_df['visit_date'].astype(str)
-        paid_visits['full_key'] = paid_visits['subject_id'].astype(str) + '_' + paid_visits['visit_name'].astype(str) + '_' + paid_visits['visit_date'].astype(str)
-        
-        uploaded_df['visit_type_key'] = uploaded_df['subject_id'].astype(str) + '_' + uploaded_df['visit_name'].astype(str)
-        paid_visits['visit_type_key'] = paid_visits['subject_id'].astype(str) + '_' + paid_visits['visit_name'].astype(str)
-        
-        uploaded_df['date_key'] = uploaded_df['subject_id'].astype(str) + '_' + uploaded_df['visit_date'].astype(str)
-        paid_visits['date_key'] = paid_visits['subject_id'].astype(str) + '_' + paid_visits['visit_date'].astype(str)
-        
-        # Находим различные типы совпадений
-        exact_duplicates_mask = uploaded_df['full_key'].isin(paid_visits['full_key'])
-        same_visit_type_mask = (uploaded_df['visit_type_key'].isin(paid_visits['visit_type_key'])) & (~exact_duplicates_mask)
-        same_date_mask = (uploaded_df['date_key'].isin(paid_visits['date_key'])) & (~exact_duplicates_mask) & (~same_visit_type_mask)
-        
-        # Разделяем данные на категории
-        new_visits = uploaded_df[~exact_duplicates_mask & ~same_visit_type_mask & ~same_date_mask].copy()
-        exact_duplicates = uploaded_df[exact_duplicates_mask].copy()
-        same_visit_different_date = uploaded_df[same_visit_type_mask].copy()
-        suspicious_same_date = uploaded_df[same_date_mask].copy()
-        
-        # Добавляем информацию о предыдущих записях
-        if not exact_duplicates.empty:
-            exact_duplicates = exact_duplicates.merge(
-                paid_visits[['full_key', 'payment_date']].rename(columns={'payment_date': 'previous_payment_date'}),
-                on='full_key', how='left'
-            )
+    # Классификация стоит O(размер загрузки): история уже разложена по хэш-индексам
+    new_visits, exact_duplicates, same_visit_different_date, suspicious_same_date, similar_names = \
+        core.process_visits(uploaded_df, visit_index)
+    
+    return new_visits, exact_duplicates, same_visit_different_date, suspicious_same_date, similar_names
+
+# Отображение дубликатов
+def show_exact_duplicate(row):
+    """Подробности точного дубликата"""
+    st.write(f"**ID пациента:** {row['subject_id']}")
+    st.write(f"**Название визита:** {row['visit_name']}")
+    st.write(f"**Дата визита:** {row['visit_date']}")
+    if 'previous_payment_date' in row and pd.notna(row['previous_payment_date']):
+        st.write(f"**Дата предыдущей оплаты:** {row['previous_payment_date']}")
+    if 'previous_count' in row and row['previous_count'] > 1:
+        st.write(f"**Всего предыдущих оплат:** {row['previous_count']}")
+    st.error("❌ **ТОЧНЫЙ ДУБЛИКАТ**: Не будет оплачен!")
+
+def show_same_visit_type(row):
+    """Подробности визита того же типа с другой датой"""
+    st.write(f"**ID пациента:** {row['subject_id']}")
+    st.write(f"**Название визита:** {row['visit_name']}")
+    st.write(f"**Текущая дата визита:** {row['visit_date']}")
+    if 'previous_visit_date' in row and pd.notna(row['previous_visit_date']):
+        st.write(f"**Ранее оплаченная дата:** {row['previous_visit_date']}")
+        st.write(f"**Дата предыдущей оплаты:** {row['previous_payment_date']}")
+        if row['previous_count'] > 1:
+            st.write(f"**Всего предыдущих оплат визита:** {row['previous_count']}")
+    st.warning("🔄 **Дата изменилась**: Проверьте, нужна ли доплата")
+
+def show_suspicious(row):
+    """Подробности подозрительного визита"""
+    st.write(f"**ID пациента:** {row['subject_id']}")
+    st.write(f"**Текущий визит:** {row['visit_name']}")
+    st.write(f"**Дата:** {row['visit_date']}")
+    if 'previous_visit_name' in row and pd.notna(row['previous_visit_name']):
+        st.write(f"**Ранее оплаченный визит в эту дату:** {row['previous_visit_name']}")
+        st.write(f"**Дата предыдущей оплаты:** {row['previous_payment_date']}")
+        if row['previous_count'] > 1:
+            st.write(f"**Всего визитов, оплаченных в эту дату:** {row['previous_count']}")
+    st.error("🚨 **ПОДОЗРИТЕЛЬНО**: Два разных визита в один день!")
+    st.info("💡 **Рекомендация**: Проверьте в ИРК, какой визит правильный")
+
+def show_similar_name(row):
+    """Подробности визита с похожим названием"""
+    st.write(f"**ID пациента:** {row['subject_id']}")
+    st.write(f"**Название в файле:** «{row['visit_name']}»")
+    st.write(f"**Дата визита:** {row['visit_date']}")
+    st.write(f"**Похожий оплаченный визит:** «{row['previous_visit_name']}» от {row['previous_visit_date']}")
+    st.write(f"**Дата предыдущей оплаты:** {row['previous_payment_date']}")
+    st.write(f"**Сходство названий:** {row['similarity']:.0%}")
+    st.warning("🔤 **ПОХОЖЕЕ НАЗВАНИЕ**: Возможно, это уже оплаченный визит, записанный иначе")
+
+def show_upload_repeat(row):
+    """Подробности повтора визита внутри загрузки"""
+    st.write(f"**ID пациента:** {row['subject_id']}")
+    st.write(f"**Название визита:** {row['visit_name']}")
+    st.write(f"**Дата визита:** {row['visit_date']}")
+    if 'source_file' in row:
+        st.write(f"**Файл повтора:** {row['source_file']}")
+        st.write(f"**Первое вхождение в файле:** {row['first_file']}")
+    st.info("📑 **ПОВТОР В ЗАГРУЗКЕ**: Визит проверяется и оплачивается один раз")
+
+@timed('render.duplicates_table')
+def paginated_rows(df, key, icon, show_details, page_sizes=(25, 50, 100)):
+    """Постраничная таблица с поиском по ID субъекта и деталями выбранной строки
+
+    Фильтрация и нарезка страницы выполняются на сервере, а подробности
+    рисуются только для выбранной строки, поэтому число виджетов не зависит
+    от количества найденных дубликатов.
+    """
+    col_search, col_size, col_page = st.columns([2, 1, 1])
+    
+    with col_search:
+        query = st.text_input("🔎 Поиск по ID субъекта", key=f"{key}_search").strip()
+    if query:
+        df = df[df['subject_id'].astype(str).str.contains(query, case=False, regex=False, na=False)]
+    
+    with col_size:
+        page_size = st.selectbox("Строк на странице", page_sizes, key=f"{key}_page_size")
+    
+    pages = max(1, -(-len(df) // page_size))
+    # После смены фильтра номер страницы может оказаться за пределами
+    if st.session_state.get(f"{key}_page", 1) > pages:
+        st.session_state[f"{key}_page"] = pages
+    with col_page:
+        page = st.number_input(f"Страница (из {pages})", min_value=1, max_value=pages, key=f"{key}_page")
+    
+    start = (page - 1) * page_size
+    page_df = as_strings(df.iloc[start:start + page_size])
+    if page_df.empty:
+        st.info("Нет строк, подходящих под фильтр")
+        return
+    
+    st.caption(f"Строки {start + 1}–{start + len(page_df)} из {len(df)}")
+    event = st.dataframe(
+        page_df,
+        use_container_width=True,
+        hide_index=True,
+        on_select="rerun",
+        selection_mode="single-row",
+        key=f"{key}_table"
+    )
+    
+    if event.selection.rows:
+        row = page_df.iloc[event.selection.rows[0]]
+        with st.container(border=True):
+            st.markdown(f"**{icon} {row['subject_id']} - {row['visit_name']} - {row['visit_date']}**")
+            show_details(row)
+    else:
+        st.caption("Выберите строку в таблице, чтобы увидеть подробности")
+
+# Диагностика производительности
+def request_profile():
+    """Помечает следующий перезапуск для записи профиля cProfile"""
+    st.session_state['profile_next_run'] = True
+
+def show_diagnostics(metrics):
+    """Панель диагностики в боковой панели: замеры текущего перезапуска"""
+    with st.sidebar:
+        st.markdown("---")
+        if not st.checkbox("🩺 Диагностика производительности", key="diagnostics_enabled"):
+            return
         
-        if not same_visit_different_date.empty:
-            same_visit_different_date = same_visit_different_date.merge(
-                paid_visits[['visit_type_key', 'visit_date', 'payment_date']].rename(columns={
-                    'visit_date': 'previous_visit_date', 'payment_date': 'previous_payment_date'
-                }),
-                on='visit_type_key', how='left'
-            )
+        summary = metrics.summary()
+        col_api, col_limit = st.columns(2)
+        with col_api:
+            st.metric("Запросов к GitHub", summary['api_calls'])
+        with col_limit:
+            remaining = summary['rate_limit_remaining']
+            st.metric("Остаток лимита API", remaining if remaining is not None else "—")
+        st.caption(
+            f"Перезапуск: {summary['seconds']:.2f} с · получено {summary['bytes_received'] / 1024:.1f} КБ · "
+            f"отправлено {summary['bytes_sent'] / 1024:.1f} КБ"
+        )
         
-        if not suspicious_same_date.empty:
-            suspicious_same_date = suspicious_same_date.merge(
-                paid_visits[['date_key', 'visit_name', 'payment_date']].rename(columns={
-                    'visit_name': 'previous_visit_name', 'payment_date': 'previous_payment_date'
-                }),
-                on='date_key', how='left'
-            )
+        timings = metrics.timing_table()
+        if timings:
+            st.dataframe(pd.DataFrame(timings), hide_index=True, use_container_width=True)
         
-        # Убираем служебные столбцы
-        columns_to_drop = ['full_key', 'visit_type_key', 'date_key']
-        for df in [new_visits, exact_duplicates, same_visit_different_date, suspicious_same_date]:
-            if not df.empty:
-                df.drop(columns_to_drop, axis=1, inplace=True)
+        memory, cached_segments = history_store.memory_report()
+        if memory:
+            st.caption("Память истории, байт (object_bytes - оценка для тех же данных строками)")
+            st.dataframe(pd.DataFrame(memory), hide_index=True, use_container_width=True)
+            st.caption(f"Кэш сегментов: {cached_segments / 2 ** 20:.1f} МиБ")
         
-    else:
-        new_visits = uploaded_df.copy()
-        exact_duplicates = pd.DataFrame(columns=['subject_id', 'visit_name', 'visit_date'])
-        same_visit_different_date = pd.DataFrame(columns=['subject_id', 'visit_name', 'visit_date'])
-        suspicious_same_date = pd.DataFrame(columns=['subject_id', 'visit_name', 'visit_date'])
-    
-    return new_visits, exact_duplicates, same_visit_different_date, suspicious_same_date, paid_visits
+        st.button("🧪 Профилировать следующий перезапуск", on_click=request_profile, key="profile_next_run_btn")
+        last_profile = st.session_state.get('last_profile')
+        if last_profile:
+            with st.expander("Профиль cProfile последнего замера"):
+                st.code(last_profile['text'])
+                st.download_button(
+                    label="📥 Скачать .prof",
+                    data=last_profile['raw'],
+                    file_name="rerun.prof",
+                    mime="application/octet-stream",
+                    key="download_profile_btn"
+                )
 
 # Основное приложение
 def main():
@@ -245,17 +408,33 @@ def main():
     
     st.markdown("---")
     
+    # История загружается в фоне: страница рисуется сразу, сводка и статус появляются по готовности
+    prefetch = history_prefetch()
+    
     # Проверяем подключение к GitHub
     with st.sidebar:
         st.header("🔧 Статус системы")
         
-        # Проверяем подключение
-        try:
-            data, sha = get_file_from_github()
-            st.success("✅ GitHub подключен")
-            st.info(f"📊 Записей в базе: {len(data)}")
-        except:
-            st.error("❌ Ошибка подключения к GitHub")
+        # Проверяем подключение (пока идёт фоновая загрузка - без лишнего запроса)
+        if not prefetch.done():
+            st.info(f"⏳ Подключаемся к {history_store.backend_name}...")
+        else:
+            try:
+                records_count = history_store.count(RUN_ID)
+                st.success(f"✅ {history_store.backend_name} подключен")
+                st.info(f"📊 Записей в базе: {records_count}")
+            except:
+                st.error(f"❌ Ошибка подключения к {history_store.backend_name}")
+        
+        # Оплаты, записанные в журнал, но ещё не отправленные в GitHub
+        journal = history_store.journal_status()
+        if journal['pending_entries']:
+            st.warning(f"⏳ Ожидают отправки в GitHub: {journal['pending_rows']} визитов")
+            if journal['error']:
+                st.caption(f"Последняя ошибка отправки: {journal['error']}")
+            if st.button("📤 Отправить сейчас", key="flush_journal_btn"):
+                flush_journal()
+                st.rerun()
         
         st.markdown("---")
         
@@ -264,12 +443,13 @@ def main():
         **Формат Excel-файла:**
         - Столбец A: ID субъекта
         - Столбец B: Название визита  
-        - Столбец C: Дата визита
+        - Столбец C: Дата визита (дата Excel, ДД.ММ.ГГГГ или ГГГГ-ММ-ДД)
         
         **🔍 Проверка дубликатов:**
         - **Точные дубликаты**: ID + визит + дата
         - **Тот же тип визита**: ID + визит (другая дата)
         - **Подозрительные**: ID + дата (другой визит)
+        - **Похожие названия**: ID + похожее название визита (пробелы, регистр, латиница)
         """)
     
     # Основная область
@@ -277,34 +457,86 @@ def main():
     
     with col1:
         st.header("📁 Загрузка данных")
-        uploaded_file = st.file_uploader(
-            "Выберите Excel-файл с данными визитов",
+        uploaded_files = st.file_uploader(
+            "Выберите Excel-файлы с данными визитов (можно несколько, например по файлу на центр)",
             type=['xlsx', 'xls'],
+            accept_multiple_files=True,
             help="Файл должен содержать: ID субъекта, Название визита, Дата визита"
         )
         
-        if uploaded_file is not None:
+        if uploaded_files:
             try:
-                # Загружаем данные
-                df = pd.read_excel(uploaded_file)
+                # Загружаем данные: разобранные файлы кэшируются по SHA-256 содержимого,
+                # поэтому перезапуски при переключении флажков не читают книги заново
+                progress_placeholder = st.empty()
+                
+                if len(uploaded_files) == 1:
+                    def show_progress(done, total):
+                        fraction = min(done / total, 1.0) if total else 0.0
+                        progress_placeholder.progress(fraction, text=f"Читаем файл: {done} строк")
+                    
+                    uploaded_file = uploaded_files[0]
+                    parsed = [(uploaded_file.name, read_visits(uploaded_file.getvalue(), uploaded_file.name, progress=show_progress))]
+                else:
+                    def show_progress(done, total, file_name):
+                        progress_placeholder.progress(done / total, text=f"Читаем файлы: {done} из {total}")
+                    
+                    # Несколько файлов разбираются параллельно в пуле процессов
+                    parsed = read_visit_files(
+                        [(uploaded_file.getvalue(), uploaded_file.name) for uploaded_file in uploaded_files],
+                        progress=show_progress
+                    )
+                progress_placeholder.empty()
                 
-                st.success(f"✅ Файл загружен успешно! Найдено {len(df)} записей")
+                for file_name, result in parsed:
+                    if isinstance(result, Exception):
+                        st.error(f"❌ Не удалось прочитать {file_name}: {result}. Файл не включён в проверку")
+                parsed = [(file_name, result) for file_name, result in parsed if not isinstance(result, Exception)]
+                if not parsed:
+                    raise ValueError("ни один файл не удалось прочитать")
+                
+                # Строки с пустой или нераспознанной датой визита не проверяются и не оплачиваются
+                df, date_errors = core.split_date_errors(core.combine_uploads(parsed))
+                # Все файлы проверяются как одна загрузка: визит, пришедший дважды, оплачивается один раз
+                df, upload_repeats = core.split_repeats(df)
+                uploaded_rows = len(df) + len(upload_repeats) + len(date_errors)
+                
+                if len(parsed) == 1:
+                    st.success(f"✅ Файл загружен успешно! Найдено {uploaded_rows} записей")
+                else:
+                    st.success(f"✅ Загружено файлов: {len(parsed)}, записей: {uploaded_rows}")
+                    st.dataframe(
+                        pd.DataFrame({
+                            'Файл': [file_name for file_name, _ in parsed],
+                            'Записей': [len(result) for _, result in parsed],
+                        }),
+                        hide_index=True,
+                        use_container_width=True
+                    )
+                
+                if not date_errors.empty:
+                    st.warning(f"📅 {len(date_errors)} строк с пустой или нераспознанной датой визита: "
+                               "они не проверяются и не будут оплачены")
+                    with st.expander("Строки с нераспознанной датой"):
+                        st.dataframe(date_errors, hide_index=True, use_container_width=True)
                 
                 # Показываем превью данных
                 st.subheader("👀 Превью загруженных данных")
-                st.dataframe(df.head(10), use_container_width=True)
+                st.dataframe(as_strings(df.head(10)), use_container_width=True)
                 
                 # Обрабатываем данные
-                new_visits, exact_duplicates, same_visit_different_date, suspicious_same_date, paid_visits = process_visits(df.copy())
+                new_visits, exact_duplicates, same_visit_different_date, suspicious_same_date, similar_names = process_visits(df)
                 
                 st.markdown("---")
                 
                 # Результаты обработки
-                tab1, tab2, tab3, tab4, tab5 = st.tabs([
+                tab1, tab2, tab3, tab4, tab_similar, tab_repeats, tab5 = st.tabs([
                     f"🆕 Новые визиты ({len(new_visits)})", 
                     f"⚠️ Точные дубликаты ({len(exact_duplicates)})",
                     f"🔄 Тот же тип визита ({len(same_visit_different_date)})",
                     f"🚨 Подозрительные ({len(suspicious_same_date)})",
+                    f"🔤 Похожие названия ({len(similar_names)})",
+                    f"📑 Повторы в загрузке ({len(upload_repeats)})",
                     f"📊 Сводка"
                 ])
                 
@@ -312,7 +544,7 @@ def main():
                     st.subheader("🆕 Новые визиты к оплате")
                     if not new_visits.empty:
                         st.success(f"Найдено {len(new_visits)} новых визитов")
-                        st.dataframe(new_visits, use_container_width=True)
+                        st.dataframe(as_strings(new_visits), use_container_width=True)
                         
                         # Группировка по субъектам
                         summary = new_visits.groupby('subject_id').size().reset_index(name='количество_визитов')
@@ -328,14 +560,7 @@ def main():
                         st.error(f"🚫 Найдено {len(exact_duplicates)} точных дубликатов!")
                         st.warning("**Эти визиты уже были оплачены с точно такими же данными**")
                         
-                        for _, row in exact_duplicates.iterrows():
-                            with st.expander(f"🚫 {row['subject_id']} - {row['visit_name']} - {row['visit_date']}"):
-                                st.write(f"**ID пациента:** {row['subject_id']}")
-                                st.write(f"**Название визита:** {row['visit_name']}")
-                                st.write(f"**Дата визита:** {row['visit_date']}")
-                                if 'previous_payment_date' in row and pd.notna(row['previous_payment_date']):
-                                    st.write(f"**Дата предыдущей оплаты:** {row['previous_payment_date']}")
-                                st.error("❌ **ТОЧНЫЙ ДУБЛИКАТ**: Не будет оплачен!")
+                        paginated_rows(exact_duplicates, "exact", "🚫", show_exact_duplicate)
                         
                     else:
                         st.success("✅ Точных дубликатов не найдено")
@@ -346,15 +571,7 @@ def main():
                         st.warning(f"⚠️ Найдено {len(same_visit_different_date)} визитов того же типа с другими датами")
                         st.info("**Визиты того же типа, но с другими датами. Возможно, дата была исправлена.**")
                         
-                        for _, row in same_visit_different_date.iterrows():
-                            with st.expander(f"⚠️ {row['subject_id']} - {row['visit_name']} - {row['visit_date']}"):
-                                st.write(f"**ID пациента:** {row['subject_id']}")
-                                st.write(f"**Название визита:** {row['visit_name']}")
-                                st.write(f"**Текущая дата визита:** {row['visit_date']}")
-                                if 'previous_visit_date' in row and pd.notna(row['previous_visit_date']):
-                                    st.write(f"**Ранее оплаченная дата:** {row['previous_visit_date']}")
-                                    st.write(f"**Дата предыдущей оплаты:** {row['previous_payment_date']}")
-                                st.warning("🔄 **Дата изменилась**: Проверьте, нужна ли доплата")
+                        paginated_rows(same_visit_different_date, "same_type", "⚠️", show_same_visit_type)
                         
                         # Опция добавить в оплату
                         st.markdown("---")
@@ -372,16 +589,7 @@ def main():
                         st.error(f"🚨 Найдено {len(suspicious_same_date)} подозрительных визитов!")
                         st.warning("**У одного пациента в один день записаны разные визиты. Возможно, ошибка в данных.**")
                         
-                        for _, row in suspicious_same_date.iterrows():
-                            with st.expander(f"🚨 {row['subject_id']} - {row['visit_name']} - {row['visit_date']}"):
-                                st.write(f"**ID пациента:** {row['subject_id']}")
-                                st.write(f"**Текущий визит:** {row['visit_name']}")
-                                st.write(f"**Дата:** {row['visit_date']}")
-                                if 'previous_visit_name' in row and pd.notna(row['previous_visit_name']):
-                                    st.write(f"**Ранее оплаченный визит в эту дату:** {row['previous_visit_name']}")
-                                    st.write(f"**Дата предыдущей оплаты:** {row['previous_payment_date']}")
-                                st.error("🚨 **ПОДОЗРИТЕЛЬНО**: Два разных визита в один день!")
-                                st.info("💡 **Рекомендация**: Проверьте в ИРК, какой визит правильный")
+                        paginated_rows(suspicious_same_date, "suspicious", "🚨", show_suspicious)
                         
                         # Опция добавить в оплату
                         st.markdown("---")
@@ -393,13 +601,42 @@ def main():
                         st.success("✅ Подозрительных визитов не найдено")
                         add_suspicious = False
                 
+                with tab_similar:
+                    st.subheader("🔤 Похожие названия визитов")
+                    if not similar_names.empty:
+                        st.warning(f"⚠️ Найдено {len(similar_names)} визитов с названием, похожим на уже оплаченный визит")
+                        st.info("**Названия отличаются пробелами, регистром, похожими латинскими буквами или сокращением. Номер визита совпадает.**")
+                        
+                        paginated_rows(similar_names, "similar", "🔤", show_similar_name)
+                        
+                        # Опция добавить в оплату
+                        st.markdown("---")
+                        add_similar = st.checkbox("✅ Это другие визиты, добавить к оплате",
+                                                  help="Отметьте, если похожие названия действительно обозначают разные визиты",
+                                                  key="add_similar_checkbox")
+                        
+                    else:
+                        st.success("✅ Визитов с похожими названиями не найдено")
+                        add_similar = False
+                
+                with tab_repeats:
+                    st.subheader("📑 Повторы визитов внутри загрузки")
+                    if not upload_repeats.empty:
+                        st.info(f"ℹ️ {len(upload_repeats)} визитов встречаются в загрузке повторно (в том же или другом файле). "
+                                "Проверяется и оплачивается только первое вхождение.")
+                        
+                        paginated_rows(upload_repeats, "repeats", "📑", show_upload_repeat)
+                        
+                    else:
+                        st.success("✅ Повторов внутри загрузки нет")
+                
                 with tab5:
                     st.subheader("📊 Общая сводка")
                     
-                    col_stat1, col_stat2, col_stat3, col_stat4, col_stat5 = st.columns(5)
+                    col_stat1, col_stat2, col_stat3, col_stat4, col_stat5, col_stat6, col_stat7 = st.columns(7)
                     
                     with col_stat1:
-                        st.metric("Всего в файле", len(df))
+                        st.metric("Всего в загрузке", uploaded_rows)
                     
                     with col_stat2:
                         st.metric("Новые к оплате", len(new_visits))
@@ -413,6 +650,12 @@ def main():
                     with col_stat5:
                         st.metric("Подозрительные", len(suspicious_same_date))
                     
+                    with col_stat6:
+                        st.metric("Похожие названия", len(similar_names))
+                    
+                    with col_stat7:
+                        st.metric("Повторы в загрузке", len(upload_repeats))
+                    
                     # Детальная статистика
                     st.markdown("---")
                     st.subheader("📈 Рекомендации")
@@ -426,17 +669,21 @@ def main():
                     if len(suspicious_same_date) > 0:
                         st.error(f"🚨 **{len(suspicious_same_date)} подозрительных визитов** - проверьте в ИРК!")
                     
+                    if len(similar_names) > 0:
+                        st.warning(f"🔤 **{len(similar_names)} визитов** с похожими названиями - сверьте с оплаченными")
+                    
+                    if len(date_errors) > 0:
+                        st.warning(f"📅 **{len(date_errors)} строк** без распознанной даты визита - исправьте даты в файле")
+                    
                     if len(new_visits) > 0:
                         st.success(f"✅ **{len(new_visits)} новых визитов** готовы к оплате")
                 
                 # Формируем итоговый список для оплаты
-                visits_to_pay = new_visits.copy()
-                
-                if 'add_same_type' in locals() and add_same_type and not same_visit_different_date.empty:
-                    visits_to_pay = pd.concat([visits_to_pay, same_visit_different_date[['subject_id', 'visit_name', 'visit_date']]], ignore_index=True)
-                
-                if 'add_suspicious' in locals() and add_suspicious and not suspicious_same_date.empty:
-                    visits_to_pay = pd.concat([visits_to_pay, suspicious_same_date[['subject_id', 'visit_name', 'visit_date']]], ignore_index=True)
+                visits_to_pay = core.select_visits_to_pay(
+                    new_visits, same_visit_different_date, suspicious_same_date,
+                    add_same_type=add_same_type, add_suspicious=add_suspicious,
+                    similar_names=similar_names, add_similar=add_similar
+                )
                 
                 # Кнопки действий
                 if not visits_to_pay.empty:
@@ -446,27 +693,14 @@ def main():
                     col_btn1, col_btn2, col_btn3 = st.columns(3)
                     
                     with col_btn1:
-                        # Скачать отчет
-                        excel_buffer = io.BytesIO()
-                        with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-                            visits_to_pay.to_excel(writer, sheet_name='К оплате', index=False)
-                            
-                            if not visits_to_pay.empty:
-                                summary = visits_to_pay.groupby('subject_id').size().reset_index(name='количество_визитов')
-                                summary.to_excel(writer, sheet_name='Сводка', index=False)
-                            
-                            if not exact_duplicates.empty:
-                                exact_duplicates.to_excel(writer, sheet_name='Точные дубликаты', index=False)
-                            
-                            if not same_visit_different_date.empty:
-                                same_visit_different_date.to_excel(writer, sheet_name='Тот же тип визита', index=False)
-                            
-                            if not suspicious_same_date.empty:
-                                suspicious_same_date.to_excel(writer, sheet_name='Подозрительные', index=False)
-                        
+                        # Скачать отчет: книга собирается только по нажатию кнопки
+                        # и кэшируется по отпечатку входных таблиц
                         st.download_button(
                             label="📥 Скачать полный отчет",
-                            data=excel_buffer.getvalue(),
+                            data=lambda: payment_report(
+                                visits_to_pay, exact_duplicates, same_visit_different_date, suspicious_same_date,
+                                similar_names, upload_repeats, date_errors
+                            ),
                             file_name=f"polnyj_otchet_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
                             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                             key="download_report_btn"
@@ -474,13 +708,8 @@ def main():
                     
                     with col_btn2:
                         if st.button("✅ Отметить как оплаченные", type="primary", key="mark_paid_btn"):
-                            # Добавляем информацию об оплате
-                            visits_to_save = visits_to_pay.copy()
-                            visits_to_save['payment_date'] = datetime.now().strftime('%Y-%m-%d')
-                            visits_to_save['payment_amount'] = 0.0
-                            
-                            # Сохраняем в GitHub
-                            success = save_paid_visits(visits_to_save[['subject_id', 'visit_name', 'visit_date', 'payment_date', 'payment_amount']])
+                            # Сохраняем одной записью для всех файлов (дата оплаты - сегодня)
+                            success = save_paid_visits(visits_to_pay)
                             
                             if success:
                                 st.success(f"✅ {len(visits_to_pay)} визитов отмечены как оплаченные!")
@@ -490,6 +719,8 @@ def main():
                         if st.button("🔄 Обновить данные", key="refresh_data_btn"):
                             st.rerun()
                 
+            except HistoryUnavailable:
+                st.info("Повторите проверку, когда история оплат снова станет доступна")
             except Exception as e:
                 st.error(f"❌ Ошибка при обработке файла: {str(e)}")
                 st.info("Убедитесь, что файл содержит данные в правильном формате")
@@ -497,19 +728,28 @@ def main():
     with col2:
         st.header("📈 История оплат")
         
-        # Загружаем и показываем историю
-        paid_visits = load_paid_visits()
+        # Сводка ведётся по сегментам, поэтому показ не зависит от размера истории;
+        # пока она собирается в фоне, на её месте заглушка
+        history_stats = None
+        if prefetch.done():
+            history_stats = load_history_stats()
+        else:
+            history_placeholder()
+        # Недоступную историю не выдаём за пустую
+        history_loaded = history_stats is not None
+        if not history_loaded:
+            history_stats = HistoryStats()
         
-        if not paid_visits.empty:
+        if history_stats.rows:
             # Статистика
             st.subheader("📊 Статистика")
-            st.metric("Всего оплаченных визитов", len(paid_visits))
-            st.metric("Уникальных субъектов", paid_visits['subject_id'].nunique())
-            st.metric("Уникальных типов визитов", paid_visits['visit_name'].nunique())
+            st.metric("Всего оплаченных визитов", history_stats.rows)
+            st.metric("Уникальных субъектов", history_stats.subject_count)
+            st.metric("Уникальных типов визитов", history_stats.visit_count)
             
             # Последние оплаты
             st.subheader("🕒 Последние оплаты")
-            recent_payments = paid_visits.sort_values('payment_date', ascending=False).head(5)
+            recent_payments = as_strings(history_stats.recent_payments())
             for _, payment in recent_payments.iterrows():
                 with st.container():
                     st.text(f"📅 {payment['payment_date']}")
@@ -517,28 +757,50 @@ def main():
                     st.text(f"🏥 {payment['visit_name']}")
                     st.text(f"📆 {payment['visit_date']}")
                     st.markdown("---")
-        else:
+        elif history_loaded:
             st.info("История оплат пустая")
         
         # Управление данными
         st.subheader("🛠️ Управление")
         
-        if st.button("📊 Показать всю историю", key="show_history_btn"):
+        # Выборка за период: показ и экспорт читают только нужный срез по индексу дат
+        history_query = history_filters(history_stats.visit_name_list())
+        
+        if st.button("📊 Показать историю", key="show_history_btn"):
+            paid_visits = query_paid_visits(history_query)
             if not paid_visits.empty:
-                st.dataframe(paid_visits[['subject_id', 'visit_name', 'visit_date', 'payment_date']], use_container_width=True)
+                st.caption(f"Записей в выборке: {len(paid_visits)}")
+                st.dataframe(
+                    paid_visits[['subject_id', 'visit_name', 'visit_date', 'payment_date']],
+                    use_container_width=True,
+                    column_config={
+                        'visit_date': st.column_config.DateColumn(format="YYYY-MM-DD"),
+                        'payment_date': st.column_config.DateColumn(format="YYYY-MM-DD"),
+                    }
+                )
             else:
-                st.info("История пустая")
+                st.info("За выбранный период записей нет")
         
-        # Экспорт истории
-        if not paid_visits.empty:
-            excel_buffer = io.BytesIO()
-            paid_visits.to_excel(excel_buffer, index=False, engine='openpyxl')
+        # Экспорт выборки: файл собирается только по нажатию кнопки и кэшируется по версии и условиям
+        if history_stats.rows:
+            formats = list(EXPORT_FORMATS)
+            # Выборка не помещается на лист Excel - только CSV и JSONL; строки выборки
+            # считаются, только если вся история больше листа
+            if history_stats.rows > EXCEL_MAX_ROWS and export_rows(history_query, history_stats.rows) > EXCEL_MAX_ROWS:
+                formats.remove('xlsx')
+            export_format = st.selectbox(
+                "Формат экспорта",
+                formats,
+                format_func=lambda fmt: EXPORT_FORMATS[fmt][0],
+                help="Для очень большой истории быстрее CSV или JSONL",
+                key="export_format_select"
+            )
             
             st.download_button(
-                label="📥 Экспорт истории в Excel",
-                data=excel_buffer.getvalue(),
-                file_name=f"istoriya_oplat_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                label=f"📥 Экспорт истории в {EXPORT_FORMATS[export_format][0]}",
+                data=lambda: export_history(export_format, history_query),
+                file_name=f"istoriya_oplat_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{export_format}",
+                mime=EXPORT_FORMATS[export_format][1],
                 key="export_history_btn"
             )
         
@@ -568,4 +830,17 @@ def main():
                     st.rerun()
 
 if __name__ == "__main__":
-    main()
+    metrics = instrumentation.start_run(RUN_ID)
+    try:
+        with timed('render.main'):
+            if st.session_state.pop('profile_next_run', False):
+                profile_report = {}
+                try:
+                    instrumentation.profile(main, profile_report)
+                finally:
+                    st.session_state['last_profile'] = profile_report
+            else:
+                main()
+        show_diagnostics(metrics)
+    finally:
+        instrumentation.finish_run(metrics)
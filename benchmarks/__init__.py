@@ -0,0 +1 @@
+"""Бенчмарки на синтетических историях оплат и загрузках визитов"""
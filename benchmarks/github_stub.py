@@ -0,0 +1,274 @@
+"""Локальный стенд GitHub Contents API для нагрузочных проверок и проверок конкуренции
+
+Реализует то, чем пользуется GitHubClient:
+    GET /repos/{owner}/{repo}/contents/{path} - JSON с base64 и sha, ETag и
+        If-None-Match (304); с Accept: application/vnd.github.raw+json - сырое
+        содержимое с тем же ETag
+    PUT /repos/{owner}/{repo}/contents/{path} - запись с проверкой sha: 409 при
+        устаревшем sha, 422 без sha для существующего файла
+Настраиваются задержка ответа, доля отказов (5xx до обработки), доля
+"потерянных ответов" (запись выполнена, а клиент получил 502), лимит
+запросов с заголовками X-RateLimit-* и 403 при исчерпании и Retry-After в
+отказах. stats['connections'] считает TCP-соединения (проверка пула).
+
+Примеры (из корня репозитория):
+    python -m benchmarks.github_stub --port 8765 --latency 0.05 --error-rate 0.02 --rate-limit 500 --rate-window 60
+    GITHUB_API_URL=http://127.0.0.1:8765 streamlit run app.py
+"""
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from github_client import blob_sha
+
+CONTENTS_PREFIX = '/repos/'
+RAW_MEDIA_TYPES = ('application/vnd.github.raw', 'application/vnd.github.raw+json', 'application/vnd.github.v3.raw')
+ERROR_STATUSES = (500, 502, 503)
+
+
+class GitHubStub:
+    """Файлы репозиториев в памяти и HTTP-сервер с их Contents API"""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, lost_response_rate=0.0,
+                 rate_limit=None, rate_window=3600.0, seed=None, retry_after=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.lost_response_rate = lost_response_rate
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.files = {}
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._rate_reset = 0.0
+        self._rate_used = 0
+        self._server = None
+
+    def start(self, host='127.0.0.1', port=0):
+        """Запускает сервер в фоновом потоке и возвращает адрес API (для GITHUB_API_URL)"""
+        handler = type('Handler', (_ContentsHandler,), {'stub': self})
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='github-stub', daemon=True).start()
+        return f"http://{host}:{self._server.server_port}"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def put(self, owner, repo, path, raw):
+        """Кладёт файл напрямую, без HTTP (начальные данные)"""
+        with self._lock:
+            self.files[(owner, repo, path)] = (raw, blob_sha(raw))
+
+    def get(self, owner, repo, path):
+        with self._lock:
+            return self.files.get((owner, repo, path))
+
+    def count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    # Поведение, общее для всех запросов
+
+    def delay(self):
+        seconds = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if seconds:
+            time.sleep(seconds)
+
+    def inject(self, rate):
+        with self._lock:
+            return rate > 0 and self.random.random() < rate
+
+    def take_rate_limit(self):
+        """Учитывает запрос в окне лимита; возвращает (заголовки, исчерпан ли лимит)"""
+        if self.rate_limit is None:
+            return {}, False
+        with self._lock:
+            now = time.time()
+            if now >= self._rate_reset:
+                self._rate_reset = now + self.rate_window
+                self._rate_used = 0
+            self._rate_used += 1
+            exceeded = self._rate_used > self.rate_limit
+            headers = {
+                'X-RateLimit-Limit': str(self.rate_limit),
+                'X-RateLimit-Remaining': str(max(0, self.rate_limit - self._rate_used)),
+                'X-RateLimit-Reset': str(int(self._rate_reset) + 1),
+                'X-RateLimit-Used': str(min(self._rate_used, self.rate_limit)),
+                'X-RateLimit-Resource': 'core',
+            }
+            return headers, exceeded
+
+
+class _ContentsHandler(BaseHTTPRequestHandler):
+    stub = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.stub.count('connections')
+
+    def do_GET(self):
+        self._handle(self._get)
+
+    def do_PUT(self):
+        self._handle(self._put)
+
+    def _handle(self, action):
+        stub = self.stub
+        target = self._target()
+        # Тело читаем всегда, иначе соединение keep-alive рассинхронизируется
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+
+        stub.delay()
+        headers, exceeded = stub.take_rate_limit()
+        if stub.retry_after is not None:
+            headers['Retry-After'] = str(stub.retry_after)
+        if exceeded:
+            stub.count('rate_limited')
+            self._reply(403, {'message': 'API rate limit exceeded'}, headers)
+            return
+        if target is None:
+            self._reply(404, {'message': 'Not Found'}, headers)
+            return
+        if stub.inject(stub.error_rate):
+            stub.count('injected_errors')
+            self._reply(stub.random.choice(ERROR_STATUSES), {'message': 'Server Error'}, headers)
+            return
+        action(target, body, headers)
+
+    def _target(self):
+        """(owner, repo, path) из /repos/{owner}/{repo}/contents/{path}"""
+        path = self.path.split('?', 1)[0]
+        if not path.startswith(CONTENTS_PREFIX):
+            return None
+        parts = path[len(CONTENTS_PREFIX):].split('/', 3)
+        if len(parts) != 4 or parts[2] != 'contents' or not parts[3]:
+            return None
+        return parts[0], parts[1], parts[3]
+
+    def _get(self, target, body, headers):
+        stored = self.stub.get(*target)
+        if stored is None:
+            self._reply(404, {'message': 'Not Found'}, headers)
+            return
+        raw, sha = stored
+        etag = f'W/"{sha}"'
+        if self.headers.get('If-None-Match') == etag:
+            self._reply_bytes(304, b'', None, dict(headers, ETag=etag))
+            return
+        if self.headers.get('Accept') in RAW_MEDIA_TYPES:
+            self._reply_bytes(200, raw, 'application/octet-stream', dict(headers, ETag=etag))
+            return
+        self._reply(200, {
+            'type': 'file',
+            'encoding': 'base64',
+            'path': target[2],
+            'name': target[2].rsplit('/', 1)[-1],
+            'size': len(raw),
+            'sha': sha,
+            'content': base64.b64encode(raw).decode('ascii'),
+        }, dict(headers, ETag=etag))
+
+    def _put(self, target, body, headers):
+        stub = self.stub
+        try:
+            payload = json.loads(body)
+            raw = base64.b64decode(payload['content'])
+        except (ValueError, KeyError, TypeError):
+            self._reply(422, {'message': 'Invalid request.\n\n"content" wasn\'t supplied.'}, headers)
+            return
+        if not payload.get('message'):
+            self._reply(422, {'message': 'Invalid request.\n\n"message" wasn\'t supplied.'}, headers)
+            return
+
+        with stub._lock:
+            current = stub.files.get(target)
+            if current is not None and not payload.get('sha'):
+                status = 422
+            elif current is not None and payload['sha'] != current[1]:
+                status = 409
+            else:
+                status = 200 if current is not None else 201
+                sha = blob_sha(raw)
+                stub.files[target] = (raw, sha)
+
+        if status == 422:
+            self._reply(422, {'message': 'Invalid request.\n\n"sha" wasn\'t supplied.'}, headers)
+            return
+        if status == 409:
+            self._reply(409, {'message': f"{target[2]} does not match {payload['sha']}"}, headers)
+            return
+        if stub.inject(stub.lost_response_rate):
+            # Запись выполнена, но клиент об этом не узнает
+            stub.count('lost_responses')
+            self._reply(502, {'message': 'Bad Gateway'}, headers)
+            return
+        self._reply(status, {
+            'content': {'path': target[2], 'name': target[2].rsplit('/', 1)[-1], 'sha': sha, 'size': len(raw)},
+            'commit': {'sha': uuid.uuid4().hex + uuid.uuid4().hex[:8], 'message': payload['message']},
+        }, headers)
+
+    def _reply(self, status, data, headers):
+        self._reply_bytes(status, json.dumps(data).encode('utf-8'), 'application/json; charset=utf-8', headers)
+
+    def _reply_bytes(self, status, raw, content_type, headers):
+        self.stub.count(f'{self.command}_{status}')
+        self.send_response(status)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Локальный стенд GitHub Contents API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help="задержка каждого ответа, с")
+    parser.add_argument('--jitter', type=float, default=0.0, help="случайная добавка к задержке (0 ... jitter), с")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="доля запросов с ответом 5xx")
+    parser.add_argument('--lost-response-rate', type=float, default=0.0,
+                        help="доля записей, которые выполнены, но отвечают 502")
+    parser.add_argument('--rate-limit', type=int, help="запросов на окно (по умолчанию без лимита)")
+    parser.add_argument('--rate-window', type=float, default=3600.0, help="длина окна лимита, с")
+    parser.add_argument('--retry-after', type=int, help="заголовок Retry-After в ответах, с")
+    parser.add_argument('--legacy', help="файл, который отдавать как data/payments.json")
+    parser.add_argument('--owner', default='owner')
+    parser.add_argument('--repo', default='repo')
+    args = parser.parse_args(argv)
+
+    stub = GitHubStub(args.latency, args.jitter, args.error_rate, args.lost_response_rate,
+                      args.rate_limit, args.rate_window, retry_after=args.retry_after)
+    if args.legacy:
+        stub.put(args.owner, args.repo, 'data/payments.json', Path(args.legacy).read_bytes())
+    api_url = stub.start(args.host, args.port)
+    print(f"GITHUB_API_URL={api_url} (Ctrl+C - остановить)", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stub.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+"""Нагрузочный прогон: параллельные сессии "загрузка -> проверка -> оплата" против стенда GitHub
+
+Каждая сессия в цикле проверяет загрузку (часть визитов уже оплачена,
+часть - новые, уникальные для сессии) и отмечает новые визиты оплаченными.
+По умолчанию у каждой сессии своё хранилище, как у отдельных процессов
+приложения, поэтому они соревнуются за манифест. В конце история читается
+заново и сверяется с подтверждёнными сохранениями: потерянные и
+задвоенные записи считаются отдельно.
+
+Примеры (из корня репозитория):
+    python -m benchmarks.load --sessions 8 --iterations 5
+    python -m benchmarks.load --sessions 16 --latency 0.05 --jitter 0.05 --error-rate 0.02 --lost-response-rate 0.05
+    python -m benchmarks.load --rate-limit 200 --rate-window 10 --output load.json
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import core
+from benchmarks.github_stub import GitHubStub
+from benchmarks.synthetic import VISIT_NAMES, make_history
+from github_client import GitHubClient
+from history_model import as_strings
+from ingest import VISIT_COLUMNS
+from storage import PaymentHistoryStore
+
+OWNER = 'load'
+REPO = 'payments'
+PERCENTILES = (50, 90, 95, 99)
+
+
+def session_upload(history, session, iteration, rows, seed):
+    """Загрузка сессии: половина - уже оплаченные визиты, половина - новые (уникальные ID)"""
+    rng = np.random.default_rng(seed)
+    paid = history.iloc[rng.choice(len(history), size=rows // 2, replace=False)][VISIT_COLUMNS]
+    count = rows - len(paid)
+    start = datetime(2024, 1, 1)
+    new = pd.DataFrame({
+        'subject_id': [f"L{session:03d}-{iteration:04d}-{k:05d}" for k in range(count)],
+        'visit_name': [VISIT_NAMES[k % len(VISIT_NAMES)] for k in range(count)],
+        'visit_date': [(start + timedelta(days=k % 365)).strftime('%Y-%m-%d') for k in range(count)],
+    })
+    return pd.concat([paid, new], ignore_index=True).sample(frac=1, random_state=seed).reset_index(drop=True), new
+
+
+def run_session(store_factory, history, session, args, results):
+    store = store_factory()
+    for iteration in range(args.iterations):
+        upload, new = session_upload(history, session, iteration, args.upload, seed=session * 10007 + iteration)
+        flow = {'session': session, 'iteration': iteration, 'new_expected': len(new)}
+        start = time.perf_counter()
+        try:
+            run_id = uuid.uuid4().hex
+            visit_index = store.load_index(run_id)
+            new_visits, _, same_type, suspicious, similar_names = core.process_visits(upload, visit_index)
+            visits_to_pay = core.select_visits_to_pay(new_visits, same_type, suspicious, similar_names=similar_names)
+            flow['classify'] = time.perf_counter() - start
+            flow['new_found'] = len(new_visits)
+
+            saved = time.perf_counter()
+            core.save_paid_visits(store, visits_to_pay)
+            flow['save'] = time.perf_counter() - saved
+            flow['saved_keys'] = [tuple(key) for key in visits_to_pay[VISIT_COLUMNS].itertuples(index=False)]
+        except Exception as e:
+            flow['error'] = f"{type(e).__name__}: {e}"
+            flow['attempted_keys'] = [tuple(key) for key in new[VISIT_COLUMNS].itertuples(index=False)]
+        flow['total'] = time.perf_counter() - start
+        results.append(flow)
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    return {f"p{p}": float(np.percentile(values, p)) for p in PERCENTILES} | {'max': float(max(values))}
+
+
+def verify(store, history_rows, flows):
+    """Сверяет историю с подтверждёнными сохранениями: потерянные и задвоенные визиты"""
+    df, version = store.load()
+    keys = Counter(as_strings(df)[VISIT_COLUMNS].itertuples(index=False, name=None))
+    saved = [key for flow in flows for key in flow.get('saved_keys', [])]
+    # Сохранение с ошибкой могло всё же дойти до манифеста: такие визиты не потеряны, но и не подтверждены
+    unconfirmed = [key for flow in flows for key in flow.get('attempted_keys', [])]
+    return {
+        'history_rows': len(df),
+        'expected_rows': history_rows + len(saved),
+        'lost_updates': sum(1 for key in saved if keys[key] == 0),
+        'duplicated_rows': sum(count - 1 for key, count in keys.items() if count > 1 and key[0].startswith('L')),
+        'unconfirmed_written': sum(1 for key in unconfirmed if keys[key] > 0),
+        'version': version,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон сессий против стенда GitHub Contents API")
+    parser.add_argument('--sessions', type=int, default=8, help="параллельных сессий")
+    parser.add_argument('--iterations', type=int, default=5, help="проверок с оплатой на сессию")
+    parser.add_argument('--history', type=int, default=20000, help="строк истории до начала прогона")
+    parser.add_argument('--upload', type=int, default=200, help="строк в каждой загрузке")
+    parser.add_argument('--shared-store', action='store_true',
+                        help="одно хранилище на все сессии (как сессии одного процесса приложения)")
+    parser.add_argument('--max-age', type=float, default=0.0, help="HISTORY_MAX_AGE хранилищ, с")
+    parser.add_argument('--latency', type=float, default=0.0, help="задержка ответа стенда, с")
+    parser.add_argument('--jitter', type=float, default=0.0, help="случайная добавка к задержке, с")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="доля ответов 5xx")
+    parser.add_argument('--lost-response-rate', type=float, default=0.0, help="доля выполненных записей с ответом 502")
+    parser.add_argument('--rate-limit', type=int, help="лимит запросов стенда на окно")
+    parser.add_argument('--rate-window', type=float, default=60.0, help="окно лимита, с")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="файл для результатов в JSON")
+    args = parser.parse_args(argv)
+
+    stub = GitHubStub(seed=args.seed)
+    api_url = stub.start()
+    history = make_history(args.history, seed=args.seed)
+
+    def store_factory():
+        client = GitHubClient('load-token', OWNER, REPO, api_url=api_url)
+        return PaymentHistoryStore(client, max_age=args.max_age)
+
+    # Начальная история пишется без помех, отказы и задержки включаются после
+    store_factory().append(history.to_dict('records'))
+    stub.latency, stub.jitter = args.latency, args.jitter
+    stub.error_rate, stub.lost_response_rate = args.error_rate, args.lost_response_rate
+    stub.rate_limit, stub.rate_window = args.rate_limit, args.rate_window
+    stub.stats.clear()
+
+    shared = store_factory() if args.shared_store else None
+    factory = (lambda: shared) if shared is not None else store_factory
+    flows = []
+    threads = [
+        threading.Thread(target=run_session, args=(factory, history, session, args, flows))
+        for session in range(args.sessions)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    # Сверка - без отказов и лимита, свежим хранилищем
+    stub.error_rate = stub.lost_response_rate = 0.0
+    stub.rate_limit = None
+    completed = [flow for flow in flows if 'error' not in flow]
+    report = {
+        'config': vars(args),
+        'wall_seconds': wall,
+        'flows': len(flows),
+        'completed': len(completed),
+        'failed': len(flows) - len(completed),
+        'errors': dict(Counter(flow['error'].split(':')[0] for flow in flows if 'error' in flow)),
+        'throughput_flows_per_s': len(completed) / wall if wall else None,
+        'saved_rows_per_s': sum(len(flow['saved_keys']) for flow in completed) / wall if wall else None,
+        'misclassified': sum(1 for flow in completed if flow['new_found'] != flow['new_expected']),
+        'latency': {
+            phase: percentiles([flow[phase] for flow in completed])
+            for phase in ('classify', 'save', 'total')
+        },
+        'stub': dict(stub.stats),
+        'verify': verify(store_factory(), len(history), flows),
+    }
+    stub.stop()
+
+    print(f"Сессий {args.sessions} x {args.iterations}: выполнено {report['completed']}, ошибок {report['failed']} "
+          f"за {wall:.2f} с ({report['throughput_flows_per_s']:.2f} проверок с оплатой/с)")
+    for phase, values in report['latency'].items():
+        if values:
+            print(f"  {phase:<9} " + '  '.join(f"{name} {value * 1000:8.1f} мс" for name, value in values.items()))
+    if report['errors']:
+        print(f"  ошибки: {report['errors']}")
+    print(f"  стенд: {report['stub']}")
+    check = report['verify']
+    print(f"  история: {check['history_rows']} строк (ожидалось {check['expected_rows']}), "
+          f"потеряно {check['lost_updates']}, задвоено {check['duplicated_rows']}, "
+          f"записано без подтверждения {check['unconfirmed_written']}, "
+          f"ошибок классификации {report['misclassified']}")
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding='utf-8')
+    return 1 if check['lost_updates'] or check['duplicated_rows'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
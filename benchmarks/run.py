@@ -0,0 +1,198 @@
+"""Замеры горячих путей на синтетических данных с сохранением результатов в JSON
+
+Примеры (из корня репозитория):
+    python -m benchmarks.run
+    python -m benchmarks.run --sizes 1000 100000 5000000 --upload 20000
+    python -m benchmarks.run --compare benchmarks/results/<старый>.json
+"""
+import argparse
+import base64
+import json
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+from benchmarks.synthetic import make_history, make_upload
+from github_cache import HISTORY_COLUMNS
+from history_model import compact_history, to_dates
+from reports import build_payment_report
+from sqlite_store import SQLitePaymentStore
+from storage import jsonl_to_frame, records_to_jsonl
+from visit_dates import parse_dates
+from visit_index import VisitIndex
+
+RESULTS_DIR = Path(__file__).parent / 'results'
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+
+
+def measure(function, repeat, memory=False):
+    """Время выполнения (все повторы) и, по желанию, пик выделенной памяти"""
+    seconds = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - start)
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def history_footprint(size, segment):
+    """Память истории: строки после разбора JSONL против компактного представления"""
+    records = [json.loads(line) for line in segment.splitlines()]
+    as_loaded = pd.DataFrame(records, columns=HISTORY_COLUMNS).astype(object)
+    compact = compact_history(as_loaded)
+    footprint = {
+        'history_rows': size,
+        'object_bytes': int(as_loaded.memory_usage(index=False, deep=True).sum()),
+        'compact_bytes': int(compact.memory_usage(index=False, deep=True).sum()),
+    }
+    print(f"{size:>9} {'history_memory':<28} {footprint['object_bytes'] / 2 ** 20:8.1f} MiB -> "
+          f"{footprint['compact_bytes'] / 2 ** 20:8.1f} MiB")
+    return footprint
+
+
+def run_size(size, upload_rows, repeat, memory, footprints):
+    """Все замеры для одного размера истории"""
+    history = make_history(size, seed=size)
+    upload, expected = make_upload(history, upload_rows, seed=size + 1)
+    records = history.to_dict('records')
+    results = []
+
+    def record(name, function, rows):
+        result, seconds, peak = measure(function, repeat, memory)
+        results.append({
+            'benchmark': name,
+            'history_rows': size,
+            'rows': rows,
+            'seconds': seconds,
+            'best': min(seconds),
+            'median': statistics.median(seconds),
+            'peak_bytes': peak,
+        })
+        print(f"{size:>9} {name:<28} {min(seconds):10.4f} s" + (f"  {peak / 2 ** 20:8.1f} MiB" if peak else ''))
+        return result
+
+    # Индекс строится по компактной истории, как в хранилище
+    compact = compact_history(history)
+    visit_index = record('index_build', lambda: VisitIndex.from_frame(compact), size)
+    classified = record('process_visits', lambda: visit_index.classify(upload), upload_rows)
+
+    actual = {
+        'new': len(classified[0]),
+        'exact_duplicates': len(classified[1]),
+        'same_visit_type': len(classified[2]),
+        'suspicious': len(classified[3]),
+    }
+    if actual != expected:
+        raise AssertionError(f"классификация не совпала с ожидаемой: {actual} != {expected}")
+
+    # Разбор дат загрузки, записанных текстом "ДД.ММ.ГГГГ" (раньше - угадывание формата для каждой строки)
+    expected_dates = to_dates(upload['visit_date'])
+    text_dates = expected_dates.dt.strftime('%d.%m.%Y').astype(object)
+    parsed_dates, _, _ = record('upload_dates_parse', lambda: parse_dates(text_dates), upload_rows)
+    if not pd.Series(parsed_dates.to_numpy()).equals(pd.Series(expected_dates.to_numpy())):
+        raise AssertionError("разбор дат загрузки не совпал с исходными датами")
+
+    # Та же проверка по SQLite: читаются только записи субъектов загрузки (индексы по ключам)
+    with tempfile.TemporaryDirectory() as directory:
+        sqlite_store = SQLitePaymentStore(Path(directory) / 'payments.sqlite3')
+        sqlite_store.append(records)
+        sqlite_classified = record('sqlite_process_visits', lambda: sqlite_store.load_index().classify(upload), upload_rows)
+    if [len(frame) for frame in sqlite_classified] != [len(frame) for frame in classified]:
+        raise AssertionError("классификация по SQLite не совпала с индексом в памяти")
+
+    # Полная запись одним файлом, как в прежнем save_file_to_github: json с отступами + base64
+    legacy_json = record('json_dumps_indent', lambda: json.dumps(records, ensure_ascii=False, indent=2), size)
+    record('json_loads', lambda: json.loads(legacy_json), size)
+    encoded = record('base64_encode', lambda: base64.b64encode(legacy_json.encode('utf-8')).decode('utf-8'), size)
+    record('base64_decode', lambda: base64.b64decode(encoded).decode('utf-8'), size)
+
+    # Сегмент JSONL, который пишет текущее хранилище
+    segment = record('jsonl_segment_dumps', lambda: records_to_jsonl(records), size)
+    record('jsonl_segment_loads', lambda: jsonl_to_frame(segment), size)
+    footprints.append(history_footprint(size, segment))
+
+    new_visits, exact_duplicates, same_visit_different_date, suspicious_same_date = classified
+    record('excel_report_export', lambda: build_payment_report(
+        new_visits, exact_duplicates, same_visit_different_date, suspicious_same_date
+    ), upload_rows)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, baseline_path):
+    """Печатает отношение лучших времён к сохранённому прогону"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    previous = {(r['benchmark'], r['history_rows']): r['best'] for r in baseline['results']}
+
+    print(f"\nСравнение с {baseline_path} (коммит {baseline.get('commit')}):")
+    for r in current['results']:
+        before = previous.get((r['benchmark'], r['history_rows']))
+        if before:
+            ratio = r['best'] / before
+            mark = '  <-- медленнее' if ratio > 1.1 else ''
+            print(f"{r['history_rows']:>9} {r['benchmark']:<28} {before:10.4f} -> {r['best']:10.4f} s  x{ratio:5.2f}{mark}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарки обработки визитов")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help="размеры истории (1000 ... 5000000)")
+    parser.add_argument('--upload', type=int, default=10000, help="строк в загрузке")
+    parser.add_argument('--repeat', type=int, default=3, help="повторов каждого замера")
+    parser.add_argument('--memory', action='store_true', help="дополнительно измерить пик памяти (tracemalloc)")
+    parser.add_argument('--output', help="файл результатов (по умолчанию benchmarks/results/<время>-<коммит>.json)")
+    parser.add_argument('--compare', help="файл результатов прошлого прогона для сравнения")
+    args = parser.parse_args(argv)
+
+    results = []
+    footprints = []
+    for size in args.sizes:
+        results.extend(run_size(size, min(args.upload, size), args.repeat, args.memory, footprints))
+
+    commit = git_revision()
+    report = {
+        'commit': commit,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'upload_rows': args.upload,
+        'repeat': args.repeat,
+        'results': results,
+        'history_memory': footprints,
+    }
+
+    output = Path(args.output) if args.output else RESULTS_DIR / f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{commit or 'local'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nРезультаты сохранены в {output}")
+
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Генератор реалистичных историй оплат и загрузок с заданной долей дубликатов"""
+import numpy as np
+import pandas as pd
+
+from github_cache import HISTORY_COLUMNS
+from ingest import VISIT_COLUMNS
+
+VISIT_NAMES = [
+    "Визит 0 - Скрининг",
+    "Визит 1 - Исходная оценка",
+    "Визит 2 - Последующее наблюдение",
+    "Визит 3 - Последующее наблюдение",
+    "Визит 4 - Последующее наблюдение",
+    "Визит 5 - Последующее наблюдение",
+    "Визит 6 - Контроль терапии",
+    "Визит 7 - Контроль терапии",
+    "Визит 8 - Завершение лечения",
+    "Визит 9 - Наблюдение после лечения",
+    "Визит 10 - Заключительный визит",
+]
+# Визит, которого нет в истории: тот же ID и дата, другое название -> "подозрительный"
+UNSCHEDULED_VISIT = "Незапланированный визит"
+VISIT_INTERVAL_DAYS = 28
+FIRST_SITE = 10
+
+
+def make_history(rows, seed=0, start='2022-01-01', enrolment_days=900):
+    """История оплат: субъекты вида "13-001" проходят визиты по порядку раз в ~4 недели"""
+    rng = np.random.default_rng(seed)
+    visits_per_subject = len(VISIT_NAMES)
+    subjects = -(-rows // visits_per_subject)
+
+    subject_ids = _subject_ids(np.arange(subjects))
+    enrolment = pd.Timestamp(start) + pd.to_timedelta(rng.integers(0, enrolment_days, subjects), unit='D')
+
+    subject = np.repeat(np.arange(subjects), visits_per_subject)[:rows]
+    visit = np.tile(np.arange(visits_per_subject), subjects)[:rows]
+    jitter = rng.integers(-3, 4, rows)
+    visit_date = enrolment[subject] + pd.to_timedelta(visit * VISIT_INTERVAL_DAYS + jitter, unit='D')
+    payment_date = visit_date + pd.to_timedelta(rng.integers(5, 60, rows), unit='D')
+
+    history = pd.DataFrame({
+        'subject_id': subject_ids[subject],
+        'visit_name': np.asarray(VISIT_NAMES, dtype=object)[visit],
+        'visit_date': visit_date.strftime('%Y-%m-%d'),
+        'payment_date': payment_date.strftime('%Y-%m-%d'),
+        'payment_amount': 0.0,
+    })
+    return history[HISTORY_COLUMNS]
+
+
+def make_upload(history, rows, exact_ratio=0.3, same_type_ratio=0.05, same_date_ratio=0.02, seed=1):
+    """Загрузка визитов с заданными долями точных дубликатов, того же типа и той же даты
+
+    Возвращает (загрузка, ожидаемое число строк по категориям). Новые визиты
+    принадлежат субъектам, которых нет в истории.
+    """
+    rng = np.random.default_rng(seed)
+    counts = {
+        'exact_duplicates': int(rows * exact_ratio),
+        'same_visit_type': int(rows * same_type_ratio),
+        'suspicious': int(rows * same_date_ratio),
+    }
+    counts['new'] = rows - sum(counts.values())
+
+    # Каждая запись истории используется не более одного раза
+    sample = history.iloc[rng.permutation(len(history))[:rows - counts['new']]]
+    exact_rows = sample.iloc[:counts['exact_duplicates']]
+    same_type_rows = sample.iloc[counts['exact_duplicates']:counts['exact_duplicates'] + counts['same_visit_type']]
+    same_date_rows = sample.iloc[counts['exact_duplicates'] + counts['same_visit_type']:]
+
+    # Тот же визит с датой, сдвинутой на 1-3 дня (меньше интервала между визитами)
+    shifted = pd.to_datetime(same_type_rows['visit_date']) + pd.to_timedelta(rng.integers(1, 4, len(same_type_rows)), unit='D')
+    same_type_rows = same_type_rows.assign(visit_date=shifted.dt.strftime('%Y-%m-%d'))
+    same_date_rows = same_date_rows.assign(visit_name=UNSCHEDULED_VISIT)
+
+    first_new = -(-len(history) // len(VISIT_NAMES))
+    new_subjects = first_new + rng.integers(0, max(1, counts['new']), counts['new'])
+    new_rows = pd.DataFrame({
+        'subject_id': _subject_ids(new_subjects),
+        'visit_name': np.asarray(VISIT_NAMES, dtype=object)[rng.integers(0, len(VISIT_NAMES), counts['new'])],
+        'visit_date': (pd.Timestamp('2026-01-01') + pd.to_timedelta(rng.integers(0, 300, counts['new']), unit='D')).strftime('%Y-%m-%d'),
+    })
+
+    upload = pd.concat(
+        [exact_rows[VISIT_COLUMNS], same_type_rows[VISIT_COLUMNS], same_date_rows[VISIT_COLUMNS], new_rows],
+        ignore_index=True
+    )
+    upload = upload.iloc[rng.permutation(len(upload))].reset_index(drop=True)
+    return upload, counts
+
+
+def _subject_ids(numbers):
+    """Номер субъекта -> ID вида "<центр>-<номер>", по 999 субъектов на центр"""
+    site = FIRST_SITE + numbers // 999
+    number = numbers % 999 + 1
+    return np.char.add(np.char.add(site.astype(str), '-'), np.char.zfill(number.astype(str), 3)).astype(object)
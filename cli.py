@@ -0,0 +1,201 @@
+"""Проверка файлов визитов из командной строки (без Streamlit)
+
+Примеры:
+    python cli.py classify site13.xlsx site16.xlsx --out reports
+    python cli.py classify exports/*.xlsx --commit
+    python cli.py migrate
+    python cli.py compact
+    STORAGE_BACKEND=sqlite python cli.py migrate
+
+Настройки берутся из переменных окружения GITHUB_TOKEN, REPO_OWNER,
+REPO_NAME, GITHUB_API_URL, HISTORY_MAX_AGE, STORAGE_BACKEND, SQLITE_PATH
+или из файла, указанного в --secrets.
+"""
+import argparse
+import json
+import os
+import sys
+import tomllib
+from pathlib import Path
+
+import pandas as pd
+
+import core
+from ingest import VISIT_COLUMNS, read_visit_files
+from reports import build_payment_report
+
+CONFIG_KEYS = ['GITHUB_TOKEN', 'REPO_OWNER', 'REPO_NAME', 'GITHUB_API_URL', 'HISTORY_MAX_AGE',
+               'STORAGE_BACKEND', 'SQLITE_PATH']
+
+
+def load_config(secrets_path=None):
+    """Настройки из secrets.toml (если указан) с приоритетом переменных окружения"""
+    config = {}
+    if secrets_path:
+        with open(secrets_path, 'rb') as f:
+            config.update(tomllib.load(f))
+    for key in CONFIG_KEYS:
+        if os.environ.get(key):
+            config[key] = os.environ[key]
+    return config
+
+
+def classify_files(store, paths, out_dir=None, workers=None,
+                   add_same_type=False, add_suspicious=False, add_similar=False):
+    """Проверяет файлы по одному снимку истории; возвращает (сводка, визиты к оплате)"""
+    visit_index = store.load_index()
+
+    summary = []
+    to_pay = []
+    files = []
+    readable = []
+    for path in paths:
+        try:
+            files.append((Path(path).read_bytes(), Path(path).name))
+            readable.append(path)
+        except OSError as e:
+            summary.append({'file': str(path), 'error': str(e)})
+
+    # Файлы разбираются параллельно в пуле процессов
+    parsed = read_visit_files(files, workers=workers)
+    for path, (_, uploaded_df) in zip(readable, parsed):
+        if isinstance(uploaded_df, Exception):
+            summary.append({'file': str(path), 'error': str(uploaded_df)})
+            continue
+        # Строки без распознанной даты визита не проверяются и не оплачиваются
+        uploaded_df, date_errors = core.split_date_errors(uploaded_df)
+        # Визит, записанный в файле дважды, проверяется и оплачивается один раз
+        uploaded_df, upload_repeats = core.split_repeats(uploaded_df)
+
+        new_visits, exact_duplicates, same_visit_different_date, suspicious_same_date, similar_names = \
+            core.process_visits(uploaded_df, visit_index)
+        visits_to_pay = core.select_visits_to_pay(
+            new_visits, same_visit_different_date, suspicious_same_date,
+            add_same_type=add_same_type, add_suspicious=add_suspicious,
+            similar_names=similar_names, add_similar=add_similar
+        )
+        to_pay.append(visits_to_pay)
+
+        entry = {
+            'file': str(path),
+            'total': len(uploaded_df) + len(upload_repeats) + len(date_errors),
+            'date_errors': len(date_errors),
+            'upload_repeats': len(upload_repeats),
+            'new': len(new_visits),
+            'exact_duplicates': len(exact_duplicates),
+            'same_visit_type': len(same_visit_different_date),
+            'suspicious': len(suspicious_same_date),
+            'similar_names': len(similar_names),
+            'to_pay': len(visits_to_pay),
+        }
+        if out_dir is not None:
+            report_path = Path(out_dir) / f"{Path(path).stem}_otchet.xlsx"
+            report_path.write_bytes(build_payment_report(
+                visits_to_pay, exact_duplicates, same_visit_different_date, suspicious_same_date, similar_names,
+                upload_repeats=upload_repeats, date_errors=date_errors
+            ))
+            entry['report'] = str(report_path)
+        summary.append(entry)
+
+    visits_to_pay = pd.concat(to_pay, ignore_index=True) if to_pay else pd.DataFrame(columns=VISIT_COLUMNS)
+    return summary, visits_to_pay
+
+
+def command_classify(args):
+    store = core.open_store(load_config(args.secrets))
+    if args.out:
+        Path(args.out).mkdir(parents=True, exist_ok=True)
+
+    summary, visits_to_pay = classify_files(
+        store, args.files, out_dir=args.out, workers=args.workers,
+        add_same_type=args.add_same_type, add_suspicious=args.add_suspicious,
+        add_similar=args.add_similar
+    )
+
+    for entry in summary:
+        if 'error' in entry:
+            print(f"❌ {entry['file']}: {entry['error']}")
+        else:
+            print(f"{entry['file']}: всего {entry['total']}, новые {entry['new']}, "
+                  f"точные дубликаты {entry['exact_duplicates']}, тот же тип {entry['same_visit_type']}, "
+                  f"подозрительные {entry['suspicious']}, похожие названия {entry['similar_names']}, "
+                  f"повторы в файле {entry['upload_repeats']}, без даты {entry['date_errors']}, "
+                  f"к оплате {entry['to_pay']}")
+
+    result = {'files': summary}
+    failed = any('error' in entry for entry in summary)
+    if args.commit and failed:
+        print("Запись отменена: не все файлы удалось прочитать", file=sys.stderr)
+    elif args.commit:
+        # Один визит в двух файлах оплачивается один раз
+        unique_to_pay, _ = core.split_repeats(visits_to_pay)
+        result['cross_file_duplicates'] = len(visits_to_pay) - len(unique_to_pay)
+        if unique_to_pay.empty:
+            print("Нет визитов для оплаты")
+        else:
+            result['version'] = core.save_paid_visits(store, unique_to_pay)
+            print(f"✅ {len(unique_to_pay)} визитов отмечены как оплаченные одной записью")
+        result['paid'] = len(unique_to_pay)
+
+    if args.out:
+        with open(Path(args.out) / 'summary.json', 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    return 1 if failed else 0
+
+
+def command_migrate(args):
+    config = load_config(args.secrets)
+    store = core.open_store(config)
+    if store.backend_name == 'SQLite':
+        # Пустая база заполняется историей из GitHub, если он настроен
+        source = core.open_github_store(config) if config.get('GITHUB_TOKEN') else None
+        version = store.migrate(source)
+        print(f"✅ История в SQLite ({store.count()} записей), версия {version}")
+        return 0
+    version = store.migrate()
+    print(f"✅ История хранится в сегментах, версия манифеста {version}")
+    return 0
+
+
+def command_compact(args):
+    store = core.open_store(load_config(args.secrets))
+    version = store.compact()
+    if version is None:
+        print("✅ Сворачивать нечего")
+    else:
+        print(f"✅ Сегменты закрытых месяцев свёрнуты, версия манифеста {version}")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Проверка дубликатов визитов без веб-интерфейса")
+    parser.add_argument('--secrets', help="путь к secrets.toml с настройками GitHub")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    classify = commands.add_parser('classify', help="проверить Excel-файлы по истории оплат")
+    classify.add_argument('files', nargs='+', help="Excel-файлы с визитами")
+    classify.add_argument('--out', help="папка для отчётов по файлам и summary.json")
+    classify.add_argument('--workers', type=int, help="число процессов для разбора файлов")
+    classify.add_argument('--add-same-type', action='store_true', help="оплачивать визиты того же типа с другой датой")
+    classify.add_argument('--add-suspicious', action='store_true', help="оплачивать подозрительные визиты")
+    classify.add_argument('--add-similar', action='store_true', help="оплачивать визиты с похожими названиями")
+    classify.add_argument('--commit', action='store_true', help="отметить визиты оплаченными одной записью")
+    classify.set_defaults(handler=command_classify)
+
+    migrate = commands.add_parser('migrate', help="перенести data/payments.json в сегменты (или историю GitHub в SQLite)")
+    migrate.set_defaults(handler=command_migrate)
+
+    compact = commands.add_parser('compact', help="свернуть сегменты закрытых месяцев по одному на месяц")
+    compact.set_defaults(handler=command_compact)
+
+    args = parser.parse_args(argv)
+    try:
+        return args.handler(args)
+    except KeyError as e:
+        print(f"❌ Ошибка конфигурации: {e}", file=sys.stderr)
+        return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+"""Проверка и оплата визитов без зависимости от Streamlit
+
+Используется и веб-приложением (app.py), и командной строкой (cli.py).
+"""
+from datetime import datetime
+
+import pandas as pd
+
+from github_cache import HISTORY_COLUMNS
+from github_client import DEFAULT_API_URL
+from history_model import as_strings, to_dates
+from ingest import DATE_ERROR_COLUMN, VISIT_COLUMNS
+from instrumentation import timed
+from journal import DEFAULT_JOURNAL_DIR
+from sqlite_store import DEFAULT_SQLITE_PATH, get_sqlite_store
+from storage import DEFAULT_FLUSH_DELAY, DEFAULT_MAX_AGE, get_store
+
+BACKENDS = ('github', 'sqlite')
+
+
+def open_store(config, journal=False):
+    """Открывает общее хранилище по настройкам (secrets.toml или окружение)
+
+    STORAGE_BACKEND выбирает хранилище: "github" (по умолчанию) или "sqlite"
+    (файл SQLITE_PATH). journal=True - сохранения в GitHub через локальный
+    журнал с фоновой отправкой; нужен долгоживущий процесс (веб-приложение),
+    а не разовый запуск CLI. SQLite пишет локально и журнал не использует.
+    """
+    backend = config.get('STORAGE_BACKEND') or 'github'
+    if backend not in BACKENDS:
+        raise KeyError(f"STORAGE_BACKEND должен быть одним из {', '.join(BACKENDS)}, а не {backend!r}")
+    if backend == 'sqlite':
+        return get_sqlite_store(config.get('SQLITE_PATH') or DEFAULT_SQLITE_PATH)
+    return open_github_store(config, journal)
+
+
+def open_github_store(config, journal=False):
+    """Хранилище в репозитории GitHub (например, как источник переноса в SQLite)"""
+    return get_store(
+        config['GITHUB_TOKEN'],
+        config['REPO_OWNER'],
+        config['REPO_NAME'],
+        api_url=config.get('GITHUB_API_URL') or DEFAULT_API_URL,
+        max_age=float(config.get('HISTORY_MAX_AGE', DEFAULT_MAX_AGE)),
+        journal_dir=config.get('JOURNAL_DIR', DEFAULT_JOURNAL_DIR) if journal else None,
+        flush_delay=float(config.get('JOURNAL_FLUSH_DELAY', DEFAULT_FLUSH_DELAY))
+    )
+
+
+def query_paid_visits(store, run_id=None, **filters):
+    """Возвращает (выборка истории по периоду, центру и визиту, версия хранилища)"""
+    return store.query(run_id, **filters)
+
+
+def combine_uploads(named_frames):
+    """Склеивает визиты нескольких файлов в одну загрузку
+
+    Если файлов больше одного, добавляется столбец source_file с именем
+    файла, чтобы в результатах было видно, откуда строка.
+    """
+    frames = []
+    for file_name, df in named_frames:
+        if len(named_frames) > 1:
+            df = df.assign(source_file=file_name)
+        frames.append(df)
+    if not frames:
+        return pd.DataFrame(columns=VISIT_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+
+def split_date_errors(uploaded_df):
+    """Отделяет строки, дату визита которых не удалось разобрать
+
+    Возвращает (строки с датой, строки без даты): такой визит нельзя ни
+    сравнить с историей, ни оплатить, поэтому он только показывается с
+    исходным значением даты (столбец date_error).
+    """
+    if DATE_ERROR_COLUMN not in uploaded_df:
+        return uploaded_df, pd.DataFrame(columns=['subject_id', 'visit_name', DATE_ERROR_COLUMN])
+    failed = uploaded_df[DATE_ERROR_COLUMN].notna().to_numpy()
+    date_errors = uploaded_df[failed].drop(columns='visit_date').reset_index(drop=True)
+    return uploaded_df[~failed].drop(columns=DATE_ERROR_COLUMN), date_errors
+
+
+def split_repeats(uploaded_df):
+    """Отделяет повторы визита внутри загрузки (в том же или другом файле)
+
+    Возвращает (первые вхождения, повторы): визит, пришедший дважды,
+    проверяется по истории и оплачивается один раз.
+    """
+    repeated = uploaded_df.duplicated(VISIT_COLUMNS, keep='first').to_numpy()
+    repeats = uploaded_df[repeated].reset_index(drop=True)
+    if 'source_file' in uploaded_df and not repeats.empty:
+        first_file = uploaded_df[~repeated].set_index(VISIT_COLUMNS)['source_file']
+        repeats['first_file'] = first_file.reindex(pd.MultiIndex.from_frame(repeats[VISIT_COLUMNS])).to_numpy()
+    return uploaded_df[~repeated], repeats
+
+
+@timed('process_visits')
+def process_visits(uploaded_df, visit_index):
+    """Разделяет загрузку на новые визиты, точные дубликаты, тот же тип, подозрительные
+    и визиты с названием, похожим на уже оплаченный визит субъекта
+    """
+    new_visits, exact_duplicates, same_visit_different_date, suspicious_same_date = visit_index.classify(uploaded_df)
+    new_visits, similar_names = visit_index.find_similar(new_visits)
+    return new_visits, exact_duplicates, same_visit_different_date, suspicious_same_date, similar_names
+
+
+def select_visits_to_pay(new_visits, same_visit_different_date, suspicious_same_date,
+                         add_same_type=False, add_suspicious=False,
+                         similar_names=None, add_similar=False):
+    """Итоговый список к оплате: новые визиты и, по выбору, спорные"""
+    visits_to_pay = new_visits[VISIT_COLUMNS].copy()
+    if add_same_type and not same_visit_different_date.empty:
+        visits_to_pay = pd.concat([visits_to_pay, same_visit_different_date[VISIT_COLUMNS]], ignore_index=True)
+    if add_suspicious and not suspicious_same_date.empty:
+        visits_to_pay = pd.concat([visits_to_pay, suspicious_same_date[VISIT_COLUMNS]], ignore_index=True)
+    if add_similar and similar_names is not None and not similar_names.empty:
+        visits_to_pay = pd.concat([visits_to_pay, similar_names[VISIT_COLUMNS]], ignore_index=True)
+    return visits_to_pay
+
+
+def paid_records(visits_to_pay, payment_date=None, payment_amount=0.0):
+    """Добавляет к визитам сведения об оплате в формате истории (даты - datetime64[s])"""
+    visits_to_save = visits_to_pay[VISIT_COLUMNS].copy()
+    visits_to_save['visit_date'] = to_dates(visits_to_save['visit_date'])
+    visits_to_save['payment_date'] = to_dates(pd.Series(payment_date or datetime.now().date(), index=visits_to_save.index))
+    visits_to_save['payment_amount'] = payment_amount
+    return visits_to_save[HISTORY_COLUMNS]
+
+
+def save_paid_visits(store, visits_to_pay, payment_date=None):
+    """Отмечает визиты оплаченными одной записью в хранилище
+
+    С журналом записи сохраняются локально и возвращается id записи журнала
+    (отправка в GitHub идёт в фоне), без журнала - новая версия хранилища.
+    """
+    # В хранилище и журнале даты - строки "YYYY-MM-DD"
+    records = as_strings(paid_records(visits_to_pay, payment_date)).to_dict('records')
+    if store.journal is not None:
+        return store.enqueue(records)
+    return store.append(records)
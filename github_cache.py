@@ -0,0 +1,124 @@
+"""Кэш файла данных из GitHub с условными запросами (ETag / sha)"""
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from github_client import GitHubError, blob_sha
+
+HISTORY_COLUMNS = ['subject_id', 'visit_name', 'visit_date', 'payment_date', 'payment_amount']
+
+
+class GitHubFileCache:
+    """Хранит последнюю версию файла и перепроверяет её через If-None-Match
+
+    Все вызовы с одним и тем же run_id (один перезапуск Streamlit) обходятся
+    не более чем одним запросом к GitHub. Параллельные вызовы, пришедшие во
+    время загрузки, ждут её окончания и используют тот же результат.
+    Если версия проверялась не раньше чем max_age секунд назад (любой
+    сессией), новые перезапуски берут её без запроса.
+    """
+
+    def __init__(self, client, path, max_runs=256, max_age=0.0):
+        self.client = client
+        self.path = path
+        self._cond = threading.Condition()
+        self._in_flight = False
+        self._generation = 0
+        self._etag = None
+        self._sha = None
+        self._data = None
+        self._validated_runs = OrderedDict()
+        self._max_runs = max_runs
+        self._max_age = max_age
+        self._validated_at = None
+
+    def get(self, run_id=None):
+        """Возвращает (data, sha); без run_id всегда перепроверяет версию"""
+        with self._cond:
+            if run_id is not None and (run_id in self._validated_runs or self._is_fresh()):
+                self._remember_run(run_id)
+                return self._data, self._sha
+
+            if self._in_flight:
+                generation = self._generation
+                while self._in_flight:
+                    self._cond.wait()
+                # Пока мы ждали, кто-то уже сходил в GitHub - берём его результат
+                if self._generation != generation and self._data is not None:
+                    self._remember_run(run_id)
+                    return self._data, self._sha
+
+            self._in_flight = True
+            etag = self._etag if self._data is not None else None
+            cached_sha = self._sha
+
+        ok = False
+        try:
+            result = self._fetch(etag, cached_sha)
+            ok = True
+        finally:
+            with self._cond:
+                self._in_flight = False
+                if ok:
+                    self._apply(*result)
+                    self._validated_at = time.monotonic()
+                    self._generation += 1
+                    self._remember_run(run_id)
+                self._cond.notify_all()
+
+        with self._cond:
+            return self._data, self._sha
+
+    def peek(self):
+        """Последняя известная версия (data, sha) без запроса к GitHub"""
+        with self._cond:
+            return self._data, self._sha
+
+    def store(self, data, sha):
+        """Запоминает только что записанную версию, чтобы не скачивать её заново"""
+        with self._cond:
+            self._data = data
+            self._sha = sha
+            self._etag = None
+            self._generation += 1
+            self._validated_runs.clear()
+            # Только что записанная версия заведомо актуальна для всех сессий
+            self._validated_at = time.monotonic()
+
+    def _fetch(self, etag, cached_sha):
+        """Выполняет условный GET; отсутствие файла - только 404
+
+        Любой другой ответ, кроме 200 и 304, - GitHubError: пустая история
+        вместо недоступной пометила бы уже оплаченные визиты как новые.
+        """
+        status, raw, new_etag = self.client.get_file(self.path, etag)
+        if status == 304:
+            return ('not_modified', None, None, etag)
+        if status == 404:
+            return ('replace', [], None, None)
+        if status != 200:
+            raise GitHubError(f"файл {self.path} недоступен (HTTP {status})", status)
+
+        sha = blob_sha(raw)
+        if sha == cached_sha:
+            return ('not_modified', None, None, new_etag)
+        return ('replace', json.loads(raw), sha, new_etag)
+
+    def _apply(self, action, data, sha, etag):
+        self._etag = etag
+        if action == 'replace':
+            self._data = data
+            self._sha = sha
+
+    def _is_fresh(self):
+        return (self._max_age > 0 and self._validated_at is not None and self._data is not None
+                and time.monotonic() - self._validated_at < self._max_age)
+
+    def _remember_run(self, run_id):
+        if run_id is None:
+            return
+        self._validated_runs[run_id] = True
+        while len(self._validated_runs) > self._max_runs:
+            self._validated_runs.popitem(last=False)
+
@@ -0,0 +1,197 @@
+"""Клиент GitHub Contents API: пул соединений, таймауты и повторы"""
+import base64
+import hashlib
+import random
+import threading
+import time
+from datetime import datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from instrumentation import record_api_call, timed
+
+DEFAULT_API_URL = "https://api.github.com"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RAW_MEDIA_TYPE = "application/vnd.github.raw+json"
+
+
+def blob_sha(raw):
+    """sha содержимого файла, как его считает git (и возвращает GitHub)"""
+    return hashlib.sha1(b'blob %d\0' % len(raw) + raw).hexdigest()
+
+
+class GitHubError(Exception):
+    """Ошибка обращения к GitHub"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class ShaConflict(GitHubError):
+    """Файл изменился с момента чтения (409 или 422 из-за устаревшего sha)"""
+
+
+class GitHubClient:
+    """Обращения к /repos/{owner}/{repo}/contents/{path} через общую сессию
+
+    Повторяет запросы при сетевых ошибках, 5xx и исчерпании лимита запросов
+    с экспоненциальной задержкой, учитывая Retry-After и X-RateLimit-Reset.
+    Адрес API настраивается, поэтому клиент можно направить на локальный стенд.
+    """
+
+    def __init__(self, token, owner, repo, api_url=DEFAULT_API_URL, timeout=(5, 30),
+                 max_retries=4, backoff=0.5, max_backoff=30, max_rate_limit_wait=60,
+                 pool_size=16, session=None, sleep=time.sleep):
+        self.token = token
+        self.owner = owner
+        self.repo = repo
+        self.api_url = api_url.rstrip('/')
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_rate_limit_wait = max_rate_limit_wait
+        self.sleep = sleep
+        self.rate_limit = {}
+        self._rate_limit_lock = threading.Lock()
+
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        session.headers.update({
+            "Authorization": f"token {token}",
+            "Accept": "application/vnd.github+json",
+        })
+        self.session = session
+
+    def contents_url(self, path):
+        return f"{self.api_url}/repos/{self.owner}/{self.repo}/contents/{path}"
+
+    def request(self, method, path, headers=None, **kwargs):
+        """Выполняет запрос с повторами; возвращает последний ответ"""
+        url = self.contents_url(path)
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, headers=headers, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                record_api_call(method, path, 'error', 0, 0, time.perf_counter() - start)
+                if attempt >= self.max_retries:
+                    raise GitHubError(f"GitHub недоступен: {e}") from e
+                self.sleep(self.backoff_delay(attempt))
+                attempt += 1
+                continue
+
+            self._remember_rate_limit(response)
+            record_api_call(
+                method, path, response.status_code,
+                len(response.request.body or b''), len(response.content),
+                time.perf_counter() - start, self.rate_limit.get('remaining')
+            )
+            if not self._should_retry(response) or attempt >= self.max_retries:
+                return response
+            self.sleep(self._retry_delay(response, attempt))
+            attempt += 1
+
+    @timed('github.get')
+    def get_file(self, path, etag=None):
+        """Условный GET содержимого файла: (status, raw, etag)
+
+        Содержимое запрашивается как raw: base64-поле content ответа JSON
+        пустое для файлов больше 1 МБ. sha файла считается по содержимому (blob_sha).
+        """
+        headers = {"Accept": RAW_MEDIA_TYPE}
+        if etag:
+            headers["If-None-Match"] = etag
+        response = self.request('GET', path, headers=headers)
+        if response.status_code == 200:
+            return 200, response.content, response.headers.get('ETag')
+        return response.status_code, None, etag
+
+    @timed('github.get_raw')
+    def get_raw(self, path):
+        """Скачивает содержимое файла целиком (до 100 МБ, в отличие от base64-поля)"""
+        response = self.request('GET', path, headers={"Accept": RAW_MEDIA_TYPE})
+        if response.status_code != 200:
+            raise GitHubError(f"файл {path} недоступен (HTTP {response.status_code})", response.status_code)
+        return response.content
+
+    @timed('github.put')
+    def put_file(self, path, raw, sha=None, message=None):
+        """Записывает файл и возвращает его новый sha; ShaConflict при гонке"""
+        payload = {
+            "message": message or f"Update payments data - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+            "content": base64.b64encode(raw).decode('utf-8')
+        }
+        if sha:
+            payload["sha"] = sha
+
+        response = self.request('PUT', path, json=payload)
+        if response.status_code in [200, 201]:
+            return response.json()['content']['sha']
+        if response.status_code == 409 or (response.status_code == 422 and _mentions_sha(response)):
+            raise ShaConflict(f"файл {path} был изменён другим пользователем", response.status_code)
+        raise GitHubError(f"не удалось записать {path} (HTTP {response.status_code})", response.status_code)
+
+    def _should_retry(self, response):
+        if response.status_code in RETRY_STATUSES:
+            return True
+        # 403 означает исчерпанный основной или вторичный лимит запросов
+        return response.status_code == 403 and (
+            response.headers.get('X-RateLimit-Remaining') == '0' or 'Retry-After' in response.headers
+        )
+
+    def _retry_delay(self, response, attempt):
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is not None:
+            try:
+                return self._check_wait(float(retry_after))
+            except ValueError:
+                pass
+
+        if response.headers.get('X-RateLimit-Remaining') == '0':
+            reset = response.headers.get('X-RateLimit-Reset')
+            if reset is not None:
+                return self._check_wait(max(0.0, float(reset) - time.time()))
+
+        return self.backoff_delay(attempt)
+
+    def _check_wait(self, seconds):
+        if seconds > self.max_rate_limit_wait:
+            raise GitHubError(f"лимит запросов GitHub исчерпан, повтор возможен через {int(seconds)} с", 429)
+        return seconds
+
+    def backoff_delay(self, attempt):
+        """Экспоненциальная задержка со случайным разбросом"""
+        delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+        return delay * random.uniform(0.5, 1.0)
+
+    def _remember_rate_limit(self, response):
+        headers = response.headers
+        if 'X-RateLimit-Remaining' not in headers:
+            return
+        with self._rate_limit_lock:
+            self.rate_limit = {
+                'limit': _int_or_none(headers.get('X-RateLimit-Limit')),
+                'remaining': _int_or_none(headers.get('X-RateLimit-Remaining')),
+                'reset': _int_or_none(headers.get('X-RateLimit-Reset')),
+            }
+
+
+def _mentions_sha(response):
+    try:
+        return 'sha' in response.json().get('message', '')
+    except ValueError:
+        return False
+
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,132 @@
+"""Компактное представление истории оплат в памяти
+
+ID субъектов и названия визитов хранятся категориями (каждая строка один раз
+на словарь), даты - datetime64[s], суммы - float32. Преобразование
+выполняется один раз при чтении сегмента; склейка сегментов объединяет
+словари категорий, не возвращаясь к строкам.
+"""
+import sys
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from github_cache import HISTORY_COLUMNS
+
+CATEGORY_COLUMNS = ['subject_id', 'visit_name']
+DATE_COLUMNS = ['visit_date', 'payment_date']
+DATE_FORMAT = '%Y-%m-%d'
+# Указатель на объект в столбце object и размер строки даты "YYYY-MM-DD"
+POINTER_BYTES = 8
+DATE_STRING_BYTES = sys.getsizeof('2024-01-01')
+
+
+def compact_history(df):
+    """Приводит историю к компактным типам; уже компактные столбцы не трогает"""
+    df = df.reset_index(drop=True)
+    columns = {}
+    for column in CATEGORY_COLUMNS:
+        values = df[column] if column in df else pd.Series(index=df.index, dtype=object)
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            columns[column] = values
+        else:
+            values = values.where(values.isna(), values.astype(str))
+            columns[column] = values.astype(object).astype('category')
+    for column in DATE_COLUMNS:
+        values = df[column] if column in df else pd.Series(index=df.index, dtype=object)
+        columns[column] = to_dates(values)
+    amount = df['payment_amount'] if 'payment_amount' in df else pd.Series(0.0, index=df.index)
+    columns['payment_amount'] = pd.to_numeric(amount, errors='coerce').astype(np.float32)
+    return pd.DataFrame(columns)[HISTORY_COLUMNS]
+
+
+def to_dates(values):
+    """Строки "YYYY-MM-DD" (или даты) -> datetime64[s]; нераспознанные -> NaT"""
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values.astype('datetime64[s]')
+    return pd.to_datetime(pd.Series(values), format=DATE_FORMAT, errors='coerce').astype('datetime64[s]')
+
+
+def empty_history():
+    return compact_history(pd.DataFrame(columns=HISTORY_COLUMNS))
+
+
+def concat_history(frames):
+    """Склеивает компактные таблицы истории с объединением словарей категорий"""
+    frames = [frame for frame in frames if len(frame)]
+    if not frames:
+        return empty_history()
+    if len(frames) == 1:
+        return frames[0]
+
+    columns = {}
+    for column in HISTORY_COLUMNS:
+        if column in CATEGORY_COLUMNS:
+            columns[column] = pd.Series(union_categoricals([frame[column] for frame in frames]))
+        else:
+            columns[column] = pd.concat([frame[column] for frame in frames], ignore_index=True)
+    return pd.DataFrame(columns)[HISTORY_COLUMNS]
+
+
+def day_numbers(dates):
+    """Даты -> число дней от 1970-01-01 (int64); NaT -> -1"""
+    dates = to_dates(dates)
+    days = dates.to_numpy().astype('datetime64[D]').astype(np.int64)
+    days[dates.isna().to_numpy()] = -1
+    return days
+
+
+def format_dates(values):
+    """Дни от 1970-01-01 или datetime64 -> строки "YYYY-MM-DD" (None для пропусков)"""
+    values = np.asarray(values)
+    if values.dtype.kind == 'M':
+        missing = np.isnat(values)
+        days = values.astype('datetime64[D]')
+    else:
+        missing = values < 0
+        days = np.maximum(values, 0).astype('datetime64[D]')
+    result = np.datetime_as_string(days, unit='D').astype(object)
+    result[missing] = None
+    return result
+
+
+def as_strings(df):
+    """Копия таблицы с датами в виде строк "YYYY-MM-DD" - для экспорта и показа"""
+    result = df.copy(deep=False)
+    for column in DATE_COLUMNS:
+        if column in result and pd.api.types.is_datetime64_any_dtype(result[column]):
+            result[column] = result[column].dt.strftime(DATE_FORMAT)
+    for column in CATEGORY_COLUMNS:
+        if column in result and isinstance(result[column].dtype, pd.CategoricalDtype):
+            result[column] = result[column].astype(object)
+    return result
+
+
+def memory_report(df):
+    """Память по столбцам: фактическая и оценка для тех же данных строками object
+
+    Оценка считает указатель и отдельный объект str на каждую строку, как
+    получается после json.loads и pd.DataFrame(records).
+    """
+    rows = []
+    for column in df.columns:
+        values = df[column]
+        actual = int(values.memory_usage(index=False, deep=True))
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            sizes = np.array([sys.getsizeof(value) for value in values.cat.categories], dtype=np.int64)
+            codes = values.cat.codes.to_numpy()
+            as_object = int(sizes[codes[codes >= 0]].sum()) + POINTER_BYTES * len(values)
+        elif pd.api.types.is_datetime64_any_dtype(values):
+            as_object = (POINTER_BYTES + DATE_STRING_BYTES) * len(values)
+        elif values.dtype == np.float32:
+            as_object = 8 * len(values)
+        else:
+            as_object = actual
+        rows.append({'column': column, 'dtype': str(values.dtype), 'bytes': actual, 'object_bytes': as_object})
+    rows.append({
+        'column': 'ИТОГО',
+        'dtype': '',
+        'bytes': sum(row['bytes'] for row in rows),
+        'object_bytes': sum(row['object_bytes'] for row in rows),
+    })
+    return rows
@@ -0,0 +1,117 @@
+"""Выборка истории оплат по периоду, центру (началу ID субъекта) и визиту
+
+Даты оплаты и визита индексируются отсортированными массивами позиций
+строк снимка (DateIndex), поэтому период находится двоичным поиском, а
+остальные условия проверяются только на строках этого периода. Индекс
+строится один раз на снимок и дополняется новыми строками, как индекс
+дубликатов.
+"""
+import numpy as np
+import pandas as pd
+
+from history_model import DATE_COLUMNS, DATE_FORMAT, to_dates
+
+# Условия выборки (все необязательные); периоды включают обе границы
+FILTER_KEYS = ('payment_from', 'payment_to', 'visit_from', 'visit_to', 'subject_prefix', 'visit_name')
+# NaT в int64 - минимальное значение, поэтому пропуски дат стоят в начале отсортированного массива
+MISSING_DAY = np.iinfo(np.int64).min
+
+
+def day_number(value):
+    """Дата (строка "YYYY-MM-DD", date или Timestamp) -> число дней от 1970-01-01"""
+    return int(np.datetime64(pd.Timestamp(value).date(), 'D').astype(np.int64))
+
+
+def day_text(value):
+    """Дата -> строка "YYYY-MM-DD", как в хранилище"""
+    return pd.Timestamp(value).strftime(DATE_FORMAT)
+
+
+def has_filters(filters):
+    """Задано ли хоть одно условие выборки; без условий выборка - вся история"""
+    return any(filters.get(key) is not None for key in FILTER_KEYS)
+
+
+def _days(dates):
+    return to_dates(dates).to_numpy().astype('datetime64[D]').view(np.int64)
+
+
+class DateIndex:
+    """Позиции строк снимка, отсортированные по дате оплаты и по дате визита"""
+
+    def __init__(self):
+        self.rows = 0
+        self._days = {column: np.empty(0, dtype=np.int64) for column in DATE_COLUMNS}
+        self._order = {column: np.empty(0, dtype=np.int64) for column in DATE_COLUMNS}
+
+    @classmethod
+    def from_frame(cls, paid_visits):
+        index = cls()
+        index.add_frame(paid_visits)
+        return index
+
+    def add_frame(self, paid_visits):
+        """Добавляет строки, дописанные в конец снимка
+
+        Новые оплаты обычно не раньше прежних, и тогда массивы просто
+        дописываются; иначе отсортированные новые строки вливаются слиянием
+        (O(n) без пересортировки всей истории).
+        """
+        for column in DATE_COLUMNS:
+            days = _days(paid_visits[column])
+            order = np.argsort(days, kind='stable')
+            new_days, new_order = days[order], order + self.rows
+            old_days, old_order = self._days[column], self._order[column]
+            if not len(old_days) or not len(new_days) or new_days[0] >= old_days[-1]:
+                self._days[column] = np.concatenate([old_days, new_days])
+                self._order[column] = np.concatenate([old_order, new_order])
+            else:
+                # side='right': при равной дате новые строки идут после прежних
+                at = np.searchsorted(old_days, new_days, side='right')
+                self._days[column] = np.insert(old_days, at, new_days)
+                self._order[column] = np.insert(old_order, at, new_order)
+        self.rows += len(paid_visits)
+
+    def positions(self, column, start=None, end=None):
+        """Позиции строк с датой в [start, end] (границы необязательны); пропуски дат не попадают"""
+        days = self._days[column]
+        lo = np.searchsorted(days, MISSING_DAY + 1 if start is None else day_number(start), side='left')
+        hi = len(days) if end is None else np.searchsorted(days, day_number(end), side='right')
+        return self._order[column][lo:hi]
+
+
+def query_history(paid_visits, dates=None, payment_from=None, payment_to=None, visit_from=None, visit_to=None,
+                  subject_prefix=None, visit_name=None):
+    """Строки истории, подходящие под все заданные условия, в порядке записи
+
+    subject_prefix - начало ID субъекта (например, "13-" - все субъекты
+    центра 13), visit_name - точное название визита. dates - DateIndex
+    этого снимка (или более позднего снимка того же ряда); без него индекс
+    строится на месте.
+    """
+    positions = None
+    for column, start, end in (('payment_date', payment_from, payment_to), ('visit_date', visit_from, visit_to)):
+        if start is None and end is None:
+            continue
+        if dates is None:
+            dates = DateIndex.from_frame(paid_visits)
+        found = dates.positions(column, start, end)
+        # Индекс мог быть уже дополнен строками более новой версии
+        found = found[found < len(paid_visits)]
+        positions = found if positions is None else np.intersect1d(positions, found, assume_unique=True)
+
+    rows = paid_visits if positions is None else paid_visits.iloc[np.sort(positions)]
+    if subject_prefix:
+        rows = rows[_category_mask(rows['subject_id'], lambda values: values.str.startswith(subject_prefix))]
+    if visit_name:
+        rows = rows[_category_mask(rows['visit_name'], lambda values: values == visit_name)]
+    return rows.reset_index(drop=True)
+
+
+def _category_mask(values, matches):
+    """Маска строк по условию, которое проверяется только на словаре категорий"""
+    if not isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.astype('category')
+    selected = np.asarray(matches(values.cat.categories.astype(str)), dtype=bool)
+    # Код -1 (пропуск) попадает на последний элемент - False
+    return np.append(selected, False)[values.cat.codes.to_numpy()]
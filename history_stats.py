@@ -0,0 +1,100 @@
+"""Сводка истории оплат для статистики, дополняемая по сегментам"""
+import threading
+
+import numpy as np
+import pandas as pd
+
+from history_model import concat_history, empty_history
+
+RECENT_PAYMENTS = 5
+
+
+class HistoryStats:
+    """Число оплат, множества субъектов и визитов и последние оплаты
+
+    Строится один раз на версию хранилища и дополняется новыми сегментами,
+    как и индекс дубликатов, поэтому показ статистики не зависит от размера
+    истории. Последние оплаты - top-K по дате оплаты; при равной дате выше
+    записанная позже.
+    """
+
+    def __init__(self, top_k=RECENT_PAYMENTS):
+        self.top_k = top_k
+        self.rows = 0
+        self.subjects = set()
+        self.visit_names = set()
+        self._recent = empty_history()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_frame(cls, paid_visits, top_k=RECENT_PAYMENTS):
+        stats = cls(top_k)
+        stats.add_frame(paid_visits)
+        return stats
+
+    @classmethod
+    def from_summary(cls, rows, subjects, visit_names, recent, top_k=RECENT_PAYMENTS):
+        """Сводка из готовых агрегатов (запросы к базе); recent - последние оплаты, новые сверху"""
+        stats = cls(top_k)
+        stats.rows = rows
+        stats.subjects = set(subjects)
+        stats.visit_names = set(visit_names)
+        stats._recent = recent.head(top_k).reset_index(drop=True)
+        return stats
+
+    def add_frame(self, paid_visits):
+        """Учитывает записи истории; стоит O(новых записей)"""
+        if paid_visits.empty:
+            return
+        subjects = _distinct(paid_visits['subject_id'])
+        visit_names = _distinct(paid_visits['visit_name'])
+        # Порядок записи нужен, чтобы при равной дате выше шла более поздняя оплата
+        newest = paid_visits.iloc[::-1]
+        candidates = concat_history([newest.iloc[_top_positions(newest['payment_date'], self.top_k)], self._recent])
+        recent = candidates.sort_values('payment_date', ascending=False, kind='stable', na_position='last').head(self.top_k)
+
+        with self._lock:
+            self.rows += len(paid_visits)
+            self.subjects.update(subjects)
+            self.visit_names.update(visit_names)
+            self._recent = recent.reset_index(drop=True)
+
+    @property
+    def subject_count(self):
+        return len(self.subjects)
+
+    @property
+    def visit_count(self):
+        return len(self.visit_names)
+
+    def visit_name_list(self):
+        """Названия визитов по алфавиту; копия снимается под блокировкой, пока add_frame дополняет набор"""
+        with self._lock:
+            names = list(self.visit_names)
+        return sorted(names)
+
+    def recent_payments(self):
+        """Последние оплаты (не больше top_k строк), новые сверху"""
+        with self._lock:
+            return self._recent.copy(deep=False)
+
+
+def _top_positions(payment_dates, k):
+    """Позиции строк, которые могут войти в top-k по дате (O(n), без полной сортировки)"""
+    days = payment_dates.to_numpy().astype('datetime64[s]').view(np.int64)
+    if len(days) <= k:
+        return np.arange(len(days))
+    # NaT - минимальное int64, поэтому пропуски попадают в кандидаты последними
+    threshold = np.partition(days, len(days) - k)[len(days) - k]
+    # Из строк с пороговой датой нужны только первые k (сортировка устойчивая)
+    ties = np.flatnonzero(days == threshold)[:k]
+    return np.union1d(np.flatnonzero(days > threshold), ties)
+
+
+def _distinct(values):
+    """Различные непустые значения; у категорий - без перебора строк"""
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes = values.cat.codes.to_numpy()
+        used = np.bincount(codes[codes >= 0], minlength=len(values.cat.categories))
+        return values.cat.categories[np.flatnonzero(used)]
+    return pd.unique(values.dropna().to_numpy())
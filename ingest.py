@@ -0,0 +1,200 @@
+"""Чтение Excel-файлов с визитами: потоковый разбор и кэш по содержимому"""
+import hashlib
+import io
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from instrumentation import timed
+from visit_dates import parse_dates
+
+VISIT_COLUMNS = ['subject_id', 'visit_name', 'visit_date']
+# Исходное значение даты, которую не удалось разобрать (столбец есть, только если такие строки нашлись)
+DATE_ERROR_COLUMN = 'date_error'
+CHUNK_ROWS = 5000
+# Хватает на месячный набор файлов по центрам, чтобы перезапуски не разбирали их заново
+CACHE_SIZE = 32
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def file_digest(data):
+    """SHA-256 содержимого файла - ключ кэша разобранных загрузок"""
+    return hashlib.sha256(data).hexdigest()
+
+
+@timed('ingest.read_visits')
+def read_visits(data, file_name='', progress=None, chunk_rows=CHUNK_ROWS):
+    """Возвращает нормализованный DataFrame визитов из содержимого Excel-файла
+
+    Результат кэшируется по SHA-256 байтов файла, поэтому повторные
+    перезапуски с тем же файлом не разбирают книгу заново. progress, если
+    задан, вызывается как progress(прочитано_строк, всего_строк_или_None).
+    """
+    digest = file_digest(data)
+    cached = _cached(digest)
+    if cached is not None:
+        return cached
+
+    df = parse_visits(data, file_name, progress, chunk_rows)
+    _remember(digest, df)
+    return df.copy(deep=False)
+
+
+@timed('ingest.read_visit_files')
+def read_visit_files(files, progress=None, workers=None):
+    """Читает несколько файлов; возвращает [(имя, DataFrame или исключение)] в исходном порядке
+
+    files - список (содержимое, имя файла). Файлы из кэша не разбираются,
+    остальные разбираются параллельно в пуле процессов (разбор xlsx занимает
+    процессор, потоки здесь не помогают). progress, если задан, вызывается
+    как progress(готово_файлов, всего_файлов, имя) после каждого файла.
+    """
+    results = [None] * len(files)
+    digests = [file_digest(data) for data, _ in files]
+    missing = []
+    for position, ((data, file_name), digest) in enumerate(zip(files, digests)):
+        cached = _cached(digest)
+        if cached is not None:
+            results[position] = (file_name, cached)
+        else:
+            missing.append(position)
+
+    done = len(files) - len(missing)
+    if progress is not None and done:
+        progress(done, len(files), None)
+
+    workers = min(workers or os.cpu_count() or 1, len(missing))
+    if workers > 1:
+        # spawn: процессы не наследуют потоки веб-сервера
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            futures = {pool.submit(parse_visits, *files[position]): position for position in missing}
+            for future in as_completed(futures):
+                position = futures[future]
+                results[position] = _file_result(files[position][1], digests[position], future.result)
+                done += 1
+                if progress is not None:
+                    progress(done, len(files), files[position][1])
+    else:
+        for position in missing:
+            data, file_name = files[position]
+            results[position] = _file_result(file_name, digests[position], lambda: parse_visits(data, file_name))
+            done += 1
+            if progress is not None:
+                progress(done, len(files), file_name)
+    return results
+
+
+def _file_result(file_name, digest, parse):
+    try:
+        df = parse()
+    except Exception as e:
+        return file_name, e
+    _remember(digest, df)
+    return file_name, df.copy(deep=False)
+
+
+def _cached(digest):
+    with _cache_lock:
+        if digest in _cache:
+            _cache.move_to_end(digest)
+            return _cache[digest].copy(deep=False)
+    return None
+
+
+def _remember(digest, df):
+    with _cache_lock:
+        _cache[digest] = df
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def parse_visits(data, file_name='', progress=None, chunk_rows=CHUNK_ROWS):
+    """Разбирает Excel-файл без кэша; выполняется и в процессах пула"""
+    if file_name.lower().endswith('.xls'):
+        # Старый формат openpyxl не читает - разбираем целиком, но теми же порциями
+        raw = pd.read_excel(io.BytesIO(data))
+        chunks = _frame_chunks(raw, chunk_rows)
+        total = len(raw)
+    else:
+        chunks, total = _stream_xlsx(data, chunk_rows)
+
+    frames = []
+    done = 0
+    # Написание дат определяется по первой порции и дополняется, только если следующие им не разбираются
+    date_formats = []
+    for chunk in chunks:
+        frames.append(normalize_visits(chunk, date_formats))
+        done += len(chunk)
+        if progress is not None:
+            progress(done, total)
+
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=VISIT_COLUMNS)
+
+
+def normalize_visits(chunk, date_formats=None):
+    """Приводит порцию строк к столбцам и типам визитов
+
+    Дата визита становится datetime64[s]. Строки с пустой или
+    нераспознанной датой остаются с NaT, а исходное значение попадает в
+    столбец date_error (см. core.split_date_errors). date_formats - список
+    написаний дат, найденных в предыдущих порциях файла; дополняется.
+    """
+    if chunk.shape[1] < len(VISIT_COLUMNS):
+        raise ValueError("ожидаются столбцы: ID субъекта, Название визита, Дата визита")
+    chunk = chunk.iloc[:, :len(VISIT_COLUMNS)].copy()
+    chunk.columns = VISIT_COLUMNS
+
+    for column in ['subject_id', 'visit_name']:
+        values = chunk[column]
+        chunk[column] = values.where(values.isna(), values.astype(str)).astype(object)
+    raw = chunk['visit_date']
+    dates, failed, formats = parse_dates(raw, date_formats)
+    if date_formats is not None:
+        date_formats[:] = formats
+    chunk['visit_date'] = dates
+    if failed.any():
+        chunk[DATE_ERROR_COLUMN] = raw.where(raw.isna(), raw.astype(str)).fillna('').where(failed)
+    return chunk
+
+
+def _stream_xlsx(data, chunk_rows):
+    """Читает первый лист в режиме read_only порциями по chunk_rows строк"""
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    sheet = workbook.worksheets[0]
+    total = sheet.max_row - 1 if sheet.max_row else None
+
+    def chunks():
+        try:
+            rows = sheet.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                return
+            width = len(header)
+            buffer = []
+            for row in rows:
+                if all(value is None for value in row):
+                    continue
+                buffer.append(row[:width])
+                if len(buffer) >= chunk_rows:
+                    yield pd.DataFrame(buffer, columns=range(width))
+                    buffer = []
+            if buffer:
+                yield pd.DataFrame(buffer, columns=range(width))
+        finally:
+            workbook.close()
+
+    return chunks(), total
+
+
+def _frame_chunks(df, chunk_rows):
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start:start + chunk_rows]
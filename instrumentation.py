@@ -0,0 +1,190 @@
+"""Замеры горячих путей: таймеры, счётчики обращений к GitHub и профилирование
+
+Метрики собираются в RunMetrics текущего перезапуска (contextvar), поэтому
+сессии не смешиваются. Каждый замер пишется структурированной строкой JSON в
+логгер payment_system.perf (DEBUG), итог перезапуска - одной строкой (INFO).
+"""
+import contextvars
+import cProfile
+import functools
+import io
+import json
+import logging
+import marshal
+import pstats
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger('payment_system.perf')
+
+_current = contextvars.ContextVar('run_metrics', default=None)
+
+
+class RunMetrics:
+    """Метрики одного перезапуска: времена, запросы к API, трафик, лимит"""
+
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self.started = time.perf_counter()
+        self.timings = []
+        self.api_calls = 0
+        self.api_statuses = Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.rate_limit_remaining = None
+        self._lock = threading.Lock()
+
+    def add_timing(self, name, seconds):
+        with self._lock:
+            self.timings.append((name, seconds))
+
+    def add_api_call(self, method, status, sent, received, rate_limit_remaining):
+        with self._lock:
+            self.api_calls += 1
+            self.api_statuses[f"{method} {status}"] += 1
+            self.bytes_sent += sent
+            self.bytes_received += received
+            if rate_limit_remaining is not None:
+                self.rate_limit_remaining = rate_limit_remaining
+
+    def timing_table(self):
+        """Сводка по именам: число вызовов, суммарное и максимальное время"""
+        table = {}
+        with self._lock:
+            for name, seconds in self.timings:
+                calls, total, longest = table.get(name, (0, 0.0, 0.0))
+                table[name] = (calls + 1, total + seconds, max(longest, seconds))
+        return [
+            {'name': name, 'calls': calls, 'total_s': round(total, 4), 'max_s': round(longest, 4)}
+            for name, (calls, total, longest) in sorted(table.items(), key=lambda item: -item[1][1])
+        ]
+
+    def summary(self):
+        with self._lock:
+            return {
+                'event': 'run',
+                'run': self.run_id,
+                'seconds': round(time.perf_counter() - self.started, 4),
+                'api_calls': self.api_calls,
+                'api_statuses': dict(self.api_statuses),
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'rate_limit_remaining': self.rate_limit_remaining,
+            }
+
+
+def start_run(run_id):
+    """Начинает сбор метрик для текущего перезапуска"""
+    metrics = RunMetrics(run_id)
+    _current.set(metrics)
+    return metrics
+
+
+def finish_run(metrics):
+    """Пишет итоговую строку перезапуска и отключает сбор"""
+    if logger.isEnabledFor(logging.INFO):
+        summary = metrics.summary()
+        summary['timings'] = metrics.timing_table()
+        logger.info(json.dumps(summary, ensure_ascii=False))
+    _current.set(None)
+
+
+class timed:
+    """Декоратор и контекстный менеджер: замеряет время под заданным именем"""
+
+    def __init__(self, name):
+        self.name = name
+        self._starts = threading.local()
+
+    def __enter__(self):
+        self._starts.__dict__.setdefault('stack', []).append(time.perf_counter())
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self._starts.stack.pop()
+        record_timing(self.name, seconds)
+        return False
+
+    def __call__(self, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record_timing(self.name, time.perf_counter() - start)
+        return wrapper
+
+
+def record_timing(name, seconds):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add_timing(name, seconds)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(json.dumps({
+            'event': 'timing',
+            'run': metrics.run_id if metrics else None,
+            'name': name,
+            'seconds': round(seconds, 6),
+        }, ensure_ascii=False))
+
+
+def record_api_call(method, path, status, sent, received, seconds, rate_limit_remaining=None):
+    """Учитывает один HTTP-запрос к GitHub"""
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add_api_call(method, status, sent, received, rate_limit_remaining)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(json.dumps({
+            'event': 'api_call',
+            'run': metrics.run_id if metrics else None,
+            'method': method,
+            'path': path,
+            'status': status,
+            'bytes_sent': sent,
+            'bytes_received': received,
+            'seconds': round(seconds, 6),
+            'rate_limit_remaining': rate_limit_remaining,
+        }, ensure_ascii=False))
+
+
+def propagate(function):
+    """Оборачивает функцию для пула потоков, сохраняя метрики текущего перезапуска"""
+    metrics = _current.get()
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        token = _current.set(metrics)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _current.reset(token)
+    return wrapper
+
+
+def profile(function, report, limit=30):
+    """Выполняет функцию под cProfile и заполняет report: топ функций и данные .prof
+
+    Отчёт заполняется и тогда, когда функция завершается исключением
+    (например, st.rerun()); исключение пробрасывается дальше.
+    """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function)
+    finally:
+        stream = io.StringIO()
+        stats = pstats.Stats(profiler, stream=stream)
+        stats.sort_stats('cumulative').print_stats(limit)
+        report['text'] = stream.getvalue()
+        report['raw'] = marshal.dumps(stats.stats)
+
+
+def configure_logging(level='INFO'):
+    """Выводит строки payment_system.perf в stderr, если обработчик не настроен"""
+    logger.setLevel(level)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(message)s'))
+        logger.addHandler(handler)
+        logger.propagate = False
@@ -0,0 +1,150 @@
+"""Локальный журнал предзаписи оплат (JSONL, только дописывание)
+
+"Отметить как оплаченные" сначала дописывает записи в журнал на диске и
+сразу возвращается; фоновая отправка объединяет накопившиеся записи в
+один сегмент хранилища. Журнал переживает обрыв сети и перезапуск:
+при открытии он перечитывается, и неотправленные записи отправляются снова.
+
+Строки журнала:
+    {"op": "entry", "id": ..., "records": [...], "created": ...}  - новые оплаты
+    {"op": "batch", "path": ..., "ids": [...]}  - начата отправка записей сегментом path
+    {"op": "flushed", "path": ...}  - сегмент path записан и внесён в манифест
+    {"op": "discard", "ids": [...]}  - записи отменены (очистка истории)
+
+Отправка идемпотентна: путь сегмента фиксируется строкой batch до записи,
+поэтому после сбоя та же пачка дописывается под тем же путём, а манифест
+с этим путём повторно не меняется.
+"""
+import json
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+
+DEFAULT_JOURNAL_DIR = '.journal'
+
+logger = logging.getLogger('payment_system.journal')
+
+
+class PaymentJournal:
+    """Журнал неотправленных оплат одного хранилища"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._batches = OrderedDict()
+        self._replay()
+
+    def append(self, records):
+        """Дописывает записи на диск (с fsync) и возвращает id записи журнала"""
+        entry_id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        with self._lock:
+            self._write({'op': 'entry', 'id': entry_id, 'records': records,
+                         'created': datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
+            self._entries[entry_id] = records
+        return entry_id
+
+    def pending(self):
+        """Неотправленные записи [(id, records)] в порядке добавления, включая начатые пачки"""
+        with self._lock:
+            return list(self._entries.items())
+
+    def open_batches(self):
+        """Начатые, но не завершённые отправки [(path, ids)] - их нужно довести до конца"""
+        with self._lock:
+            return list(self._batches.items())
+
+    def snapshot(self):
+        """(неотправленные записи [(id, records)], начатые отправки {path: ids}) одним срезом"""
+        with self._lock:
+            return list(self._entries.items()), dict(self._batches)
+
+    def unbatched(self):
+        """Записи, ещё не включённые ни в одну отправку"""
+        with self._lock:
+            batched = {entry_id for ids in self._batches.values() for entry_id in ids}
+            return [(entry_id, records) for entry_id, records in self._entries.items() if entry_id not in batched]
+
+    def records(self, ids):
+        with self._lock:
+            return [record for entry_id in ids for record in self._entries.get(entry_id, [])]
+
+    def begin_batch(self, path, ids):
+        with self._lock:
+            self._write({'op': 'batch', 'path': path, 'ids': list(ids)})
+            self._batches[path] = list(ids)
+
+    def complete_batch(self, path):
+        with self._lock:
+            self._write({'op': 'flushed', 'path': path})
+            for entry_id in self._batches.pop(path, []):
+                self._entries.pop(entry_id, None)
+            self._compact()
+
+    def discard(self, ids):
+        """Отменяет неотправленные записи (например, при очистке истории)"""
+        with self._lock:
+            self._write({'op': 'discard', 'ids': list(ids)})
+            for entry_id in ids:
+                self._entries.pop(entry_id, None)
+            for path, batch_ids in list(self._batches.items()):
+                if set(batch_ids) <= set(ids):
+                    del self._batches[path]
+            self._compact()
+
+    def _replay(self):
+        if not self.path.exists():
+            return
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        complete = data.rfind(b'\n') + 1
+        if complete < len(data):
+            # Оборванная последняя строка: запись не была подтверждена, новые строки пойдут после неё
+            logger.warning("отброшена незавершённая запись журнала %s", self.path)
+            with open(self.path, 'r+b') as f:
+                f.truncate(complete)
+        for line in data[:complete].decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                logger.warning("пропущена повреждённая строка журнала %s", self.path)
+                continue
+            op = item.get('op')
+            if op == 'entry':
+                self._entries[item['id']] = item['records']
+            elif op == 'batch':
+                self._batches[item['path']] = item['ids']
+            elif op == 'flushed':
+                for entry_id in self._batches.pop(item['path'], []):
+                    self._entries.pop(entry_id, None)
+            elif op == 'discard':
+                for entry_id in item['ids']:
+                    self._entries.pop(entry_id, None)
+        for path, ids in list(self._batches.items()):
+            if not any(entry_id in self._entries for entry_id in ids):
+                del self._batches[path]
+        if self._entries:
+            logger.info("в журнале %s найдено неотправленных записей: %d", self.path, len(self._entries))
+        with self._lock:
+            self._compact()
+
+    def _write(self, item):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(item, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _compact(self):
+        """Когда всё отправлено, журнал обнуляется, чтобы не расти бесконечно"""
+        if self._entries or self._batches or not self.path.exists():
+            return
+        temporary = self.path.with_suffix('.tmp')
+        open(temporary, 'w').close()
+        os.replace(temporary, self.path)
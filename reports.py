@@ -0,0 +1,123 @@
+"""Отчёты и экспорт истории: сборка по требованию с кэшем по отпечатку данных"""
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+from history_model import as_strings
+from instrumentation import timed
+
+CHUNK_ROWS = 10000
+CACHE_SIZE = 8
+EXCEL_MAX_ROWS = 1048575
+
+EXPORT_FORMATS = {
+    'xlsx': ('Excel', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'csv': ('CSV', 'text/csv'),
+    'jsonl': ('JSONL', 'application/x-ndjson'),
+}
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def frames_fingerprint(*frames):
+    """Отпечаток содержимого таблиц: одинаковые данные - одинаковый отчёт"""
+    digest = hashlib.sha256()
+    for df in frames:
+        digest.update(repr(list(df.columns)).encode('utf-8'))
+        if not df.empty:
+            digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+        digest.update(b'|')
+    return digest.hexdigest()
+
+
+def payment_report(visits_to_pay, exact_duplicates, same_visit_different_date, suspicious_same_date,
+                   similar_names=None, upload_repeats=None, date_errors=None):
+    """Полный отчёт (К оплате, Сводка, дубликаты) в xlsx; кэшируется по входным данным"""
+    if similar_names is None:
+        similar_names = pd.DataFrame()
+    if upload_repeats is None:
+        upload_repeats = pd.DataFrame()
+    if date_errors is None:
+        date_errors = pd.DataFrame()
+    frames = (visits_to_pay, exact_duplicates, same_visit_different_date, suspicious_same_date,
+              similar_names, upload_repeats, date_errors)
+    key = ('payment_report', frames_fingerprint(*frames))
+    return _memoized(key, lambda: build_payment_report(*frames))
+
+
+def history_export(paid_visits, fmt='xlsx', version=None, filters=None):
+    """Экспорт истории (или выборки по filters) в xlsx, csv или jsonl; кэшируется по версии и условиям"""
+    key = ('history', version or frames_fingerprint(paid_visits), fmt, tuple(sorted((filters or {}).items())))
+    return _memoized(key, lambda: build_history_export(paid_visits, fmt))
+
+
+@timed('report.payment')
+def build_payment_report(visits_to_pay, exact_duplicates, same_visit_different_date, suspicious_same_date,
+                         similar_names=None, upload_repeats=None, date_errors=None):
+    summary = visits_to_pay.groupby('subject_id').size().reset_index(name='количество_визитов')
+    sheets = [
+        ('К оплате', visits_to_pay),
+        ('Сводка', summary),
+        ('Точные дубликаты', exact_duplicates),
+        ('Тот же тип визита', same_visit_different_date),
+        ('Подозрительные', suspicious_same_date),
+        ('Похожие названия', similar_names if similar_names is not None else pd.DataFrame()),
+        ('Повторы в загрузке', upload_repeats if upload_repeats is not None else pd.DataFrame()),
+        ('Нераспознанные даты', date_errors if date_errors is not None else pd.DataFrame()),
+    ]
+    # Как и раньше, в отчёт попадают только непустые листы (кроме "К оплате"); даты - строками "YYYY-MM-DD"
+    return write_xlsx([(title, as_strings(df)) for title, df in sheets if title == 'К оплате' or not df.empty])
+
+
+@timed('report.history')
+def build_history_export(paid_visits, fmt='xlsx'):
+    # В файле даты остаются строками "YYYY-MM-DD", как в хранилище
+    paid_visits = as_strings(paid_visits)
+    if fmt == 'xlsx':
+        if len(paid_visits) > EXCEL_MAX_ROWS:
+            raise ValueError("история не помещается на лист Excel, выберите CSV или JSONL")
+        return write_xlsx([('Sheet1', paid_visits)])
+    if fmt == 'csv':
+        # utf-8-sig, чтобы Excel правильно показал кириллицу
+        return paid_visits.to_csv(index=False).encode('utf-8-sig')
+    if fmt == 'jsonl':
+        return paid_visits.to_json(orient='records', lines=True, force_ascii=False).encode('utf-8')
+    raise ValueError(f"неизвестный формат экспорта: {fmt}")
+
+
+def write_xlsx(sheets):
+    """Записывает листы в xlsx в режиме write_only (потоково, без модели ячеек в памяти)"""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    for title, df in sheets:
+        sheet = workbook.create_sheet(title)
+        sheet.append([str(column) for column in df.columns])
+        for start in range(0, len(df), CHUNK_ROWS):
+            chunk = df.iloc[start:start + CHUNK_ROWS].astype(object)
+            chunk = chunk.where(chunk.notna(), None)
+            for row in chunk.itertuples(index=False, name=None):
+                sheet.append(row)
+
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def _memoized(key, build):
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    data = build()
+
+    with _cache_lock:
+        _cache[key] = data
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return data
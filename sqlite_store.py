@@ -0,0 +1,262 @@
+"""Хранилище истории оплат в локальной базе SQLite
+
+Записи лежат в одной таблице с индексами по ключам сравнения, поэтому
+проверка загрузки читает только записи её субъектов, а не всю историю:
+все три вида дубликатов и похожие названия определяются записями того же
+субъекта. Сводка строится агрегатными запросами; полная таблица читается
+только для показа и экспорта истории и дальше дополняется новыми строками.
+"""
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+import pandas as pd
+
+from github_cache import HISTORY_COLUMNS
+from history_model import as_strings, compact_history, concat_history, empty_history, memory_report
+from history_query import day_text
+from history_stats import RECENT_PAYMENTS, HistoryStats
+from instrumentation import timed
+from storage import HistoryStore
+from visit_index import MISSING_KEY, VisitIndex, key_text
+
+DEFAULT_SQLITE_PATH = "data/payments.sqlite3"
+# Сколько секунд ждать, пока другой процесс держит блокировку записи
+BUSY_TIMEOUT = 30.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS payments (
+    id INTEGER PRIMARY KEY,
+    subject_id TEXT,
+    visit_name TEXT,
+    visit_date TEXT,
+    payment_date TEXT,
+    payment_amount REAL
+);
+CREATE INDEX IF NOT EXISTS payments_visit ON payments (subject_id, visit_name, visit_date);
+CREATE INDEX IF NOT EXISTS payments_subject_date ON payments (subject_id, visit_date);
+CREATE INDEX IF NOT EXISTS payments_payment_date ON payments (payment_date);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+INSERT OR IGNORE INTO meta VALUES ('generation', 0);
+"""
+COLUMNS = ', '.join(HISTORY_COLUMNS)
+
+
+class SQLitePaymentStore(HistoryStore):
+    """История оплат в файле SQLite (один файл на процесс и на все сессии)"""
+
+    backend_name = 'SQLite'
+
+    def __init__(self, path=DEFAULT_SQLITE_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._df = None
+        self._df_state = None
+        self._stats = None
+        self._stats_state = None
+        with self._connect() as connection:
+            # WAL: чтение не ждёт записи из другой сессии или процесса
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _state(self, connection):
+        """(поколение, последний id): поколение растёт при очистке, id - при записи"""
+        generation = connection.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+        last_id = connection.execute("SELECT COALESCE(MAX(id), 0) FROM payments").fetchone()[0]
+        return generation, last_id
+
+    @staticmethod
+    def _version(state):
+        return f"sqlite:{state[0]}:{state[1]}"
+
+    @staticmethod
+    def _read(connection, where='', params=()):
+        df = pd.read_sql_query(f"SELECT {COLUMNS} FROM payments {where} ORDER BY id", connection, params=params)
+        return compact_history(df)
+
+    # Чтение
+
+    @timed('history.load')
+    def load(self, run_id=None):
+        """Возвращает (DataFrame истории, версия); после записи дочитываются только новые строки"""
+        with self._lock, self._connect() as connection:
+            state = self._state(connection)
+            if self._df is None or self._df_state[0] != state[0] or self._df_state[1] > state[1]:
+                self._df, self._df_state = empty_history(), (state[0], 0)
+            if state[1] > self._df_state[1]:
+                added = self._read(connection, "WHERE id > ? AND id <= ?", (self._df_state[1], state[1]))
+                self._df = concat_history([self._df, added])
+                self._df_state = state
+            return self._df.copy(deep=False), self._version(state)
+
+    @timed('history.index')
+    def load_index(self, run_id=None):
+        """Проверка дубликатов запросами по субъектам загрузки"""
+        return SQLiteVisitLookup(self)
+
+    @timed('history.stats')
+    def load_stats(self, run_id=None):
+        """Сводка истории агрегатными запросами; после записи дополняется новыми строками"""
+        with self._lock, self._connect() as connection:
+            # Одна читающая транзакция: состояние и агрегаты - из одного снимка базы
+            connection.execute("BEGIN")
+            state = self._state(connection)
+            if self._stats is None or self._stats_state[0] != state[0] or self._stats_state[1] > state[1]:
+                self._stats = self._summary(connection)
+            elif state[1] > self._stats_state[1]:
+                self._stats.add_frame(self._read(connection, "WHERE id > ? AND id <= ?", (self._stats_state[1], state[1])))
+            self._stats_state = state
+            return self._stats
+
+    def _summary(self, connection):
+        rows = connection.execute("SELECT COUNT(*) FROM payments").fetchone()[0]
+        subjects = [row[0] for row in connection.execute(
+            "SELECT DISTINCT subject_id FROM payments WHERE subject_id IS NOT NULL")]
+        visit_names = [row[0] for row in connection.execute(
+            "SELECT DISTINCT visit_name FROM payments WHERE visit_name IS NOT NULL")]
+        # Обратный проход по индексу payment_date читает только последние строки
+        # (NULL в SQLite меньше любой даты, поэтому пропуски идут последними);
+        # при равной дате выше записанная позже
+        recent = compact_history(pd.read_sql_query(
+            f"SELECT {COLUMNS} FROM payments ORDER BY payment_date DESC, id DESC LIMIT ?",
+            connection, params=(RECENT_PAYMENTS,)
+        ))
+        return HistoryStats.from_summary(rows, subjects, visit_names, recent)
+
+    @timed('history.query')
+    def query(self, run_id=None, payment_from=None, payment_to=None, visit_from=None, visit_to=None,
+              subject_prefix=None, visit_name=None):
+        """Выборка истории запросом по индексам (даты, ID субъекта, визит) и версия"""
+        clauses, params = [], []
+        for column, start, end in (('payment_date', payment_from, payment_to), ('visit_date', visit_from, visit_to)):
+            # Даты хранятся строками "YYYY-MM-DD", их порядок совпадает с порядком дат
+            if start is not None:
+                clauses.append(f"{column} >= ?")
+                params.append(day_text(start))
+            if end is not None:
+                clauses.append(f"{column} <= ?")
+                params.append(day_text(end))
+        if subject_prefix:
+            # Диапазон вместо LIKE: его SQLite ищет по индексу на subject_id
+            clauses.append("subject_id >= ? AND subject_id < ?")
+            params += [subject_prefix, subject_prefix[:-1] + chr(ord(subject_prefix[-1]) + 1)]
+        if visit_name:
+            clauses.append("visit_name = ?")
+            params.append(visit_name)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        with self._connect() as connection:
+            connection.execute("BEGIN")
+            return self._read(connection, where, params), self._version(self._state(connection))
+
+    @timed('history.subject_rows')
+    def subject_rows(self, subjects):
+        """Записи истории указанных субъектов в порядке записи
+
+        Пропущенный ID (NULL) считается субъектом "nan", как в VisitIndex:
+        такие записи читаются, если "nan" есть среди субъектов.
+        """
+        columns = ', '.join('p.' + column for column in HISTORY_COLUMNS)
+        # CROSS JOIN фиксирует порядок: перебираем субъекты загрузки и ищем их по индексу
+        query = (f"SELECT p.id, {columns} "
+                 "FROM upload_subjects AS u CROSS JOIN payments AS p ON p.subject_id = u.subject_id")
+        if MISSING_KEY in subjects:
+            query += f" UNION ALL SELECT p.id, {columns} FROM payments AS p WHERE p.subject_id IS NULL"
+        with self._connect() as connection:
+            connection.execute("CREATE TEMP TABLE upload_subjects (subject_id TEXT PRIMARY KEY)")
+            connection.executemany("INSERT OR IGNORE INTO upload_subjects VALUES (?)", ((s,) for s in subjects))
+            rows = pd.read_sql_query(f"{query} ORDER BY id", connection)
+        return compact_history(rows.drop(columns='id'))
+
+    def count(self, run_id=None):
+        with self._connect() as connection:
+            return connection.execute("SELECT COUNT(*) FROM payments").fetchone()[0]
+
+    def memory_report(self):
+        with self._lock:
+            df = self._df
+        return (memory_report(df) if df is not None else []), 0
+
+    # Запись
+
+    @timed('history.append')
+    def append(self, records):
+        """Дописывает записи одной транзакцией и возвращает новую версию"""
+        # Даты приводятся к "YYYY-MM-DD" (нераспознанные - NULL), как при чтении сегментов
+        rows = as_strings(compact_history(pd.DataFrame(records, columns=HISTORY_COLUMNS)))
+        rows = rows.astype(object).where(rows.notna(), None)
+        with self._connect() as connection:
+            connection.executemany(
+                f"INSERT INTO payments ({COLUMNS}) VALUES (?, ?, ?, ?, ?)",
+                rows.itertuples(index=False, name=None)
+            )
+            return self._version(self._state(connection))
+
+    @timed('history.clear')
+    def clear(self):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM payments")
+            connection.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+            return self._version(self._state(connection))
+
+    def migrate(self, source=None):
+        """Переносит историю из другого хранилища (например, GitHub), если база пуста"""
+        if source is not None and self.count() == 0:
+            df, _ = source.load()
+            if len(df):
+                return self.append(as_strings(df).to_dict('records'))
+        with self._connect() as connection:
+            return self._version(self._state(connection))
+
+
+class SQLiteVisitLookup:
+    """Проверка загрузки по SQLite с тем же интерфейсом, что у VisitIndex
+
+    По записям субъектов загрузки строится небольшой VisitIndex, поэтому
+    результат совпадает с индексом по всей истории.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._index = None
+        self._subjects = frozenset()
+
+    def classify(self, uploaded_df):
+        return self._index_for(uploaded_df).classify(uploaded_df)
+
+    def find_similar(self, new_visits):
+        return self._index_for(new_visits).find_similar(new_visits)
+
+    def _index_for(self, df):
+        # Ключи субъектов те же, что у VisitIndex.classify: пропуск - MISSING_KEY
+        subjects = frozenset(key_text(df['subject_id']).unique())
+        # find_similar получает часть той же загрузки - записи уже прочитаны
+        if self._index is None or not subjects <= self._subjects:
+            self._index = VisitIndex.from_frame(self.store.subject_rows(subjects))
+            self._subjects = subjects
+        return self._index
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_sqlite_store(path=DEFAULT_SQLITE_PATH):
+    """Возвращает общее для процесса хранилище для файла базы"""
+    key = str(Path(path).resolve())
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = SQLitePaymentStore(path)
+            _stores[key] = store
+        return store
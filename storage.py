@@ -0,0 +1,758 @@
+"""Хранилище истории оплат: неизменяемые сегменты JSONL и небольшой манифест
+
+Каждое сохранение записывает только новый сегмент и обновлённый манифест,
+поэтому стоимость "отметить как оплаченные" не зависит от размера истории.
+Старый монолитный data/payments.json читается, пока манифест не создан, и
+переносится в первый сегмент при первой записи (или вызовом migrate()).
+
+Хранилище одно на процесс (get_store), поэтому все сессии делят один снимок
+истории, индекс и сводку на версию манифеста: сборка выполняется одним
+потоком, а сохранение из любой сессии сразу продвигает версию для всех, и
+при следующем чтении к снимку дописываются только новые сегменты из кэша.
+
+С локальным журналом (attach_journal) "отметить как оплаченные" только
+дописывает записи на диск, а фоновый поток отправляет накопившееся одним
+сегментом. Неотправленные записи входят в снимок, индекс и сводку как
+сегменты "journal:<id>", поэтому проверка дубликатов видит их сразу.
+
+prefetch() собирает индекс и сводку в фоновом потоке, пока страница уже
+показана; проверка загрузки, начатая раньше, ждёт ту же сборку.
+
+Сегменты закрытых месяцев сворачиваются в один сегмент <YYYY-MM>.jsonl на
+месяц (compact(), автоматически после записи в новом месяце), поэтому
+холодный старт скачивает примерно по сегменту на месяц, а не на каждое
+сохранение, и манифест не растёт без предела.
+"""
+import contextvars
+import io
+import json
+import logging
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+from github_cache import HISTORY_COLUMNS, GitHubFileCache
+from github_client import DEFAULT_API_URL, GitHubClient, ShaConflict, blob_sha
+from history_model import compact_history, concat_history, memory_report
+from history_query import DateIndex, query_history
+from history_stats import HistoryStats
+from instrumentation import propagate, timed
+from journal import PaymentJournal
+from visit_index import VisitIndex
+
+MANIFEST_PATH = "data/payments/manifest.json"
+SEGMENTS_DIR = "data/payments/segments"
+LEGACY_PATH = "data/payments.json"
+MANIFEST_FORMAT = 1
+MAX_CONFLICT_RETRIES = 8
+# Сколько секунд проверенная версия манифеста считается актуальной для всех сессий
+DEFAULT_MAX_AGE = 2.0
+# Сколько секунд фоновая отправка ждёт новых записей журнала, чтобы отправить их одним коммитом
+DEFAULT_FLUSH_DELAY = 2.0
+JOURNAL_PREFIX = 'journal:'
+# Месяц сегмента по пути внутри SEGMENTS_DIR: "<YYYY-MM>/<имя>.jsonl" или свёрнутый "<YYYY-MM>[.<sha>].jsonl"
+SEGMENT_MONTH = re.compile(r'(\d{4}-\d{2})[/.]')
+
+logger = logging.getLogger('payment_system.storage')
+
+# Фоновая предзагрузка истории (одна на хранилище; потоки общие для всех хранилищ)
+_prefetch_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='history-prefetch')
+_prefetch_lock = threading.Lock()
+
+
+class StorageError(Exception):
+    """Ошибка чтения или записи хранилища"""
+
+
+def records_to_jsonl(records):
+    """Сериализует записи в JSONL (одна запись на строку)"""
+    return ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+
+
+def jsonl_to_frame(text):
+    """Разбирает JSONL-сегмент в компактный DataFrame с колонками истории"""
+    records = [json.loads(line) for line in io.StringIO(text) if line.strip()]
+    return compact_history(pd.DataFrame(records, columns=HISTORY_COLUMNS))
+
+
+class _Derived:
+    """Структура по истории, которая дополняется новыми сегментами"""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.value = None
+        self.version = None
+        self.paths = None
+
+
+class HistoryStore:
+    """Общий интерфейс хранилищ истории оплат
+
+    Реализации: PaymentHistoryStore (GitHub, сегменты JSONL) и
+    SQLitePaymentStore (локальная база SQLite). Приложение и CLI пользуются
+    только этими методами:
+        load(run_id) -> (DataFrame истории, версия)
+        load_index(run_id) -> объект с classify() и find_similar(), как VisitIndex
+        load_stats(run_id) -> HistoryStats
+        query(run_id, **условия) -> (выборка истории, версия), см. history_query
+        count(run_id), append(records) -> версия, clear(), migrate()
+        prefetch(run_id) -> Future со сводкой (индекс и сводка собираются в фоне)
+    """
+
+    backend_name = ''
+    journal = None
+    _prefetch = None
+
+    def prefetch(self, run_id=None):
+        """Запускает фоновую сборку индекса и сводки и возвращает Future со сводкой
+
+        Пока предыдущая предзагрузка не закончилась, возвращается она же, а не
+        новая. Сборка в хранилище однопоточная, поэтому load_index() и
+        load_stats(), вызванные до окончания предзагрузки, ждут её и получают
+        готовый результат, не скачивая историю второй раз.
+        """
+        with _prefetch_lock:
+            if self._prefetch is None or self._prefetch.done():
+                # Контекст перезапуска копируется: замеры предзагрузки идут в его метрики и
+                # строки DEBUG с его run, даже если сам перезапуск уже закончился
+                self._prefetch = _prefetch_pool.submit(contextvars.copy_context().run, self._warm, run_id)
+            return self._prefetch
+
+    def _warm(self, run_id):
+        self.load_index(run_id)
+        return self.load_stats(run_id)
+
+    def flush(self):
+        """Отправляет отложенные записи; у хранилищ без журнала их нет"""
+        return None
+
+    def compact(self, now=None):
+        """Сворачивает историю закрытых месяцев; у хранилищ без сегментов сворачивать нечего"""
+        return None
+
+    def journal_status(self):
+        return {'pending_entries': 0, 'pending_rows': 0, 'error': None, 'last_flush': None}
+
+    def memory_report(self):
+        return [], 0
+
+
+class PaymentHistoryStore(HistoryStore):
+    """История оплат в репозитории GitHub в виде манифеста и сегментов"""
+
+    backend_name = 'GitHub'
+
+    def __init__(self, client, manifest_path=MANIFEST_PATH,
+                 segments_dir=SEGMENTS_DIR, legacy_path=LEGACY_PATH, max_age=DEFAULT_MAX_AGE):
+        self.client = client
+        self.manifest_path = manifest_path
+        self.segments_dir = segments_dir
+        self.legacy_path = legacy_path
+        self.manifest_cache = GitHubFileCache(client, manifest_path, max_age=max_age)
+        self.legacy_cache = GitHubFileCache(client, legacy_path, max_age=max_age)
+        self._lock = threading.Lock()
+        # Сборка снимка (скачивание сегментов, склейка, индекс) - одна на хранилище
+        self._build_lock = threading.Lock()
+        self._segments = {}
+        self._df = None
+        self._df_version = None
+        self._df_paths = None
+        # Ряд снимков: растёт при сборке снимка заново, а не дописыванием к прежнему
+        self._df_lineage = 0
+        self._dates = None
+        self._dates_lineage = None
+        self._derived = {'index': _Derived(VisitIndex), 'stats': _Derived(HistoryStats)}
+        # Манифест уже читался или записывался: к старому файлу больше не возвращаемся
+        self._manifest_seen = False
+        self.journal = None
+        self.flush_delay = DEFAULT_FLUSH_DELAY
+        self.flush_error = None
+        self.last_flush = None
+        # Отправка журнала и очистка истории не должны пересекаться
+        self._flush_lock = threading.Lock()
+        self._flush_wakeup = threading.Condition()
+        self._flusher = None
+
+    # Чтение
+
+    @timed('history.load')
+    def load(self, run_id=None):
+        """Возвращает (DataFrame истории, версия хранилища)"""
+        manifest, sha, pending = self._current(run_id)
+        if sha is None:
+            return self._load_legacy(run_id)
+
+        version = self._version(sha, pending)
+        with self._lock:
+            if self._df_version == version:
+                return self._df.copy(deep=False), version
+
+        # Параллельные сессии ждут одну сборку и получают готовый снимок
+        with self._build_lock:
+            # Пока ждали, пачка журнала могла уйти в манифест: журнал и манифест читаются заново
+            manifest, sha, pending = self._current(run_id)
+            if sha is not None:
+                version = self._version(sha, pending)
+                with self._lock:
+                    if self._df_version == version:
+                        return self._df.copy(deep=False), version
+
+                paths = [segment['path'] for segment in manifest['segments']] + pending
+                self._fetch_segments(paths)
+
+                with self._lock:
+                    self._build_frame(paths, version)
+                    return self._df.copy(deep=False), version
+        return self._load_legacy(run_id)
+
+    @timed('history.query')
+    def query(self, run_id=None, **filters):
+        """Выборка истории по периоду, центру и визиту и версия хранилища
+
+        Индекс дат (DateIndex) строится один раз на ряд снимков и дополняется
+        строками, дописанными к снимку, поэтому выборка за месяц не
+        перебирает всю историю.
+        """
+        df, version = self.load(run_id)
+        if not any(filters.get(key) is not None for key in ('payment_from', 'payment_to', 'visit_from', 'visit_to')):
+            return query_history(df, **filters), version
+
+        with self._build_lock:
+            with self._lock:
+                lineage = self._df_lineage if self._df_version == version else None
+            if lineage is None:
+                # Снимок уже сменился: индекс для этой выборки не кэшируем
+                dates = DateIndex.from_frame(df)
+            else:
+                if self._dates is None or self._dates_lineage != lineage or self._dates.rows > len(df):
+                    self._dates, self._dates_lineage = DateIndex.from_frame(df), lineage
+                elif self._dates.rows < len(df):
+                    self._dates.add_frame(df.iloc[self._dates.rows:])
+                dates = self._dates
+        return query_history(df, dates, **filters), version
+
+    @timed('history.index')
+    def load_index(self, run_id=None):
+        """Возвращает индекс дубликатов для текущей версии хранилища"""
+        return self._load_derived('index', run_id)
+
+    @timed('history.stats')
+    def load_stats(self, run_id=None):
+        """Возвращает сводку истории (счётчики, последние оплаты) для текущей версии"""
+        return self._load_derived('stats', run_id)
+
+    def _load_derived(self, name, run_id):
+        """Структура по истории (индекс или сводка) для текущей версии хранилища
+
+        Сегменты неизменяемы, поэтому при новой версии в структуру добавляются
+        только ещё не учтённые сегменты; полная перестройка нужна лишь после
+        очистки истории или для старого монолитного файла.
+        """
+        derived = self._derived[name]
+        manifest, sha, pending = self._current(run_id)
+        if sha is not None:
+            version = self._version(sha, pending)
+            with self._lock:
+                if derived.version == version:
+                    return derived.value
+
+            with self._build_lock:
+                manifest, sha, pending = self._current(run_id)
+                if sha is not None:
+                    version = self._version(sha, pending)
+                    with self._lock:
+                        if derived.version == version:
+                            return derived.value
+
+                    paths = [segment['path'] for segment in manifest['segments']] + pending
+                    self._fetch_segments(paths)
+
+                    with self._lock:
+                        if derived.paths is None or not derived.paths.issubset(paths):
+                            derived.value = derived.factory()
+                            derived.paths = set()
+                        for path in paths:
+                            if path not in derived.paths:
+                                derived.value.add_frame(self._segments[path])
+                                derived.paths.add(path)
+                        derived.version = version
+                        return derived.value
+
+        df, version = self.load(run_id)
+        with self._build_lock, self._lock:
+            if derived.value is None or derived.version != version or derived.paths is not None:
+                derived.value = derived.factory.from_frame(df)
+                derived.version = version
+                derived.paths = None
+            return derived.value
+
+    def count(self, run_id=None):
+        """Число записей в истории; для манифеста сегменты не скачиваются"""
+        manifest, sha = self._get_manifest(run_id)
+        pending = sum(len(records) for _, records in self.journal.pending()) if self.journal else 0
+        if sha is None:
+            data, _ = self.legacy_cache.get(run_id)
+            return len(data) + pending
+        return sum(segment['rows'] for segment in manifest['segments']) + pending
+
+    def _get_manifest(self, run_id=None):
+        """(манифест, sha); sha None - манифеста ещё нет (404) и действует старый файл
+
+        Старый файл читается, только пока манифест ни разу не встречался: если
+        манифест пропал после этого, это ошибка, а не возврат к data/payments.json
+        с давно устаревшей историей.
+        """
+        manifest, sha = self.manifest_cache.get(run_id)
+        with self._lock:
+            if sha is not None:
+                self._manifest_seen = True
+                return manifest, sha
+            seen = self._manifest_seen
+        if seen:
+            raise StorageError(f"манифест {self.manifest_path} не найден, хотя уже был прочитан")
+        return manifest, sha
+
+    def _current(self, run_id=None):
+        """(манифест, sha, псевдосегменты журнала) согласованным срезом
+
+        Журнал читается раньше манифеста: пачка уходит из журнала только после
+        записи манифеста с её сегментом, поэтому оплата попадает хотя бы в один
+        из двух срезов и не теряется между ними. Если пачка уже есть в обоих,
+        её записи берутся из сегмента, а псевдосегменты отбрасываются.
+        """
+        entries, batches = self.journal.snapshot() if self.journal is not None else ([], {})
+        manifest, sha = self._get_manifest(run_id)
+        if sha is not None and batches:
+            listed = {segment['path'] for segment in manifest['segments']}
+            flushed = {entry_id for path, ids in batches.items() if path in listed for entry_id in ids}
+            entries = [(entry_id, records) for entry_id, records in entries if entry_id not in flushed]
+        return manifest, sha, [JOURNAL_PREFIX + entry_id for entry_id, _ in entries]
+
+    def _load_legacy(self, run_id):
+        """Снимок старого монолитного файла; приводится к компактным типам раз на версию"""
+        data, legacy_sha = self.legacy_cache.get(run_id)
+        with self._build_lock:
+            pending = self._pending_paths()
+            version = self._version(f"legacy:{legacy_sha}" if legacy_sha else None, pending)
+            with self._lock:
+                if self._df is not None and self._df_version == version and self._df_paths is None:
+                    return self._df.copy(deep=False), version
+            self._fetch_segments(pending)
+            with self._lock:
+                frames = [self._segments[path] for path in pending]
+            df = concat_history([compact_history(pd.DataFrame(data or [], columns=HISTORY_COLUMNS))] + frames)
+            with self._lock:
+                self._df, self._df_version, self._df_paths = df, version, None
+                self._df_lineage += 1
+                return df.copy(deep=False), version
+
+    def memory_report(self):
+        """Память текущего снимка истории по столбцам и кэша сегментов"""
+        with self._lock:
+            df = self._df
+            segments = list(self._segments.values())
+        report = memory_report(df) if df is not None else []
+        cached = sum(int(frame.memory_usage(index=False, deep=True).sum()) for frame in segments)
+        return report, cached
+
+    def _build_frame(self, paths, version):
+        """Собирает DataFrame версии; к прежнему снимку дописываются только новые сегменты"""
+        previous = self._df_paths
+        if previous is not None and paths[:len(previous)] == previous:
+            frames = [self._df] + [self._segments[path] for path in paths[len(previous):]]
+        else:
+            frames = [self._segments[path] for path in paths]
+            self._df_lineage += 1
+        self._df, self._df_version, self._df_paths = concat_history(frames), version, paths
+
+    def _pending_paths(self):
+        """Неотправленные записи журнала как псевдосегменты "journal:<id>" (по порядку)"""
+        if self.journal is None:
+            return []
+        return [JOURNAL_PREFIX + entry_id for entry_id, _ in self.journal.pending()]
+
+    @staticmethod
+    def _version(base, pending):
+        """Версия снимка: sha манифеста плюс последняя неотправленная запись журнала"""
+        return f"{base}+{pending[-1]}" if pending else base
+
+    def _fetch_segments(self, paths):
+        """Скачивает отсутствующие в кэше сегменты; сегменты неизменяемы"""
+        with self._lock:
+            missing = [path for path in paths if path not in self._segments]
+        if not missing:
+            return
+
+        # Записи журнала берутся с диска, а не из репозитория
+        local = [path for path in missing if path.startswith(JOURNAL_PREFIX)]
+        if local:
+            frames = [self._journal_frame(path) for path in local]
+            with self._lock:
+                self._segments.update(zip(local, frames))
+            missing = [path for path in missing if path not in local]
+            if not missing:
+                return
+
+        with ThreadPoolExecutor(max_workers=min(8, len(missing))) as pool:
+            frames = list(pool.map(propagate(self._get_segment), missing))
+
+        with self._lock:
+            self._segments.update(zip(missing, frames))
+
+    def _journal_frame(self, path):
+        records = self.journal.records([path[len(JOURNAL_PREFIX):]])
+        return compact_history(pd.DataFrame(records, columns=HISTORY_COLUMNS))
+
+    def _get_segment(self, path):
+        return jsonl_to_frame(self.client.get_raw(path).decode('utf-8'))
+
+    # Запись
+
+    @timed('history.append')
+    def append(self, records):
+        """Дописывает записи новым сегментом и обновляет манифест
+
+        Сегмент пишется один раз под уникальным именем. Если манифест успел
+        изменить кто-то другой (конфликт sha), манифест перечитывается, наш
+        сегмент добавляется к свежему списку и запись повторяется, поэтому
+        одновременные сохранения не теряют данные друг друга.
+        """
+        segment = self._write_segment(records)
+        sha = self._update_manifest(lambda segments: segments + [segment], segment['path'])
+        self._compact_after_write()
+        return sha
+
+    @timed('history.compact')
+    def compact(self, now=None):
+        """Сворачивает сегменты каждого закрытого месяца в один сегмент <YYYY-MM>.jsonl
+
+        Сворачиваются месяцы раньше текущего, в которых больше одного сегмента.
+        Содержимое склеивается из сегментов как есть, в порядке манифеста, и
+        заменяет их в манифесте одной записью. Прежние файлы не удаляются:
+        сессии со старой версией манифеста ещё могут их читать. Возвращает
+        версию манифеста или None, если сворачивать нечего.
+        """
+        manifest, sha = self._get_manifest()
+        if sha is None:
+            return None
+        for month, segments in self._closed_months(manifest['segments'], now).items():
+            sha = self._fold_month(month, segments)
+        return sha
+
+    def _compact_after_write(self):
+        """Сворачивает закрытые месяцы, если только что записанный манифест их содержит
+
+        Проверка идёт по манифесту в кэше, без запроса; ошибка сворачивания не
+        отменяет уже выполненное сохранение и повторится после следующего.
+        """
+        manifest, sha = self.manifest_cache.peek()
+        if sha is None or not self._closed_months(manifest['segments']):
+            return
+        try:
+            self.compact()
+        except Exception as error:
+            logger.warning("не удалось свернуть сегменты закрытых месяцев: %s", error)
+
+    def _closed_months(self, segments, now=None):
+        """{месяц: сегменты} для закрытых месяцев, в которых больше одного сегмента"""
+        current = (now or datetime.now()).strftime('%Y-%m')
+        prefix = self.segments_dir + '/'
+        months = {}
+        for segment in segments:
+            path = segment['path']
+            match = SEGMENT_MONTH.match(path[len(prefix):]) if path.startswith(prefix) else None
+            if match and match.group(1) < current:
+                months.setdefault(match.group(1), []).append(segment)
+        return {month: folded for month, folded in months.items() if len(folded) > 1}
+
+    def _fold_month(self, month, segments):
+        """Записывает сегменты месяца одним файлом и заменяет их им в манифесте"""
+        paths = [segment['path'] for segment in segments]
+        with ThreadPoolExecutor(max_workers=min(8, len(paths))) as pool:
+            contents = list(pool.map(propagate(self.client.get_raw), paths))
+        raw = b''.join(content if content.endswith(b'\n') else content + b'\n' for content in contents if content)
+
+        with self._lock:
+            frames = [self._segments.get(path) for path in paths]
+        if any(frame is None for frame in frames):
+            frame = jsonl_to_frame(raw.decode('utf-8'))
+        else:
+            frame = concat_history(frames)
+        path = self._write_compacted(month, raw)
+        with self._lock:
+            self._segments[path] = frame
+        folded = {
+            'path': path,
+            'rows': sum(segment['rows'] for segment in segments),
+            'created': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        sha = self._update_manifest(lambda current: _fold_segments(current, paths, folded), path)
+
+        # Содержимое то же, поэтому индекс, сводка и снимок только переименовывают сегменты
+        with self._build_lock, self._lock:
+            for derived in self._derived.values():
+                if derived.paths is not None and derived.paths.issuperset(paths):
+                    derived.paths.difference_update(paths)
+                    derived.paths.add(path)
+            if self._df_paths is not None:
+                self._df_paths = _replace_run(self._df_paths, paths, path)
+            for name in paths:
+                self._segments.pop(name, None)
+        return sha
+
+    def _write_compacted(self, month, raw):
+        """Записывает свёрнутый месяц в <YYYY-MM>.jsonl и возвращает путь
+
+        Если такой файл уже есть с другим содержимым (месяц сворачивается
+        повторно из-за опоздавшей пачки журнала), используется имя с sha
+        содержимого; совпадение по такому имени означает то же содержимое.
+        """
+        path = f"{self.segments_dir}/{month}.jsonl"
+        try:
+            self.client.put_file(path, raw)
+            return path
+        except ShaConflict:
+            # Тот же месяц уже свернула другая сессия или наш повтор после потерянного ответа
+            if self.client.get_raw(path) == raw:
+                return path
+        path = f"{self.segments_dir}/{month}.{blob_sha(raw)[:8]}.jsonl"
+        try:
+            self.client.put_file(path, raw)
+        except ShaConflict:
+            pass
+        return path
+
+    @timed('history.clear')
+    def clear(self):
+        """Очищает историю: манифест без сегментов, старые файлы не трогаются
+
+        Неотправленные записи журнала отменяются, иначе фоновая отправка
+        вернула бы их в только что очищенную историю.
+        """
+        with self._flush_lock:
+            if self.journal is not None:
+                pending = self._pending_paths()
+                self.journal.discard([path[len(JOURNAL_PREFIX):] for path in pending])
+                with self._lock:
+                    for path in pending:
+                        self._segments.pop(path, None)
+            return self._update_manifest(lambda segments: [])
+
+    def migrate(self):
+        """Однократно переносит data/payments.json в первый сегмент"""
+        _, sha = self._get_manifest()
+        if sha is not None:
+            return sha
+        return self._update_manifest(lambda segments: segments)
+
+    # Журнал
+
+    def attach_journal(self, journal, flush_delay=DEFAULT_FLUSH_DELAY):
+        """Подключает локальный журнал и запускает фоновую отправку
+
+        Записи, оставшиеся в журнале после перезапуска, сразу видны проверке
+        дубликатов и отправляются первым же проходом.
+        """
+        with self._flush_wakeup:
+            if self.journal is not None:
+                return
+            self.journal = journal
+            self.flush_delay = flush_delay
+            self._flusher = threading.Thread(target=self._flush_loop, name='payment-journal-flush', daemon=True)
+            self._flusher.start()
+
+    @timed('history.enqueue')
+    def enqueue(self, records):
+        """Записывает оплаты в журнал и возвращается, не дожидаясь GitHub"""
+        entry_id = self.journal.append(records)
+        with self._flush_wakeup:
+            self._flush_wakeup.notify_all()
+        return entry_id
+
+    @timed('history.flush')
+    def flush(self):
+        """Отправляет все неотправленные записи журнала одним сегментом и возвращает версию"""
+        if self.journal is None:
+            return None
+        with self._flush_lock:
+            sha = None
+            # Сначала доводим пачки, прерванные сбоем: путь их сегмента уже в журнале
+            for path, ids in self.journal.open_batches():
+                sha = self._flush_batch(path, ids)
+            pending = self.journal.unbatched()
+            if pending:
+                ids = [entry_id for entry_id, _ in pending]
+                path = self._segment_path()
+                self.journal.begin_batch(path, ids)
+                sha = self._flush_batch(path, ids)
+        self.flush_error = None
+        self.last_flush = datetime.now()
+        self._compact_after_write()
+        return sha
+
+    def journal_status(self):
+        """Сколько записей ждёт отправки, последняя ошибка и время последней отправки"""
+        pending = self.journal.pending() if self.journal is not None else []
+        return {
+            'pending_entries': len(pending),
+            'pending_rows': sum(len(records) for _, records in pending),
+            'error': self.flush_error,
+            'last_flush': self.last_flush,
+        }
+
+    def _flush_batch(self, path, ids):
+        """Записывает пачку журнала сегментом path и вносит его в манифест (идемпотентно)"""
+        records = self.journal.records(ids)
+        segment = self._write_segment(records, path=path)
+        sha = self._update_manifest(lambda segments: segments + [segment], path)
+
+        # Псевдосегменты пачки заменяются настоящим сегментом без пересчёта индекса и сводки
+        pseudo = [JOURNAL_PREFIX + entry_id for entry_id in ids]
+        with self._build_lock, self._lock:
+            for derived in self._derived.values():
+                missing = [name for name in pseudo if name not in (derived.paths or ())]
+                # Пачка ещё не учтена совсем: сегмент добавится обычным путём при следующем чтении
+                if derived.paths is None or len(missing) == len(pseudo):
+                    continue
+                for name in missing:
+                    derived.value.add_frame(self._journal_frame(name))
+                derived.paths.difference_update(pseudo)
+                derived.paths.add(path)
+            if self._df_paths is not None:
+                self._df_paths = _replace_run(self._df_paths, pseudo, path)
+            for name in pseudo:
+                self._segments.pop(name, None)
+            self.journal.complete_batch(path)
+        return sha
+
+    def _flush_loop(self):
+        failures = 0
+        while True:
+            with self._flush_wakeup:
+                while not self.journal.pending():
+                    self._flush_wakeup.wait()
+            # Даём соседним сохранениям попасть в тот же коммит
+            time.sleep(self.flush_delay)
+            try:
+                self.flush()
+                failures = 0
+            except Exception as error:
+                # Записи остаются в журнале на диске; повторяем с нарастающей паузой
+                self.flush_error = str(error)
+                logger.warning("не удалось отправить журнал оплат: %s", error)
+                time.sleep(self.client.backoff_delay(failures))
+                failures += 1
+
+    def _update_manifest(self, change, expected_path=None):
+        """Читает манифест, применяет change к списку сегментов и записывает его"""
+        legacy_segments = None
+        for attempt in range(MAX_CONFLICT_RETRIES):
+            manifest, sha = self._get_manifest()
+            if sha is None:
+                # Манифеста ещё нет: переносим старый файл (один раз за вызов)
+                if legacy_segments is None:
+                    legacy_segments = self._legacy_segments()
+                segments = legacy_segments
+            else:
+                segments = manifest['segments']
+                # Повтор после обрыва соединения мог уже записать наш сегмент
+                if expected_path and any(segment['path'] == expected_path for segment in segments):
+                    return sha
+
+            new_manifest = {'format': MANIFEST_FORMAT, 'segments': change(list(segments))}
+            try:
+                return self._write_manifest(new_manifest, sha)
+            except ShaConflict:
+                # Разносим повторы конкурирующих сессий во времени
+                self.client.sleep(self.client.backoff_delay(attempt))
+        raise StorageError("не удалось обновить манифест: слишком много одновременных изменений")
+
+    def _legacy_segments(self):
+        """Записывает содержимое старого файла сегментом и возвращает список сегментов"""
+        legacy_data, _ = self.legacy_cache.get()
+        if not legacy_data:
+            return []
+        return [self._write_segment(legacy_data, name=f"legacy-{uuid.uuid4().hex[:8]}")]
+
+    def _segment_path(self, name=None):
+        now = datetime.now()
+        if name is None:
+            name = f"{now.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        return f"{self.segments_dir}/{now.strftime('%Y-%m')}/{name}.jsonl"
+
+    def _write_segment(self, records, name=None, path=None):
+        """Записывает сегмент под уникальным именем (или под путём из журнала)"""
+        now = datetime.now()
+        path = path or self._segment_path(name)
+        try:
+            self.client.put_file(path, records_to_jsonl(records).encode('utf-8'))
+        except ShaConflict:
+            # Путь уникален, поэтому существующий файл - наш: повтор PUT после потерянного
+            # ответа или прерванная отправка той же пачки журнала
+            pass
+
+        # Сегмент неизменяем: кладём его в кэш сразу, чтобы не скачивать обратно
+        with self._lock:
+            self._segments[path] = compact_history(pd.DataFrame(records, columns=HISTORY_COLUMNS))
+        return {'path': path, 'rows': len(records), 'created': now.strftime('%Y-%m-%d %H:%M:%S')}
+
+    def _write_manifest(self, manifest, sha):
+        raw = json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8')
+        new_sha = self.client.put_file(self.manifest_path, raw, sha)
+        self.manifest_cache.store(manifest, new_sha)
+        with self._lock:
+            self._manifest_seen = True
+        return new_sha
+
+
+def _fold_segments(segments, paths, folded):
+    """Заменяет сегменты paths одним folded на месте первого из них
+
+    Если какого-то из них в манифесте уже нет (месяц свернула другая сессия
+    или история очищена), список не меняется.
+    """
+    names = set(paths)
+    if not names.issubset(segment['path'] for segment in segments):
+        return segments
+    result = []
+    for segment in segments:
+        if segment['path'] not in names:
+            result.append(segment)
+        elif folded not in result:
+            result.append(folded)
+    return result
+
+
+def _replace_run(paths, run, replacement):
+    """Заменяет подряд идущие элементы run в списке одним replacement (если они есть)"""
+    for start in range(len(paths) - len(run) + 1):
+        if paths[start:start + len(run)] == run:
+            return paths[:start] + [replacement] + paths[start + len(run):]
+    return paths
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(token, owner, repo, api_url=DEFAULT_API_URL, max_age=DEFAULT_MAX_AGE,
+              journal_dir=None, flush_delay=DEFAULT_FLUSH_DELAY):
+    """Возвращает общее для процесса хранилище (и пул соединений) для репозитория
+
+    С journal_dir сохранения идут через локальный журнал <journal_dir>/<owner>__<repo>.jsonl.
+    """
+    key = (api_url, owner, repo, token)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = PaymentHistoryStore(GitHubClient(token, owner, repo, api_url=api_url), max_age=max_age)
+            _stores[key] = store
+        if journal_dir and store.journal is None:
+            store.attach_journal(PaymentJournal(Path(journal_dir) / f"{owner}__{repo}.jsonl"), flush_delay)
+        return store
@@ -0,0 +1,29 @@
+"""Модули приложения лежат в корне репозитория, а не в пакете; общий стенд GitHub для тестов"""
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.github_stub import GitHubStub  # noqa: E402
+from github_client import GitHubClient  # noqa: E402
+
+
+@pytest.fixture
+def stub():
+    """Локальный стенд GitHub Contents API; адрес - stub.api_url"""
+    stub = GitHubStub(seed=0)
+    stub.api_url = stub.start()
+    yield stub
+    stub.stop()
+
+
+@pytest.fixture
+def make_client(stub):
+    """Клиент стенда с короткими паузами между повторами"""
+    def make_client(**options):
+        options.setdefault('backoff', 0.001)
+        options.setdefault('max_backoff', 0.01)
+        return GitHubClient('token', 'owner', 'repo', api_url=stub.api_url, **options)
+    return make_client
@@ -0,0 +1,146 @@
+"""GitHubClient против стенда benchmarks.github_stub с включёнными отказами"""
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from github_client import GitHubError, ShaConflict, blob_sha
+
+PATH = 'data/file.json'
+
+
+class Sleeps(list):
+    """Вместо time.sleep: запоминает паузы и выполняет действие "пока ждали" """
+
+    def __init__(self, during=None):
+        super().__init__()
+        self.during = during
+
+    def __call__(self, seconds):
+        self.append(seconds)
+        if self.during is not None:
+            self.during()
+
+
+def put(stub, raw=b'{"a": 1}', path=PATH):
+    stub.put('owner', 'repo', path, raw)
+    return raw
+
+
+def test_get_file_is_conditional(stub, make_client):
+    raw = put(stub)
+    client = make_client()
+    status, content, etag = client.get_file(PATH)
+    assert (status, content) == (200, raw) and etag
+    assert blob_sha(content) == stub.get('owner', 'repo', PATH)[1]
+    assert client.get_file(PATH, etag) == (304, None, etag)
+    assert client.get_file('data/missing.json')[0] == 404
+
+
+def test_server_errors_are_retried_with_backoff(stub, make_client):
+    raw = put(stub)
+    stub.error_rate = 0.6
+    sleeps = Sleeps()
+    client = make_client(max_retries=20, backoff=0.5, max_backoff=4, sleep=sleeps)
+    for _ in range(10):
+        assert client.get_raw(PATH) == raw
+    assert len(sleeps) == stub.stats['injected_errors'] > 0
+    assert all(0.25 <= seconds <= 4 for seconds in sleeps)
+
+
+def test_retries_stop_at_the_cap(stub, make_client):
+    put(stub)
+    stub.error_rate = 1.0
+    sleeps = Sleeps()
+    client = make_client(max_retries=3, backoff=1, max_backoff=100, sleep=sleeps)
+    with pytest.raises(GitHubError) as error:
+        client.get_raw(PATH)
+    assert error.value.status in (500, 502, 503)
+    assert stub.stats['injected_errors'] == 4
+    # Экспоненциальная пауза с разбросом 0.5 ... 1.0 от 1, 2, 4 с
+    assert len(sleeps) == 3
+    assert all(0.5 * 2 ** attempt <= seconds <= 2 ** attempt for attempt, seconds in enumerate(sleeps))
+
+
+def test_retry_after_is_honoured(stub, make_client):
+    raw = put(stub)
+    stub.error_rate = 1.0
+    stub.retry_after = 7
+    sleeps = Sleeps(during=lambda: setattr(stub, 'error_rate', 0.0))
+    assert make_client(sleep=sleeps).get_raw(PATH) == raw
+    assert sleeps == [7.0]
+
+
+def test_rate_limit_waits_for_reset(stub, make_client):
+    raw = put(stub)
+    stub.rate_limit, stub.rate_window = 2, 30
+
+    def window_passes():
+        stub._rate_reset = 0.0
+
+    sleeps = Sleeps(during=window_passes)
+    client = make_client(sleep=sleeps)
+    client.get_raw(PATH)
+    client.get_raw(PATH)
+    assert client.rate_limit['remaining'] == 0
+    assert client.get_raw(PATH) == raw
+    assert stub.stats['rate_limited'] == 1
+    assert len(sleeps) == 1 and 25 <= sleeps[0] <= 31
+    assert client.rate_limit == {'limit': 2, 'remaining': 1, 'reset': client.rate_limit['reset']}
+
+
+def test_rate_limit_too_far_away_fails_fast(stub, make_client):
+    put(stub)
+    stub.rate_limit, stub.rate_window = 1, 3600
+    sleeps = Sleeps()
+    client = make_client(max_rate_limit_wait=60, sleep=sleeps)
+    client.get_raw(PATH)
+    with pytest.raises(GitHubError) as error:
+        client.get_raw(PATH)
+    assert error.value.status == 429
+    assert sleeps == []
+
+
+def test_connection_errors_raise_after_retries(stub, make_client):
+    sleeps = Sleeps()
+    client = make_client(max_retries=2, sleep=sleeps, timeout=(0.5, 0.5))
+    stub.stop()
+    with pytest.raises(GitHubError, match='недоступен'):
+        client.get_raw(PATH)
+    assert len(sleeps) == 2
+
+
+def test_put_file_conflicts(stub, make_client):
+    client = make_client()
+    sha = client.put_file(PATH, b'one')
+    assert sha == blob_sha(b'one')
+    new_sha = client.put_file(PATH, b'two', sha)
+
+    with pytest.raises(ShaConflict) as stale:
+        client.put_file(PATH, b'three', sha)
+    assert stale.value.status == 409
+    with pytest.raises(ShaConflict) as missing:
+        client.put_file(PATH, b'three')
+    assert missing.value.status == 422
+    assert stub.get('owner', 'repo', PATH) == (b'two', new_sha)
+
+
+def test_lost_write_response_is_retried_into_a_conflict(stub, make_client):
+    """Запись выполнена, ответ потерян (502): повтор видит уже записанный файл"""
+    stub.lost_response_rate = 1.0
+    client = make_client(sleep=Sleeps())
+    with pytest.raises(ShaConflict):
+        client.put_file(PATH, b'one')
+    assert stub.get('owner', 'repo', PATH)[0] == b'one'
+    assert stub.stats['lost_responses'] == 1
+
+
+def test_connections_are_pooled(stub, make_client):
+    put(stub)
+    client = make_client(pool_size=4)
+    for _ in range(20):
+        client.get_raw(PATH)
+    assert stub.stats['connections'] == 1
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(lambda _: client.get_raw(PATH), range(80)))
+    assert stub.stats['connections'] <= 4
@@ -0,0 +1,201 @@
+"""Журнал оплат и его отправка в GitHub (стенд benchmarks.github_stub)"""
+import json
+import time
+
+import pandas as pd
+import pytest
+
+from journal import PaymentJournal
+from storage import MANIFEST_PATH, PaymentHistoryStore
+
+SEED = [
+    {'subject_id': '13-001', 'visit_name': 'Визит 1', 'visit_date': '2024-01-10', 'payment_date': '2024-02-01', 'payment_amount': 0},
+    {'subject_id': '13-002', 'visit_name': 'Визит 1', 'visit_date': '2024-01-11', 'payment_date': '2024-02-01', 'payment_amount': 0},
+]
+PAID = {'subject_id': '13-003', 'visit_name': 'Визит 2', 'visit_date': '2024-03-05', 'payment_date': '2024-04-01', 'payment_amount': 0}
+
+
+def journal_store(make_client, journal_path, **options):
+    """Хранилище с журналом; фоновая отправка не успевает сработать за время теста"""
+    store = PaymentHistoryStore(make_client(**options), max_age=0)
+    store.attach_journal(PaymentJournal(journal_path), flush_delay=3600)
+    return store
+
+
+def exact_duplicates(index, record=PAID):
+    upload = pd.DataFrame([{key: record[key] for key in ('subject_id', 'visit_name', 'visit_date')}])
+    upload['visit_date'] = pd.to_datetime(upload['visit_date']).astype('datetime64[s]')
+    return len(index.classify(upload)[1])
+
+
+def manifest_paths(stub):
+    raw, _ = stub.get('owner', 'repo', MANIFEST_PATH)
+    return [segment['path'] for segment in json.loads(raw)['segments']]
+
+
+def test_reader_racing_flush_keeps_journaled_payment(stub, make_client, tmp_path):
+    """Отправка пачки между чтением манифеста и журнала не должна терять оплату"""
+    store = journal_store(make_client, tmp_path / 'journal.jsonl')
+    store.append(SEED)
+    store.enqueue([PAID])
+    assert exact_duplicates(store.load_index('run-1')) == 1
+    assert len(store.load('run-1')[0]) == 3
+
+    real_get = store.manifest_cache.get
+    flushed = []
+
+    def racing_get(run_id=None):
+        # Читатель получил манифест без пачки, и сразу после этого пачка отправлена целиком
+        result = real_get(run_id)
+        if not flushed:
+            flushed.append(True)
+            store.flush()
+        return result
+
+    for read in (lambda: exact_duplicates(store.load_index('run-2')), lambda: len(store.load('run-3')[0])):
+        flushed.clear()
+        store.manifest_cache.get = racing_get
+        try:
+            before = read()
+        finally:
+            store.manifest_cache.get = real_get
+        assert flushed
+        assert before == read()
+
+    assert exact_duplicates(store.load_index('run-4')) == 1
+    assert len(store.load('run-4')[0]) == 3
+    assert store.journal.pending() == []
+    fresh = PaymentHistoryStore(make_client(), max_age=0)
+    assert exact_duplicates(fresh.load_index()) == 1
+
+
+def interrupted_batch(make_client, journal_path, stage):
+    """Оплата, отправка которой оборвалась на стадии stage: 'begun', 'segment' или 'manifest'"""
+    store = journal_store(make_client, journal_path)
+    store.append(SEED)
+    store.enqueue([PAID])
+    ids = [entry_id for entry_id, _ in store.journal.unbatched()]
+    path = store._segment_path()
+    store.journal.begin_batch(path, ids)
+    if stage in ('segment', 'manifest'):
+        segment = store._write_segment(store.journal.records(ids), path=path)
+    if stage == 'manifest':
+        store._update_manifest(lambda segments: segments + [segment], path)
+    return path
+
+
+@pytest.mark.parametrize('stage', ['begun', 'segment', 'manifest'])
+def test_replay_completes_interrupted_batch_once(stub, make_client, tmp_path, stage):
+    """После перезапуска начатая пачка дописывается под тем же путём и попадает в манифест один раз"""
+    path = interrupted_batch(make_client, tmp_path / 'journal.jsonl', stage)
+
+    # "Перезапуск": новое хранилище и журнал, перечитанный с диска
+    restarted = journal_store(make_client, tmp_path / 'journal.jsonl')
+    assert [batch for batch, _ in restarted.journal.open_batches()] == [path]
+    assert exact_duplicates(restarted.load_index()) == 1
+    restarted.flush()
+
+    assert manifest_paths(stub).count(path) == 1
+    assert restarted.journal.pending() == [] and restarted.journal.open_batches() == []
+    assert PaymentJournal(tmp_path / 'journal.jsonl').pending() == []
+    fresh = PaymentHistoryStore(make_client(), max_age=0)
+    assert len(fresh.load()[0]) == 3
+    assert exact_duplicates(fresh.load_index()) == 1
+
+
+def test_replay_drops_torn_last_line(tmp_path):
+    journal = PaymentJournal(tmp_path / 'journal.jsonl')
+    entry_id = journal.append([PAID])
+    with open(tmp_path / 'journal.jsonl', 'a', encoding='utf-8') as f:
+        f.write('{"op": "entry", "id": "torn", "rec')
+
+    replayed = PaymentJournal(tmp_path / 'journal.jsonl')
+    assert [entry for entry, _ in replayed.pending()] == [entry_id]
+    second = replayed.append([SEED[0]])
+    assert [entry for entry, _ in PaymentJournal(tmp_path / 'journal.jsonl').pending()] == [entry_id, second]
+
+
+def test_flush_is_idempotent_when_responses_are_lost(stub, make_client, tmp_path):
+    """Запись выполнена, но ответ потерян: повтор не задваивает сегмент и манифест"""
+    store = journal_store(make_client, tmp_path / 'journal.jsonl')
+    store.append(SEED)
+    store.enqueue([PAID])
+    stub.lost_response_rate = 1.0
+    store.flush()
+    stub.lost_response_rate = 0.0
+
+    assert stub.stats['lost_responses'] >= 2
+    paths = manifest_paths(stub)
+    assert len(paths) == len(set(paths)) == 2
+    assert store.journal.pending() == []
+    fresh = PaymentHistoryStore(make_client(), max_age=0)
+    assert len(fresh.load()[0]) == 3
+
+
+def test_flush_remerges_manifest_after_sha_conflict(stub, make_client, tmp_path):
+    """Манифест изменили между нашим чтением и записью: 409, перечитывание, обе записи на месте"""
+    store = journal_store(make_client, tmp_path / 'journal.jsonl')
+    store.append(SEED)
+    other = PaymentHistoryStore(make_client(), max_age=0)
+    other.load()
+    store.enqueue([PAID])
+
+    real_put = store.client.put_file
+    raced = []
+
+    def put_file(path, raw, sha=None, message=None):
+        if path == MANIFEST_PATH and not raced:
+            raced.append(True)
+            other.append([SEED[0] | {'subject_id': '13-009'}])
+        return real_put(path, raw, sha, message)
+
+    store.client.put_file = put_file
+    store.flush()
+
+    assert raced and stub.stats['PUT_409'] == 1
+    assert len(manifest_paths(stub)) == 3
+    fresh = PaymentHistoryStore(make_client(), max_age=0)
+    assert len(fresh.load()[0]) == 4
+    assert exact_duplicates(fresh.load_index()) == 1
+
+
+def test_unflushed_payment_is_a_duplicate_before_and_after_restart(stub, make_client, tmp_path):
+    store = journal_store(make_client, tmp_path / 'journal.jsonl')
+    store.append(SEED)
+    assert exact_duplicates(store.load_index()) == 0
+
+    store.enqueue([PAID])
+    assert exact_duplicates(store.load_index()) == 1
+    assert store.count() == 3
+    # В GitHub оплаты ещё нет, но журнал на диске переживает перезапуск
+    assert exact_duplicates(PaymentHistoryStore(make_client(), max_age=0).load_index()) == 0
+    restarted = journal_store(make_client, tmp_path / 'journal.jsonl')
+    assert exact_duplicates(restarted.load_index()) == 1
+
+    restarted.flush()
+    assert exact_duplicates(restarted.load_index()) == 1
+    assert exact_duplicates(PaymentHistoryStore(make_client(), max_age=0).load_index()) == 1
+
+
+def test_background_flush_retries_until_github_recovers(stub, make_client, tmp_path):
+    store = PaymentHistoryStore(make_client(max_retries=0), max_age=0)
+    store.append(SEED)
+    stub.error_rate = 1.0
+    store.attach_journal(PaymentJournal(tmp_path / 'journal.jsonl'), flush_delay=0.01)
+    store.enqueue([PAID])
+
+    assert wait_for(lambda: store.flush_error is not None)
+    assert store.journal_status()['pending_entries'] == 1
+    stub.error_rate = 0.0
+    assert wait_for(lambda: not store.journal.pending())
+    assert store.flush_error is None
+    assert exact_duplicates(PaymentHistoryStore(make_client(), max_age=0).load_index()) == 1
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
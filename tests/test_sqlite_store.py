@@ -0,0 +1,61 @@
+"""Проверка загрузки по SQLite совпадает с VisitIndex по всей истории, включая пропуски"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from history_model import as_strings, compact_history
+from sqlite_store import SQLitePaymentStore
+from visit_index import VisitIndex
+from test_visit_index import random_history, random_upload
+
+
+def with_gaps(df, rng, columns, share=0.05):
+    """Часть значений заменяется пропуском или пустой строкой"""
+    df = as_strings(df).astype(object)
+    for column in columns:
+        rows = rng.random(len(df)) < share
+        df.loc[rows, column] = rng.choice(np.array([None, ''], dtype=object), rows.sum())
+    return df
+
+
+def assert_same(got, expected):
+    assert len(got) == len(expected)
+    for got_frame, expected_frame in zip(got, expected):
+        pd.testing.assert_frame_equal(as_strings(got_frame), as_strings(expected_frame))
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_sqlite_lookup_matches_visit_index(tmp_path, seed):
+    rng = np.random.default_rng(200 + seed)
+    records = with_gaps(random_history(rng, 3000), rng, ['subject_id', 'visit_name']).to_dict('records')
+    upload = random_upload(rng, 500)
+    # Пропуски в загрузке совпадают с пропусками в истории
+    upload['subject_id'] = upload['subject_id'].astype(object)
+    upload.loc[upload.index[:10], 'subject_id'] = np.nan
+    upload.loc[upload.index[10:20], 'subject_id'] = ''
+    upload.loc[upload.index[20:25], 'visit_name'] = np.nan
+    # Оплата без ID того же визита, что первая строка загрузки без ID
+    records.append({'subject_id': None, 'visit_name': upload['visit_name'][0],
+                    'visit_date': upload['visit_date'][0].strftime('%Y-%m-%d'), 'payment_date': '2025-01-01'})
+
+    store = SQLitePaymentStore(tmp_path / 'payments.sqlite3')
+    store.append(records)
+    index = VisitIndex.from_frame(compact_history(pd.DataFrame(records)))
+    lookup = store.load_index()
+
+    expected = index.classify(upload)
+    assert_same(lookup.classify(upload), expected)
+    assert_same(lookup.find_similar(expected[0]), index.find_similar(expected[0]))
+    assert expected[1]['subject_id'].isna().any()
+
+
+def test_missing_subject_rows_are_read_only_for_missing_subjects(tmp_path):
+    store = SQLitePaymentStore(tmp_path / 'payments.sqlite3')
+    store.append([
+        {'subject_id': None, 'visit_name': 'Визит 1', 'visit_date': '2024-01-10', 'payment_date': '2024-02-01'},
+        {'subject_id': '13-001', 'visit_name': 'Визит 1', 'visit_date': '2024-01-10', 'payment_date': '2024-02-01'},
+        {'subject_id': '', 'visit_name': 'Визит 2', 'visit_date': '2024-01-11', 'payment_date': '2024-02-01'},
+    ])
+    assert list(store.subject_rows({'13-001'})['subject_id']) == ['13-001']
+    rows = store.subject_rows({'nan', '', '13-001'})
+    assert [None if pd.isna(value) else value for value in rows['subject_id']] == [None, '13-001', '']
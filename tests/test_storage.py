@@ -0,0 +1,218 @@
+"""Хранилище истории в GitHub: перенос payments.json, манифест и сворачивание месяцев (стенд)"""
+import json
+import re
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+import storage
+from storage import (LEGACY_PATH, MANIFEST_FORMAT, MANIFEST_PATH, SEGMENTS_DIR, PaymentHistoryStore, StorageError,
+                     _replace_run)
+
+
+def records(count, start=0, month='2024-01'):
+    return [{'subject_id': f"13-{start + i:03d}", 'visit_name': f"Визит {i % 3 + 1}",
+             'visit_date': f"{month}-{i % 28 + 1:02d}", 'payment_date': f"{month}-28", 'payment_amount': 0}
+            for i in range(count)]
+
+
+def stored(stub, path):
+    found = stub.get('owner', 'repo', path)
+    return None if found is None else found[0]
+
+
+def manifest(stub):
+    return json.loads(stored(stub, MANIFEST_PATH))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Подменяет текущее время хранилища: clock.now = datetime(...)"""
+    class Clock(datetime):
+        now_value = datetime(2024, 3, 10)
+
+        @classmethod
+        def now(cls, tz=None):
+            return cls.now_value
+
+    monkeypatch.setattr(storage, 'datetime', Clock)
+    return Clock
+
+
+def test_legacy_file_is_read_until_migrated(stub, make_client):
+    legacy = records(5)
+    stub.put('owner', 'repo', LEGACY_PATH, json.dumps(legacy).encode('utf-8'))
+    store = PaymentHistoryStore(make_client(), max_age=0)
+
+    df, version = store.load()
+    assert len(df) == store.count() == 5 and version.startswith('legacy:')
+    assert stored(stub, MANIFEST_PATH) is None
+
+    sha = store.migrate()
+    segments = manifest(stub)['segments']
+    assert len(segments) == 1 and segments[0]['rows'] == 5
+    assert [json.loads(line) for line in stored(stub, segments[0]['path']).decode('utf-8').splitlines()] == legacy
+    puts = stub.stats['PUT_201'] + stub.stats['PUT_200']
+    assert store.migrate() == sha
+    assert stub.stats['PUT_201'] + stub.stats['PUT_200'] == puts
+
+    # После переноса старый файл больше не читается
+    stub.put('owner', 'repo', LEGACY_PATH, json.dumps(records(9)).encode('utf-8'))
+    assert len(PaymentHistoryStore(make_client(), max_age=0).load()[0]) == 5
+
+
+def test_first_append_migrates_legacy(stub, make_client):
+    stub.put('owner', 'repo', LEGACY_PATH, json.dumps(records(3)).encode('utf-8'))
+    store = PaymentHistoryStore(make_client(), max_age=0)
+    store.append(records(2, start=100))
+    segments = manifest(stub)['segments']
+    assert [segment['rows'] for segment in segments] == [3, 2]
+    assert '/legacy-' in segments[0]['path']
+    assert len(PaymentHistoryStore(make_client(), max_age=0).load()[0]) == 5
+
+
+def test_manifest_disappearing_after_it_was_seen_is_an_error(stub, make_client):
+    stub.put('owner', 'repo', LEGACY_PATH, json.dumps(records(3)).encode('utf-8'))
+    store = PaymentHistoryStore(make_client(), max_age=0)
+    store.append(records(2))
+    with stub._lock:
+        del stub.files[('owner', 'repo', MANIFEST_PATH)]
+    with pytest.raises(StorageError):
+        store.load()
+
+
+def test_manifest_round_trip(stub, make_client):
+    writer = PaymentHistoryStore(make_client(), max_age=0)
+    for part in range(3):
+        writer.append(records(4, start=part * 10))
+
+    written, sha = writer.manifest_cache.peek()
+    raw = stored(stub, MANIFEST_PATH)
+    assert json.loads(raw) == written and written['format'] == MANIFEST_FORMAT
+    assert sha == stub.get('owner', 'repo', MANIFEST_PATH)[1]
+
+    reader = PaymentHistoryStore(make_client(), max_age=0)
+    assert reader.manifest_cache.get() == (written, sha)
+    stub.stats.clear()
+    assert reader.manifest_cache.get() == (written, sha)
+    assert stub.stats['GET_304'] == 1 and stub.stats['GET_200'] == 0
+    assert reader.count() == 12 and len(reader.load()[0]) == 12
+
+    writer.clear()
+    assert manifest(stub)['segments'] == []
+    assert reader.load()[0].empty and reader.count() == 0
+
+
+def test_closed_months_are_folded_after_the_first_write_of_a_month(stub, make_client, clock):
+    store = PaymentHistoryStore(make_client(), max_age=0)
+    for day in (1, 2, 3):
+        clock.now_value = datetime(2024, 3, day)
+        store.append(records(3, start=day * 10, month='2024-03'))
+    march = manifest(stub)['segments']
+    originals = b''.join(stored(stub, segment['path']) for segment in march)
+
+    clock.now_value = datetime(2024, 4, 1)
+    store.append(records(2, start=100, month='2024-04'))
+
+    segments = manifest(stub)['segments']
+    assert segments[0]['path'] == f"{SEGMENTS_DIR}/2024-03.jsonl"
+    assert segments[0]['rows'] == 9 and len(segments) == 2
+    assert stored(stub, segments[0]['path']) == originals
+    # Прежние файлы остаются для сессий со старым манифестом
+    assert all(stored(stub, segment['path']) is not None for segment in march)
+
+    stub.stats.clear()
+    assert store.compact() == stub.get('owner', 'repo', MANIFEST_PATH)[1]
+    assert not any(key.startswith('PUT') for key in stub.stats)
+
+    cold = PaymentHistoryStore(make_client(), max_age=0)
+    stub.stats.clear()
+    assert len(cold.load()[0]) == 11
+    assert stub.stats['GET_200'] == 3
+
+
+def test_fold_keeps_snapshot_index_and_date_index(stub, make_client, clock):
+    store = PaymentHistoryStore(make_client(), max_age=0)
+    for day in (1, 2):
+        clock.now_value = datetime(2024, 1, day)
+        store.append(records(5, start=day * 10, month='2024-01'))
+    # Запись в феврале без автоматического сворачивания: январь сворачивается ниже, после чтения
+    clock.now_value = datetime(2024, 2, 1)
+    store._compact_after_write = lambda: None
+    store.append(records(4, start=50, month='2024-02'))
+
+    df, _ = store.load()
+    lineage = store._df_lineage
+    filters = {'payment_from': pd.Timestamp('2024-01-01').date(), 'payment_to': pd.Timestamp('2024-02-28').date()}
+    before, _ = store.query(**filters)
+    dates = store._dates
+    index = store.load_index()
+    upload = pd.DataFrame({'subject_id': ['13-010', '13-051'], 'visit_name': ['Визит 1', 'Визит 2'],
+                           'visit_date': pd.to_datetime(['2024-01-01', '2024-02-02']).astype('datetime64[s]')})
+    exact_before = index.classify(upload)[1]
+
+    store.compact(now=datetime(2024, 2, 15))
+
+    paths = [segment['path'] for segment in manifest(stub)['segments']]
+    assert paths[0] == f"{SEGMENTS_DIR}/2024-01.jsonl" and len(paths) == 2
+    assert store._df_paths == paths
+    assert store._derived['index'].paths == set(paths)
+    after, _ = store.query(**filters)
+    assert store._df_lineage == lineage and store._dates is dates
+    pd.testing.assert_frame_equal(after.reset_index(drop=True), before.reset_index(drop=True))
+    assert store.load_index() is index
+    pd.testing.assert_frame_equal(store.load_index().classify(upload)[1], exact_before)
+    assert len(store.load()[0]) == len(df) == 14
+
+
+def test_late_segment_refolds_under_a_content_name(stub, make_client, clock):
+    store = PaymentHistoryStore(make_client(), max_age=0)
+    clock.now_value = datetime(2024, 3, 1)
+    store.append(records(2, month='2024-03'))
+    store.append(records(2, start=10, month='2024-03'))
+    clock.now_value = datetime(2024, 4, 1)
+    store.compact()
+    first = stored(stub, f"{SEGMENTS_DIR}/2024-03.jsonl")
+
+    # Пачка журнала, начатая в марте, дописана уже в апреле
+    late = store._write_segment(records(3, start=20, month='2024-03'), path=f"{SEGMENTS_DIR}/2024-03/late.jsonl")
+    store._update_manifest(lambda segments: segments + [late], late['path'])
+    store.compact()
+
+    segments = manifest(stub)['segments']
+    assert len(segments) == 1 and segments[0]['rows'] == 7
+    assert re.fullmatch(rf"{SEGMENTS_DIR}/2024-03\.[0-9a-f]{{8}}\.jsonl", segments[0]['path'])
+    assert stored(stub, f"{SEGMENTS_DIR}/2024-03.jsonl") == first
+    assert stored(stub, segments[0]['path']) == first + stored(stub, late['path'])
+    assert len(PaymentHistoryStore(make_client(), max_age=0).load()[0]) == 7
+
+
+def test_concurrent_compaction_folds_once(stub, make_client, clock):
+    first = PaymentHistoryStore(make_client(), max_age=0)
+    second = PaymentHistoryStore(make_client(), max_age=0)
+    clock.now_value = datetime(2024, 3, 1)
+    first.append(records(2, month='2024-03'))
+    second.append(records(2, start=10, month='2024-03'))
+    second.load()
+
+    clock.now_value = datetime(2024, 4, 1)
+    real_update = second._update_manifest
+
+    def update_after_other(change, expected_path=None):
+        # Другая сессия свернула тот же месяц, пока мы писали файл
+        first.compact()
+        return real_update(change, expected_path)
+
+    second._update_manifest = update_after_other
+    second.compact()
+
+    segments = manifest(stub)['segments']
+    assert [segment['path'] for segment in segments] == [f"{SEGMENTS_DIR}/2024-03.jsonl"]
+    assert len(second.load()[0]) == len(first.load()[0]) == 4
+
+
+def test_replace_run():
+    assert _replace_run(['a', 'b', 'c', 'd'], ['b', 'c'], 'x') == ['a', 'x', 'd']
+    assert _replace_run(['a', 'b', 'c'], ['a', 'c'], 'x') == ['a', 'b', 'c']
+    assert _replace_run(['a'], ['a', 'b'], 'x') == ['a']
@@ -0,0 +1,85 @@
+"""Разбор дат визитов: написания текста, номера дат Excel и отказ от неполных дат"""
+import io
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+from openpyxl import Workbook
+
+from ingest import DATE_ERROR_COLUMN, parse_visits
+from visit_dates import excel_serial_dates, parse_dates
+
+
+def parsed(values, formats=None):
+    dates, failed, _ = parse_dates(pd.Series(values, dtype=object), formats)
+    return [None if pd.isna(value) else value.strftime('%Y-%m-%d') for value in dates], list(failed)
+
+
+@pytest.mark.parametrize('values, expected', [
+    (['05.03.2024', '31.12.2023', '1.2.2024'], ['2024-03-05', '2023-12-31', '2024-02-01']),
+    (['05.03.24', '31.12.23'], ['2024-03-05', '2023-12-31']),
+    (['2024-03-05', '2023-12-31'], ['2024-03-05', '2023-12-31']),
+    (['2024-03-05T10:15:00', '2024-03-06 23:59:59', '2024-03-07 08:00'], ['2024-03-05', '2024-03-06', '2024-03-07']),
+    ([' 05.03.2024 ', '05.03.2024'], ['2024-03-05', '2024-03-05']),
+])
+def test_text_dates(values, expected):
+    assert parsed(values) == (expected, [False] * len(values))
+
+
+@pytest.mark.parametrize('value', ['2024', '2024-03', '03.2024', 'март 2024', 'garbage', '31.02.2024', '', '   ', None, '1900'])
+def test_partial_or_garbage_text_is_rejected(value):
+    assert parsed(['05.03.2024', value]) == (['2024-03-05', None], [False, True])
+
+
+def test_excel_serial_numbers():
+    assert parsed([45356, 45356.75, 1]) == (['2024-03-05', '2024-03-05', '1899-12-31'], [False] * 3)
+    serials = pd.Series([45356, 60, 0, -5, 3e6], dtype=float)
+    dates, failed, _ = parse_dates(serials)
+    assert dates[0] == pd.Timestamp('2024-03-05')
+    assert list(failed) == [False, False, True, True, True]
+    assert np.isnat(excel_serial_dates(np.array([np.nan, 45356.0]))).tolist() == [True, False]
+
+
+def test_excel_serial_numbers_as_text():
+    assert parsed(['45356', '45356.0', '45356.5']) == (['2024-03-05'] * 3, [False] * 3)
+    # Короткие числа в тексте - скорее год, чем номер даты
+    assert parsed(['45356', '2024', '45356abc']) == (['2024-03-05', None, None], [False, True, True])
+
+
+def test_mixed_cell_types_in_one_column():
+    values = [datetime(2024, 3, 5, 14, 30), date(2024, 3, 6), pd.Timestamp('2024-03-07'), 45358, '08.03.2024', '45359', None]
+    assert parsed(values) == (
+        ['2024-03-05', '2024-03-06', '2024-03-07', '2024-03-07', '2024-03-08', '2024-03-08', None],
+        [False] * 6 + [True],
+    )
+
+
+def test_day_month_order_is_not_mixed():
+    # 13/02 возможно только как день/месяц; 02/13 тогда - ошибка, а не перестановка
+    assert parsed(['13/02/2024', '01/02/2024', '02/13/2024']) == (['2024-02-13', '2024-02-01', None], [False, False, True])
+    assert parsed(['02/13/2024', '02/01/2024']) == (['2024-02-13', '2024-02-01'], [False, False])
+
+
+def test_formats_from_earlier_chunks_are_reused():
+    dates, failed, formats = parse_dates(pd.Series(['05.03.2024'], dtype=object))
+    assert formats == ['%d.%m.%Y']
+    _, _, formats = parse_dates(pd.Series(['06.03.2024', '2024-03-07'], dtype=object), formats)
+    assert formats == ['%d.%m.%Y', '%Y-%m-%d']
+
+
+def test_workbook_dates_and_failures():
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(['ID', 'Визит', 'Дата'])
+    for row in [('13-001', 'Визит 1', datetime(2024, 3, 5)), ('13-002', 'Визит 1', 45357),
+                ('13-003', 'Визит 1', '07.03.2024'), ('13-004', 'Визит 1', '2024-03'), ('13-005', 'Визит 1', None)]:
+        sheet.append(row)
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+
+    visits = parse_visits(buffer.getvalue(), 'site.xlsx')
+    assert str(visits['visit_date'].dtype) == 'datetime64[s]'
+    assert [None if pd.isna(value) else value.strftime('%Y-%m-%d') for value in visits['visit_date']] == \
+        ['2024-03-05', '2024-03-06', '2024-03-07', None, None]
+    assert list(visits[DATE_ERROR_COLUMN].fillna('-')) == ['-', '-', '-', '2024-03', '']
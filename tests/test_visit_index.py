@@ -0,0 +1,158 @@
+"""VisitIndex против прежней проверки дубликатов через merge по строковым ключам
+
+merge_classify - алгоритм process_visits до перехода на индекс: ключи
+склеиваются из строк, сведения о прежних оплатах подтягиваются merge, и
+строка загрузки размножается по числу совпавших оплат. Индекс должен
+раскладывать строки по тем же категориям, а в previous_* давать последнюю
+из размноженных строк и их число в previous_count.
+"""
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from history_model import as_strings, compact_history
+from visit_index import VisitIndex
+
+KEY = ['subject_id', 'visit_name', 'visit_date']
+PREVIOUS = {
+    'exact': ['previous_payment_date'],
+    'same_type': ['previous_visit_date', 'previous_payment_date'],
+    'suspicious': ['previous_visit_name', 'previous_payment_date'],
+}
+
+
+def merge_classify(paid_visits, uploaded_df):
+    """Прежний process_visits: строковые ключи, isin и merge с размножением строк"""
+    paid_visits = as_strings(paid_visits)
+    uploaded_df = uploaded_df.copy()
+    uploaded_df['visit_date'] = uploaded_df['visit_date'].dt.strftime('%Y-%m-%d')
+    for df in (uploaded_df, paid_visits):
+        df['full_key'] = df['subject_id'].astype(str) + '_' + df['visit_name'].astype(str) + '_' + df['visit_date'].astype(str)
+        df['visit_type_key'] = df['subject_id'].astype(str) + '_' + df['visit_name'].astype(str)
+        df['date_key'] = df['subject_id'].astype(str) + '_' + df['visit_date'].astype(str)
+
+    exact_mask = uploaded_df['full_key'].isin(paid_visits['full_key'])
+    same_type_mask = uploaded_df['visit_type_key'].isin(paid_visits['visit_type_key']) & ~exact_mask
+    same_date_mask = uploaded_df['date_key'].isin(paid_visits['date_key']) & ~exact_mask & ~same_type_mask
+
+    new_visits = uploaded_df[~exact_mask & ~same_type_mask & ~same_date_mask]
+    exact = uploaded_df[exact_mask].merge(
+        paid_visits[['full_key', 'payment_date']].rename(columns={'payment_date': 'previous_payment_date'}),
+        on='full_key', how='left'
+    )
+    same_type = uploaded_df[same_type_mask].merge(
+        paid_visits[['visit_type_key', 'visit_date', 'payment_date']].rename(columns={
+            'visit_date': 'previous_visit_date', 'payment_date': 'previous_payment_date'
+        }),
+        on='visit_type_key', how='left'
+    )
+    suspicious = uploaded_df[same_date_mask].merge(
+        paid_visits[['date_key', 'visit_name', 'payment_date']].rename(columns={
+            'visit_name': 'previous_visit_name', 'payment_date': 'previous_payment_date'
+        }),
+        on='date_key', how='left'
+    )
+    columns_to_drop = ['full_key', 'visit_type_key', 'date_key']
+    return [df.drop(columns=columns_to_drop) for df in (new_visits, exact, same_type, suspicious)]
+
+
+def random_history(rng, rows, subjects=150):
+    """Компактная история, как её отдаёт хранилище; названия визитов с похожими написаниями"""
+    visits = ['Визит 1 - Скрининг', 'Визит 2 - Последующее наблюдение', 'Визит 2', 'визит 2 ', 'Visit 3', 'Визит 3']
+    dates = pd.date_range('2024-01-01', periods=90).strftime('%Y-%m-%d').to_numpy()
+    return compact_history(pd.DataFrame({
+        'subject_id': rng.choice([f"{13 + i % 4}-{i:03d}" for i in range(subjects)], rows),
+        'visit_name': rng.choice(visits, rows),
+        'visit_date': rng.choice(dates, rows),
+        'payment_date': rng.choice(pd.date_range('2025-01-01', periods=400).strftime('%Y-%m-%d').to_numpy(), rows),
+        'payment_amount': 0.0,
+    }))
+
+
+def random_upload(rng, rows, subjects=170):
+    """Загрузка после ingest: даты визитов типизированы, повторы уже отделены
+
+    Часть субъектов, названий и дат в истории не встречается.
+    """
+    visits = ['Визит 1 - Скрининг', 'Визит 2 - Последующее наблюдение', 'Визит 2', 'Визит 4', 'Visit 3']
+    upload = pd.DataFrame({
+        'subject_id': rng.choice([f"{13 + i % 4}-{i:03d}" for i in range(subjects)], rows),
+        'visit_name': rng.choice(visits, rows),
+        'visit_date': pd.to_datetime(rng.choice(pd.date_range('2023-12-01', periods=120).to_numpy(), rows)),
+    })
+    upload['visit_date'] = upload['visit_date'].astype('datetime64[s]')
+    return upload.drop_duplicates(KEY).reset_index(drop=True)
+
+
+def assert_same_as_merge(index, paid_visits, upload):
+    expected = merge_classify(paid_visits, upload)
+    result = index.classify(upload)
+
+    pd.testing.assert_frame_equal(
+        as_strings(result[0]).reset_index(drop=True),
+        expected[0].reset_index(drop=True),
+        check_dtype=False,
+    )
+    for (name, columns), merged, got in zip(PREVIOUS.items(), expected[1:], result[1:]):
+        # Размноженные строки прежнего алгоритма -> последняя оплата и их число
+        grouped = merged.groupby(KEY, sort=False)
+        last = grouped.tail(1).set_index(KEY)
+        last['previous_count'] = grouped.size()
+        got = as_strings(got).set_index(KEY)
+        assert len(got) == len(last), name
+        pd.testing.assert_frame_equal(
+            got[columns + ['previous_count']].sort_index(),
+            last[columns + ['previous_count']].sort_index(),
+            check_dtype=False, obj=name,
+        )
+
+
+@pytest.mark.parametrize('seed', range(6))
+def test_classify_matches_merge(seed):
+    rng = np.random.default_rng(seed)
+    paid_visits = random_history(rng, 4000)
+    upload = random_upload(rng, 800)
+    assert_same_as_merge(VisitIndex.from_frame(paid_visits), paid_visits, upload)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_add_frame_matches_merge(seed):
+    """Индекс, дополняемый порциями разного размера, совпадает с merge после каждой порции"""
+    rng = np.random.default_rng(100 + seed)
+    paid_visits = random_history(rng, 12000)
+    upload = random_upload(rng, 600)
+    bounds = np.sort(rng.choice(np.arange(1, len(paid_visits)), 9, replace=False))
+    index = VisitIndex()
+    for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(paid_visits)]):
+        index.add_frame(paid_visits.iloc[start:stop])
+        assert_same_as_merge(index, paid_visits.iloc[:stop], upload)
+    assert index.size == len(paid_visits)
+
+
+def test_empty_history_classifies_everything_as_new():
+    upload = random_upload(np.random.default_rng(7), 100)
+    new_visits, exact, same_type, suspicious = VisitIndex().classify(upload)
+    assert len(new_visits) == len(upload)
+    assert exact.empty and same_type.empty and suspicious.empty
+
+
+def test_classify_peak_memory_below_merge():
+    """Классификация по индексу не размножает строки и держит меньше памяти, чем merge"""
+    rng = np.random.default_rng(42)
+    paid_visits = random_history(rng, 60000, subjects=300)
+    upload = random_upload(rng, 8000, subjects=320)
+    index = VisitIndex.from_frame(paid_visits)
+
+    def peak(classify):
+        tracemalloc.start()
+        try:
+            classify()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    merge_peak = peak(lambda: merge_classify(paid_visits, upload))
+    index_peak = peak(lambda: index.classify(upload))
+    assert index_peak * 4 < merge_peak
@@ -0,0 +1,152 @@
+"""Разбор дат визитов из Excel: формат определяется один раз на столбец
+
+В одном столбце встречаются даты Excel (datetime из ячеек с форматом
+даты), числа - порядковые номера дат Excel из ячеек без формата - и текст
+в разных написаниях. Номера переводятся в даты арифметикой над массивом,
+текст разбирается pd.to_datetime с явным форматом: написание выбирается по
+выборке значений один раз на файл, а не угадывается для каждой строки.
+Дата в тексте должна быть полной: "2024" или "2024-03" - не дата визита.
+Номер даты Excel, сохранённый текстом, тоже принимается, если он не похож
+на год.
+
+Неоднозначные написания (01/02/2024) читаются как день/месяц, если в
+столбце нет значений, возможных только как месяц/день; оба порядка в одном
+столбце не смешиваются - значения другого порядка считаются
+нераспознанными, а не переставляются молча.
+"""
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+# День 0 порядковых номеров Excel (1 - 01.01.1900 с учётом ошибки Lotus про 29.02.1900)
+EXCEL_EPOCH = np.datetime64('1899-12-30', 'D')
+# Номера, которые Excel показывает как даты: 01.01.1900 ... 31.12.9999
+EXCEL_SERIAL_RANGE = (1, 2958465)
+# Написания текстовых дат в порядке предпочтения при равном числе совпадений; все с днём месяца
+TEXT_FORMATS = ('%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%d.%m.%Y', '%d.%m.%y',
+                '%d.%m.%Y %H:%M:%S', '%d.%m.%Y %H:%M', '%d/%m/%Y', '%m/%d/%Y', '%d-%m-%Y', '%Y/%m/%d')
+# Номера дат Excel в тексте: меньшие числа (1900, 2024) - скорее год, чем дата (10000 - 18.05.1927)
+TEXT_SERIAL_RANGE = (10000, EXCEL_SERIAL_RANGE[1])
+TEXT_SERIAL = r'\d+(?:\.\d+)?'
+# Порядки дня и месяца, которые нельзя смешивать в одном столбце
+RIVAL_FORMATS = {'%d/%m/%Y': '%m/%d/%Y', '%m/%d/%Y': '%d/%m/%Y'}
+# Сколько различных значений смотреть при выборе написания
+DETECT_SAMPLE = 500
+
+
+def parse_dates(values, formats=None):
+    """Столбец дат -> (даты datetime64[s], маска нераспознанных, написания текста)
+
+    formats - написания, уже найденные в предыдущих порциях того же
+    столбца; новые ищутся только для строк, которые ими не разобрались.
+    Время отбрасывается. Пустые ячейки тоже нераспознанные: без даты визит
+    нельзя ни проверить, ни оплатить.
+    """
+    values = pd.Series(values)
+    formats = list(formats or ())
+    if pd.api.types.is_datetime64_any_dtype(values):
+        dates = _to_days(values)
+    elif pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        dates = pd.Series(excel_serial_dates(values.to_numpy(dtype=np.float64, na_value=np.nan)), index=values.index)
+    elif pd.api.types.infer_dtype(values, skipna=True) in ('datetime', 'datetime64', 'date'):
+        # Обычный случай: все ячейки столбца с форматом даты (или пустые)
+        dates = _to_days(pd.to_datetime(values, errors='coerce'))
+    else:
+        dates = pd.Series(np.full(len(values), np.datetime64('NaT'), dtype='datetime64[s]'), index=values.index)
+        # Тип проверяется по словарю типов столбца, а не для каждой ячейки отдельно
+        kinds = values.map(type)
+        found = kinds.unique()
+        stamps = kinds.isin([kind for kind in found if issubclass(kind, (date, np.datetime64))]).to_numpy()
+        numbers = kinds.isin([kind for kind in found if _is_number(kind)]).to_numpy()
+        texts = kinds.isin([kind for kind in found if issubclass(kind, str)]).to_numpy()
+        if stamps.any():
+            dates[stamps] = _to_days(pd.to_datetime(values[stamps], errors='coerce')).to_numpy()
+        if numbers.any():
+            dates[numbers] = excel_serial_dates(values[numbers].to_numpy(dtype=np.float64))
+        if texts.any():
+            dates[texts], formats = _parse_texts(values[texts], formats)
+    return dates, dates.isna().to_numpy(), formats
+
+
+def excel_serial_dates(numbers):
+    """Порядковые номера дат Excel -> datetime64[s]; дробная часть (время) отбрасывается"""
+    numbers = np.asarray(numbers, dtype=np.float64)
+    valid = (numbers >= EXCEL_SERIAL_RANGE[0]) & (numbers <= EXCEL_SERIAL_RANGE[1])
+    days = np.floor(np.where(valid, numbers, 0)).astype(np.int64)
+    dates = (EXCEL_EPOCH + days).astype('datetime64[s]')
+    dates[~valid] = np.datetime64('NaT')
+    return dates
+
+
+def detect_formats(texts, known=()):
+    """Написания, подходящие к выборке значений, по убыванию числа совпадений
+
+    Написание, противоречащее уже выбранному (месяц/день при день/месяц),
+    не предлагается.
+    """
+    sample = pd.Series(pd.unique(texts.to_numpy())[:DETECT_SAMPLE], dtype=object)
+    scores = []
+    for position, fmt in enumerate(TEXT_FORMATS):
+        if fmt in known or RIVAL_FORMATS.get(fmt) in known:
+            continue
+        matched = int(_to_datetime(sample, fmt).notna().sum())
+        if matched:
+            scores.append((-matched, position, fmt))
+    chosen = []
+    for _, _, fmt in sorted(scores):
+        if RIVAL_FORMATS.get(fmt) not in chosen:
+            chosen.append(fmt)
+    return chosen
+
+
+def _parse_texts(texts, formats):
+    """Текстовые даты -> (datetime64[s], написания)
+
+    Каждое различное значение разбирается один раз (дат визитов в файле
+    намного меньше, чем строк): сначала известными написаниями, остаток -
+    написаниями, найденными по этому остатку, и наконец как номера дат Excel.
+    """
+    codes, uniques = pd.factorize(texts)
+    uniques = pd.Series(uniques, dtype=object).str.strip()
+    dates = np.full(len(uniques), np.datetime64('NaT'), dtype='datetime64[s]')
+    rest = uniques[uniques != '']
+    queue = list(formats)
+    detected = False
+    while len(rest):
+        if not queue:
+            if detected:
+                break
+            queue = detect_formats(rest, formats)
+            formats = formats + queue
+            detected = True
+            if not queue:
+                break
+        parsed = _to_datetime(rest, queue.pop(0))
+        found = parsed.notna().to_numpy()
+        dates[rest.index[found]] = _to_days(parsed[found]).to_numpy()
+        rest = rest[~found]
+    if len(rest):
+        numbers = pd.to_numeric(rest.where(rest.str.fullmatch(TEXT_SERIAL)), errors='coerce')
+        serial = (numbers >= TEXT_SERIAL_RANGE[0]) & (numbers <= TEXT_SERIAL_RANGE[1])
+        if serial.any():
+            dates[rest.index[serial]] = excel_serial_dates(numbers[serial].to_numpy())
+    return dates[codes], formats
+
+
+def _is_number(kind):
+    return issubclass(kind, (int, float, np.number)) and not issubclass(kind, (bool, np.bool_))
+
+
+def _to_datetime(texts, fmt):
+    parsed = pd.to_datetime(texts, format=fmt, errors='coerce')
+    if getattr(parsed.dt, 'tz', None) is not None:
+        parsed = parsed.dt.tz_localize(None)
+    return parsed
+
+
+def _to_days(values):
+    values = pd.Series(values)
+    if getattr(values.dt, 'tz', None) is not None:
+        values = values.dt.tz_localize(None)
+    return values.dt.floor('D').astype('datetime64[s]')
@@ -0,0 +1,297 @@
+"""Индекс оплаченных визитов для поиска дубликатов"""
+import threading
+
+import numpy as np
+import pandas as pd
+
+from history_model import day_numbers, format_dates
+from visit_names import NameMatcher
+
+# Разрядность кодов в составных int64-ключах: ID субъекта, визит, дата
+SUBJECT_BITS = 24
+VISIT_BITS = 20
+DATE_BITS = 19
+# Ключ пропущенного ID или названия: пропуск в загрузке совпадает с пропуском в истории
+MISSING_KEY = 'nan'
+
+
+class _Vocabulary:
+    """Словарь значений (строк или номеров дней) -> целочисленные коды, пополняемый на месте"""
+
+    def __init__(self, name, bits, dtype=object):
+        self.name = name
+        self.limit = 1 << bits
+        self.dtype = dtype
+        self.values = np.empty(0, dtype=dtype)
+        self._index = pd.Index(self.values)
+
+    def lookup(self, values):
+        """Коды значений; -1 для отсутствующих в словаре и пропусков"""
+        return self._index.get_indexer(pd.Index(values, dtype=self.dtype)).astype(np.int64)
+
+    def encode(self, values):
+        """Коды значений с добавлением новых значений в словарь"""
+        codes, uniques = pd.factorize(np.asarray(values, dtype=self.dtype))
+        known = self._index.get_indexer(uniques)
+        unseen = known < 0
+        if unseen.any():
+            start = len(self.values)
+            if start + unseen.sum() > self.limit:
+                raise ValueError(f"слишком много различных значений в поле {self.name}")
+            known[unseen] = np.arange(start, start + unseen.sum())
+            self.values = np.concatenate([self.values, uniques[unseen].astype(self.dtype)])
+            self._index = pd.Index(self.values)
+        mapped = known[codes].astype(np.int64)
+        mapped[codes < 0] = -1
+        return mapped
+
+    def encode_column(self, values):
+        """Коды столбца; у категорий кодируется только словарь категорий"""
+        if not isinstance(values.dtype, pd.CategoricalDtype):
+            return self.encode(key_text(values))
+        category_codes = self.encode(values.cat.categories.astype(object))
+        codes = values.cat.codes.to_numpy()
+        mapped = category_codes.take(np.maximum(codes, 0)) if len(category_codes) else np.zeros(len(codes), dtype=np.int64)
+        if (codes < 0).any():
+            # Пропуск сравнивается так же, как пропуск у загрузки (key_text)
+            mapped[codes < 0] = self.encode([MISSING_KEY])[0]
+        return mapped
+
+    def decode(self, codes):
+        result = self.values.take(np.maximum(codes, 0)) if len(self.values) else np.full(len(codes), None, dtype=object)
+        result = result.astype(object)
+        result[codes < 0] = None
+        return result
+
+
+class _KeyTable:
+    """Агрегат истории по составному ключу: последняя оплата и число оплат
+
+    Новые записи складываются в небольшую дельту, которая сливается с
+    основной таблицей, когда вырастает до 1/8 её размера, поэтому
+    дополнение индекса стоит O(новых записей) в амортизированном смысле.
+    """
+
+    def __init__(self):
+        self.base = _aggregate(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+        self.delta = self.base
+
+    def add(self, keys, info, payments):
+        rows = _aggregate(keys, info, payments)
+        self.delta = _merge(self.delta, rows)
+        if len(self.delta) * 8 > max(len(self.base), 8192):
+            self.base, self.delta = _merge(self.base, self.delta), self.base.iloc[:0]
+
+    def lookup(self, keys):
+        """(найдено, info, payment, count) для каждого ключа загрузки"""
+        base_pos = self.base.index.get_indexer(keys)
+        delta_pos = self.delta.index.get_indexer(keys)
+        in_base = base_pos >= 0
+        in_delta = delta_pos >= 0
+
+        info = np.full(len(keys), -1, dtype=np.int64)
+        payment = np.full(len(keys), -1, dtype=np.int64)
+        count = np.zeros(len(keys), dtype=np.int64)
+        for table, positions, mask in ((self.base, base_pos, in_base), (self.delta, delta_pos, in_delta)):
+            # Дельта записана позже, поэтому её "последняя оплата" перекрывает основную
+            info[mask] = table['info'].to_numpy()[positions[mask]]
+            payment[mask] = table['payment'].to_numpy()[positions[mask]]
+            count[mask] += table['count'].to_numpy()[positions[mask]]
+        return in_base | in_delta, info, payment, count
+
+
+def _aggregate(keys, info, payments):
+    """Сворачивает записи до одной строки на ключ (последняя запись + счётчик)"""
+    frame = pd.DataFrame({'info': info, 'payment': payments, 'count': 1}, index=pd.Index(keys, dtype=np.int64))
+    return _merge(frame.iloc[:0], frame)
+
+
+def _merge(older, newer):
+    both = pd.concat([older, newer])
+    counts = both.groupby(level=0, sort=False)['count'].sum()
+    latest = both[~both.index.duplicated(keep='last')].copy()
+    latest['count'] = counts.reindex(latest.index).to_numpy()
+    return latest
+
+
+class VisitIndex:
+    """Индекс истории по трём ключам сравнения на целочисленных кодах
+
+    full: (ID, визит, дата), visit_type: (ID, визит), date: (ID, дата).
+    ID и визиты кодируются общими словарями (у категориальных столбцов
+    компактной истории - только словарь категорий), даты - номерами дней
+    в общем словаре дат; ключи - int64,
+    а для каждого ключа хранится одна агрегированная строка (последняя
+    оплата и их число), поэтому сопоставление векторизовано, не строит
+    строковых столбцов и не размножает строки загрузки.
+
+    Индекс строится один раз на версию хранилища и дополняется на месте при
+    сохранении новых визитов, поэтому классификация загрузки стоит O(размер
+    загрузки), а не O(история + загрузка).
+    """
+
+    def __init__(self):
+        self.subjects = _Vocabulary('subject_id', SUBJECT_BITS)
+        self.visits = _Vocabulary('visit_name', VISIT_BITS)
+        # Даты кодируются номерами дней (NaT -> -1), без строкового представления
+        self.dates = _Vocabulary('visit_date', DATE_BITS, dtype=np.int64)
+        self.full = _KeyTable()
+        self.visit_type = _KeyTable()
+        self.date = _KeyTable()
+        self.size = 0
+        self.names = NameMatcher()
+        self._subject_visits = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_frame(cls, paid_visits):
+        index = cls()
+        index.add_frame(paid_visits)
+        return index
+
+    def add_frame(self, paid_visits):
+        """Добавляет записи истории в индекс"""
+        if paid_visits.empty:
+            return
+        with self._lock:
+            subject = self.subjects.encode_column(paid_visits['subject_id'])
+            visit = self.visits.encode_column(paid_visits['visit_name'])
+            visit_date = self.dates.encode(day_numbers(paid_visits['visit_date']))
+            payment = self.dates.encode(day_numbers(paid_visits['payment_date']))
+
+            self.full.add(_full_key(subject, visit, visit_date), visit_date, payment)
+            self.visit_type.add(_visit_type_key(subject, visit), visit_date, payment)
+            self.date.add(_date_key(subject, visit_date), visit, payment)
+            self.size += len(paid_visits)
+            self._subject_visits = None
+
+    def classify(self, uploaded_df):
+        """Разделяет загрузку на новые визиты и три вида дубликатов
+
+        Каждая строка загрузки попадает ровно в одну категорию; к дубликатам
+        добавляются сведения о последней предыдущей оплате и число оплат.
+        """
+        with self._lock:
+            subject = self.subjects.lookup(key_text(uploaded_df['subject_id']))
+            visit = self.visits.lookup(key_text(uploaded_df['visit_name']))
+            visit_date = self.dates.lookup(day_numbers(uploaded_df['visit_date']))
+
+            # Неизвестное значение (-1) делает ключ заведомо отсутствующим
+            full_found, _, full_payment, full_count = self.full.lookup(
+                np.where((subject >= 0) & (visit >= 0) & (visit_date >= 0), _full_key(subject, visit, visit_date), -1))
+            type_found, type_date, type_payment, type_count = self.visit_type.lookup(
+                np.where((subject >= 0) & (visit >= 0), _visit_type_key(subject, visit), -1))
+            date_found, date_visit, date_payment, date_count = self.date.lookup(
+                np.where((subject >= 0) & (visit_date >= 0), _date_key(subject, visit_date), -1))
+
+            exact_mask = full_found
+            same_type_mask = type_found & ~exact_mask
+            same_date_mask = date_found & ~exact_mask & ~same_type_mask
+
+            new_visits = uploaded_df[~(exact_mask | same_type_mask | same_date_mask)].copy()
+            exact_duplicates = _with_previous(uploaded_df, exact_mask, {
+                'previous_payment_date': self._decode_dates(full_payment[exact_mask]),
+                'previous_count': full_count[exact_mask],
+            })
+            same_visit_different_date = _with_previous(uploaded_df, same_type_mask, {
+                'previous_visit_date': self._decode_dates(type_date[same_type_mask]),
+                'previous_payment_date': self._decode_dates(type_payment[same_type_mask]),
+                'previous_count': type_count[same_type_mask],
+            })
+            suspicious_same_date = _with_previous(uploaded_df, same_date_mask, {
+                'previous_visit_name': self.visits.decode(date_visit[same_date_mask]),
+                'previous_payment_date': self._decode_dates(date_payment[same_date_mask]),
+                'previous_count': date_count[same_date_mask],
+            })
+        return new_visits, exact_duplicates, same_visit_different_date, suspicious_same_date
+
+    def find_similar(self, new_visits):
+        """Отделяет новые визиты, название которых похоже на уже оплаченный визит субъекта
+
+        Кандидаты - только визиты того же субъекта (блоки по отсортированным
+        ключам (ID, визит)), сходство считается один раз на пару различных
+        названий. Возвращает (новые визиты, похожие названия); к похожим
+        добавляются самый похожий оплаченный визит, его оплата и сходство.
+        """
+        with self._lock:
+            subject = self.subjects.lookup(key_text(new_visits['subject_id']))
+            keys = self._subject_visit_keys()
+            rows = np.flatnonzero(subject >= 0)
+            start = np.searchsorted(keys, subject[rows] << VISIT_BITS)
+            counts = np.searchsorted(keys, (subject[rows] + 1) << VISIT_BITS) - start
+            pair_row = np.repeat(rows, counts)
+            pair_key = keys[np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+            pair_visit = pair_key & ((1 << VISIT_BITS) - 1)
+
+            upload_names = key_text(new_visits['visit_name']).to_numpy(dtype=object)[pair_row]
+            name_codes, unique_names = pd.factorize(upload_names)
+            vocabulary = len(self.visits.values)
+            inverse, pair_ids = pd.factorize(name_codes * vocabulary + pair_visit)
+            self.names.prepare(unique_names)
+            self.names.prepare(self.visits.values[pd.unique(pair_visit)])
+            scores = np.array([
+                self.names.similarity(unique_names[pair_id // vocabulary], self.visits.values[pair_id % vocabulary])
+                for pair_id in pair_ids
+            ], dtype=float)
+            pair_score = scores[inverse] if len(pair_ids) else np.empty(0)
+
+            _, visit_date, payment, count = self.visit_type.lookup(pair_key)
+            # Лучший кандидат строки: наибольшее сходство, затем последняя оплата
+            payment_day = self.dates.values.take(np.maximum(payment, 0)) if len(payment) else payment
+            order = np.lexsort((payment_day, pair_score, pair_row))
+            last = np.r_[pair_row[order][1:] != pair_row[order][:-1], True] if len(order) else np.empty(0, dtype=bool)
+            best = order[last]
+            best = best[pair_score[best] >= self.names.threshold]
+
+            mask = np.zeros(len(new_visits), dtype=bool)
+            mask[pair_row[best]] = True
+            similar_names = _with_previous(new_visits, mask, {
+                'previous_visit_name': self.visits.decode(pair_visit[best]),
+                'previous_visit_date': self._decode_dates(visit_date[best]),
+                'previous_payment_date': self._decode_dates(payment[best]),
+                'previous_count': count[best],
+                'similarity': np.round(pair_score[best], 2),
+            })
+        return new_visits[~mask].copy(), similar_names
+
+    def _subject_visit_keys(self):
+        """Отсортированные ключи (ID, визит) истории - блоки кандидатов по субъекту"""
+        if self._subject_visits is None:
+            keys = np.sort(np.concatenate([
+                self.visit_type.base.index.to_numpy(), self.visit_type.delta.index.to_numpy()
+            ]))
+            # Ключ может быть и в основной таблице, и в дельте
+            self._subject_visits = keys[np.r_[True, keys[1:] != keys[:-1]]] if len(keys) else keys
+        return self._subject_visits
+
+    def _decode_dates(self, codes):
+        """Коды дат -> строки "YYYY-MM-DD" только для найденных строк загрузки"""
+        days = self.dates.values.take(np.maximum(codes, 0)) if len(self.dates.values) else np.full(len(codes), -1)
+        days = np.where(codes < 0, -1, days)
+        return format_dates(days)
+
+
+def key_text(values):
+    """Строковые ключи столбца; пропуск (None, NaN) -> MISSING_KEY независимо от версии pandas"""
+    values = values.astype(object)
+    return values.where(values.notna(), MISSING_KEY).astype(str)
+
+
+def _full_key(subject, visit, visit_date):
+    return (subject << (VISIT_BITS + DATE_BITS)) | (visit << DATE_BITS) | visit_date
+
+
+def _visit_type_key(subject, visit):
+    return (subject << VISIT_BITS) | visit
+
+
+def _date_key(subject, visit_date):
+    return (subject << DATE_BITS) | visit_date
+
+
+def _with_previous(uploaded_df, mask, previous_columns):
+    """Строки загрузки с добавленными столбцами предыдущей оплаты"""
+    result = uploaded_df[mask].reset_index(drop=True)
+    for column, values in previous_columns.items():
+        result[column] = values
+    return result
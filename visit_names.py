@@ -0,0 +1,66 @@
+"""Нормализация названий визитов и нечёткое сравнение по триграммам
+
+Нормализация (пробелы, регистр, латинские буквы, похожие на кириллицу,
+варианты тире и "ё") выполняется векторно по словарю различных названий,
+а сравнение - только для пар названий, которые встретились у одного
+субъекта, поэтому стоимость почти линейна по размеру загрузки.
+"""
+import re
+
+import pandas as pd
+
+# Сходство (доля общих триграмм от меньшего названия), начиная с которого названия похожи
+SIMILARITY_THRESHOLD = 0.8
+
+# Латинские буквы, которые в названиях выглядят как кириллические (после приведения к нижнему регистру)
+HOMOGLYPHS = str.maketrans({
+    'a': 'а', 'b': 'в', 'c': 'с', 'e': 'е', 'h': 'н', 'k': 'к', 'm': 'м',
+    'o': 'о', 'p': 'р', 't': 'т', 'x': 'х', 'y': 'у', 'ё': 'е',
+    '–': '-', '—': '-', '−': '-', '\u00a0': ' ',
+})
+NUMBER_PATTERN = re.compile(r'\d+')
+
+
+def normalize_names(names):
+    """Нормализованные названия: без лишних пробелов, в нижнем регистре, кириллицей"""
+    names = pd.Series(names, dtype=object).astype(str)
+    return (
+        names.str.casefold()
+        .str.translate(HOMOGLYPHS)
+        .str.replace(r'\s*-\s*', ' - ', regex=True)
+        .str.replace(r'\s+', ' ', regex=True)
+        .str.strip()
+        .to_numpy(dtype=object)
+    )
+
+
+class NameMatcher:
+    """Сходство названий визитов с кэшем нормализованных форм и триграмм"""
+
+    def __init__(self, threshold=SIMILARITY_THRESHOLD):
+        self.threshold = threshold
+        self._forms = {}
+
+    def prepare(self, names):
+        """Нормализует ещё не встречавшиеся названия (одним векторным проходом)"""
+        unseen = [name for name in pd.unique(pd.Series(names, dtype=object).astype(str)) if name not in self._forms]
+        if unseen:
+            for name, normalized in zip(unseen, normalize_names(unseen)):
+                self._forms[name] = (normalized, tuple(NUMBER_PATTERN.findall(normalized)), _trigrams(normalized))
+
+    def similarity(self, left, right):
+        """1.0 для названий, равных после нормализации; 0.0, если различаются номера визитов"""
+        left_form, left_numbers, left_trigrams = self._forms[left]
+        right_form, right_numbers, right_trigrams = self._forms[right]
+        if left_form == right_form:
+            return 1.0
+        # "Визит 1" и "Визит 10 - ..." - разные визиты, как бы ни были похожи строки
+        if left_numbers != right_numbers:
+            return 0.0
+        shared = len(left_trigrams & right_trigrams)
+        return shared / min(len(left_trigrams), len(right_trigrams))
+
+
+def _trigrams(text):
+    padded = f"  {text} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))